@@ -7,7 +7,6 @@ Bookkeeping from PyPeIt.
 
 ToDo: Not used at this moment
 """
-from IPython import embed
 import numpy
 import os
 import textwrap
@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
 def degtorad(d):
     """
@@ -62,6 +61,7 @@ def positionAngle(ra1, dec1, ra2, dec2, plot=False, positive=False):
       given as an angle between 0 and 360 degrees.
 
     """
+    import matplotlib.pyplot as plt
 
     # Convert into rad
     rarad1 = degtorad(ra1)
@@ -2,6 +2,7 @@
 Module for CFHT WIRCam
 
 """
+import os
 import glob
 import numpy as np
 
@@ -354,9 +355,9 @@ class CFHTWIRCAMCamera(camera.Camera):
             Exposure time read from the file header
         """
         # Check for file; allow for extra .gz, etc. suffix
-        fil = glob.glob(raw_file + '*')
+        fil = [raw_file] if os.path.isfile(raw_file) else glob.glob(raw_file + '*')
         if len(fil) != 1:
-            msgs.error("Found {:d} files matching {:s}".format(len(fil)))
+            msgs.error("Found {:d} files matching {:s}".format(len(fil), raw_file))
 
         # Read
         msgs.info("Reading CFHT WIRCam processed image: {:s}".format(fil[0]))
@@ -339,9 +339,9 @@ class KeckLRISBCamera(KeckLRISCamera):
             pixel. Pixels unassociated with any amplifier are set to 0.
         """
         # Check for file; allow for extra .gz, etc. suffix
-        fil = glob.glob(raw_file + '*')
+        fil = [raw_file] if os.path.isfile(raw_file) else glob.glob(raw_file + '*')
         if len(fil) != 1:
-            msgs.error("Found {:d} files matching {:s}".format(len(fil)))
+            msgs.error("Found {:d} files matching {:s}".format(len(fil), raw_file))
 
         # Read
         msgs.info("Reading LRIS file: {:s}".format(fil[0]))
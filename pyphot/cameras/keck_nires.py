@@ -3,6 +3,7 @@ Module for Keck NIRES slit view camera
 
 Modified from PyPeIt.
 """
+import os
 import glob
 
 import numpy as np
@@ -218,9 +219,9 @@ class KECKNIRESCamera(camera.Camera):
             Exposure time read from the file header
         """
         # Check for file; allow for extra .gz, etc. suffix
-        fil = glob.glob(raw_file + '*')
+        fil = [raw_file] if os.path.isfile(raw_file) else glob.glob(raw_file + '*')
         if len(fil) != 1:
-            msgs.error("Found {:d} files matching {:s}".format(len(fil)))
+            msgs.error("Found {:d} files matching {:s}".format(len(fil), raw_file))
 
         # Read
         msgs.info("Reading NIRES file: {:s}".format(fil[0]))
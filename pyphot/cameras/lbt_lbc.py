@@ -2,7 +2,7 @@
 Module for LBT/LBC
 
 """
-import glob,gc
+import os,glob,gc
 import numpy as np
 
 from astropy import wcs
@@ -136,9 +136,9 @@ class LBTLBCCamera(camera.Camera):
             Exposure time read from the file header
         """
         # Check for file; allow for extra .gz, etc. suffix
-        fil = glob.glob(raw_file + '*')
+        fil = [raw_file] if os.path.isfile(raw_file) else glob.glob(raw_file + '*')
         if len(fil) != 1:
-            msgs.error("Found {:d} files matching {:s}".format(len(fil)))
+            msgs.error("Found {:d} files matching {:s}".format(len(fil), raw_file))
 
         # Read
         msgs.info("Reading LBT LBC file: {:s}".format(fil[0]))
@@ -2,6 +2,7 @@
 Module for Magellan IMACS
 
 """
+import os
 import glob
 
 import numpy as np
@@ -137,9 +138,9 @@ class MagellanIMACSCamera(camera.Camera):
         """
         # Check for file; allow for extra .gz, etc. suffix
         raw_file = raw_file.replace('c1.fits','c{:01d}.fits'.format(det))
-        fil = glob.glob(raw_file + '*')
+        fil = [raw_file] if os.path.isfile(raw_file) else glob.glob(raw_file + '*')
         if len(fil) != 1:
-            msgs.error("Found {:d} files matching {:s}".format(len(fil)))
+            msgs.error("Found {:d} files matching {:s}".format(len(fil), raw_file))
 
         # Read
         msgs.info("Reading IMACS F2 file: {:s}".format(fil[0]))
@@ -8,8 +8,8 @@ import numpy as np
 
 import multiprocessing
 from multiprocessing import Process, Queue
+from concurrent.futures import ThreadPoolExecutor
 
-from astropy import stats
 
 from pyphot import msgs
 from pyphot import utils
@@ -17,6 +17,7 @@ from pyphot import io
 from pyphot.lacosmic import lacosmic
 from pyphot.satdet import satdet
 from pyphot.photometry import BKG2D, mask_bright_star
+from pyphot.procimg import grow_masked, combine_masks, pack_flags
 
 def ccdproc_old(scifiles, camera, det, science_path=None, masterbiasimg=None, masterdarkimg=None, masterpixflatimg=None,
                 masterillumflatimg=None, bpm_proc=None, mask_vig=False, minimum_vig=0.5, apply_gain=False, grow=1.5,
@@ -87,14 +88,16 @@ def ccdproc_old(scifiles, camera, det, science_path=None, masterbiasimg=None, ma
                 # ToDo: Not sure whether the following is safe or not.
                 #  Basically, we are using the sky background for vignetting.
                 #  IMACS need this since the guider moves around the detector.
-                bpm_for_vig = bpm | bpm_zero | bpm_vig_1 | bpm_proc
+                bpm_for_vig = combine_masks(bpm, bpm_zero, bpm_vig_1, bpm_proc)
                 starmask = mask_bright_star(sci_image, mask=bpm_for_vig, brightstar_nsigma=5., back_nsigma=3.,
                                             back_maxiters=5, method='sextractor', task=sextractor_task)
                 bkg_for_vig, _ = BKG2D(sci_image, (50,50), mask=bpm_for_vig | starmask, filter_size=(3,3),
                                        sigclip=5., back_type='sextractor')
-                bpm_vig_2 = sci_image < (1-minimum_vig) * np.median(bkg_for_vig[np.invert(bpm_for_vig)])
-                bpm_vig_3 = bkg_for_vig < (1-minimum_vig) * np.median(bkg_for_vig[np.invert(bpm_for_vig)])
-                bpm_vig_all = bpm_vig_1 | bpm_vig_2 | bpm_vig_3
+                vig_thresh = (1-minimum_vig) * np.median(bkg_for_vig[~bpm_for_vig])
+                # a pixel is vignetted if either the image or its background falls below the threshold,
+                # fmin skips NaNs so this matches (sci_image < vig_thresh) | (bkg_for_vig < vig_thresh)
+                bpm_vig_all = np.fmin(sci_image, bkg_for_vig) < vig_thresh
+                bpm_vig_all |= bpm_vig_1
 
                 bpm_vig = grow_masked(bpm_vig_all, grow, verbose=verbose)
                 ## Set viginetting pixel to be zero
@@ -113,7 +116,7 @@ def ccdproc_old(scifiles, camera, det, science_path=None, masterbiasimg=None, ma
             bpm_nan = np.isnan(sci_image) | np.isinf(sci_image)
 
             ## master BPM mask, contains all bpm except for saturated values.
-            bpm_all = bpm | bpm_zero | bpm_vig | bpm_nan | bpm_proc
+            bpm_all = combine_masks(bpm, bpm_zero, bpm_vig, bpm_nan, bpm_proc)
 
             ## replace saturated values
             ## ToDo: explore the replacement algorithm, replace a bad pixel using the median of a box
@@ -122,16 +125,19 @@ def ccdproc_old(scifiles, camera, det, science_path=None, masterbiasimg=None, ma
             #sci_image[bpm_sat] = np.max(sci_image[np.invert(bpm_all)])
 
             ## replace other bad pixel values.
-            if replace == 'zero':
+            # the clipped statistics are a few passes over the whole image, skip them if there is nothing to replace
+            if replace is not None and not np.any(bpm_all):
+                msgs.info('No bad pixels to be replaced')
+            elif replace == 'zero':
                 sci_image[bpm_all] = 0
             elif replace == 'median':
-                _,sci_image[bpm_all],_ = stats.sigma_clipped_stats(sci_image, bpm_all, sigma=3, maxiters=5)
+                sci_image[bpm_all] = utils.clipped_stat(sci_image, bpm_all, stat='median', sigclip=3, n_clip=5)
             elif replace == 'mean':
-                sci_image[bpm_all],_,_ = stats.sigma_clipped_stats(sci_image, bpm_all, sigma=3, maxiters=5)
+                sci_image[bpm_all] = utils.clipped_stat(sci_image, bpm_all, stat='mean', sigclip=3, n_clip=5)
             elif replace == 'min':
-                sci_image[bpm_all] = np.min(sci_image[np.invert(bpm_all)])
+                sci_image[bpm_all] = np.min(sci_image, where=np.invert(bpm_all), initial=np.inf)
             elif replace == 'max':
-                sci_image[bpm_all] = np.max(sci_image[np.invert(bpm_all)])
+                sci_image[bpm_all] = np.max(sci_image, where=np.invert(bpm_all), initial=-np.inf)
             else:
                 msgs.info('Not replacing bad pixel values')
 
@@ -139,166 +145,302 @@ def ccdproc_old(scifiles, camera, det, science_path=None, masterbiasimg=None, ma
             # save images
             io.save_fits(sci_fits, sci_image, header, 'ScienceImage', overwrite=True)
             msgs.info('Science image {:} saved'.format(sci_fits))
-            flag_image = bpm*np.int(2**0) + bpm_proc*np.int(2**1) + bpm_sat*np.int(2**2) + \
-                         bpm_zero * np.int(2**3) + bpm_vig*np.int(2**4) + bpm_nan*np.int(2**5)
-            io.save_fits(flag_fits, flag_image.astype('int32'), header, 'FlagImage', overwrite=True)
+            flag_image = pack_flags((bpm, bpm_proc, bpm_sat, bpm_zero, bpm_vig, bpm_nan))
+            io.save_fits(flag_fits, flag_image, header, 'FlagImage', overwrite=True)
             msgs.info('Flag image {:} saved'.format(flag_fits))
 
     return sci_fits_list, flag_fits_list
 
-def sciproc_old(scifiles, flagfiles, mastersuperskyimg=None, airmass=None, coeff_airmass=0.,
+def sciproc_old(scifiles, flagfiles, mastersuperskyimg=None, airmass=None, coeff_airmass=0., n_process=1,
             back_type='median', back_rms_type='std', back_size=(200,200), back_filtersize=(3, 3), back_maxiters=5, grow=1.5,
             maskbrightstar=True, brightstar_nsigma=3, maskbrightstar_method='sextractor', sextractor_task='sex',
-            mask_cr=True, contrast=2, lamaxiter=1, sigclip=5.0, cr_threshold=5.0, neighbor_threshold=2.0,
+            mask_cr=True, cr_method='lacosmic', contrast=2, lamaxiter=1, sigclip=5.0, cr_threshold=5.0, neighbor_threshold=2.0,
             mask_sat=True, sat_sig=3.0, sat_buf=20, sat_order=3, low_thresh=0.1, h_thresh=0.5,
             small_edge=60, line_len=200, line_gap=75, percentile=(4.5, 93.0),
-            mask_negative_star=False, replace=None):
-
-    sci_fits_list = []
-    wht_fits_list = []
-    flag_fits_list = []
-    for ii, ifile in enumerate(scifiles):
-        #ToDo: parallel this
-        # prepare output file names
-        sci_fits = ifile.replace('_proc.fits','_sci.fits')
-        sci_fits_list.append(sci_fits)
-        wht_fits = ifile.replace('_proc.fits','_sci.weight.fits')
-        wht_fits_list.append(wht_fits)
-        flag_fits = ifile.replace('_proc.fits','_flag.fits')
-        flag_fits_list.append(flag_fits)
-        if os.path.exists(sci_fits):
-            msgs.info('The Science product {:} exists, skipping...'.format(sci_fits))
-        else:
-            msgs.info('Processing {:}'.format(ifile))
-            header, data, _ = io.load_fits(ifile)
-            _, flag_image, _ = io.load_fits(flagfiles[ii])
-            bpm = flag_image>0
-            bpm_zero = data == 0.
-
-            ## super flattening your images
-            if mastersuperskyimg is not None:
-                data *= utils.inverse(mastersuperskyimg)
-
-            if airmass is not None:
-                if len(airmass) != len(scifiles):
-                    msgs.error('The length of airmass table should be the same with the number of exposures.')
-
-                # do the correction.
-                mag_ext = coeff_airmass * (airmass[ii]-1)
-                data *= 10**(0.4*mag_ext)
-
-            # mask bright stars before estimating the background
-            if maskbrightstar:
-                starmask = mask_bright_star(data, mask=bpm, brightstar_nsigma=brightstar_nsigma, back_nsigma=sigclip,
-                                            back_maxiters=back_maxiters, method=maskbrightstar_method, task=sextractor_task)
+            mask_negative_star=False, replace=None, compress=None, verbose=True):
+
+    n_file = len(scifiles)
+    n_cpu = multiprocessing.cpu_count()
+
+    if n_process > n_cpu:
+        n_process = n_cpu
+
+    if n_process>n_file:
+        n_process = n_file
+
+    if airmass is not None:
+        if len(airmass) != len(scifiles):
+            msgs.error('The length of airmass table should be the same with the number of exposures.')
+    else:
+        airmass = [None]*n_file
+
+    # prepare output file names, the order follows scifiles no matter how the files are processed
+    sci_fits_list = [ifile.replace('_proc.fits','_sci.fits') for ifile in scifiles]
+    wht_fits_list = [ifile.replace('_proc.fits','_sci.weight.fits') for ifile in scifiles]
+    flag_fits_list = [ifile.replace('_proc.fits','_flag.fits') for ifile in scifiles]
+
+    kwargs = {'mastersuperskyimg': mastersuperskyimg, 'coeff_airmass': coeff_airmass,
+              'back_type': back_type, 'back_rms_type': back_rms_type, 'back_size': back_size,
+              'back_filtersize': back_filtersize, 'back_maxiters': back_maxiters, 'grow': grow,
+              'maskbrightstar': maskbrightstar, 'brightstar_nsigma': brightstar_nsigma,
+              'maskbrightstar_method': maskbrightstar_method, 'sextractor_task': sextractor_task,
+              'mask_cr': mask_cr, 'cr_method': cr_method, 'contrast': contrast, 'lamaxiter': lamaxiter, 'sigclip': sigclip,
+              'cr_threshold': cr_threshold, 'neighbor_threshold': neighbor_threshold, 'mask_sat': mask_sat,
+              'sat_sig': sat_sig, 'sat_buf': sat_buf, 'sat_order': sat_order, 'low_thresh': low_thresh,
+              'h_thresh': h_thresh, 'small_edge': small_edge, 'line_len': line_len, 'line_gap': line_gap,
+              'percentile': percentile, 'mask_negative_star': mask_negative_star, 'replace': replace,
+              'compress': compress}
+
+    if n_process <= 1:
+        # Reading the next exposure and writing the previous products are done in a
+        # background thread (FITS I/O releases the GIL) while the current one is processed.
+        todo = []
+        for ii in range(n_file):
+            if os.path.exists(sci_fits_list[ii]):
+                msgs.info('The Science product {:} exists, skipping...'.format(sci_fits_list[ii]))
             else:
-                starmask = np.zeros_like(data, dtype=bool)
-
-            # estimate the 2D background with all masks
-            # do not mask viginetting pixels when estimating the background to reduce edge effect
-            bpm_bkg = (bpm | starmask)
-            background_array, background_rms = BKG2D(data, back_size, mask=bpm_bkg, filter_size=back_filtersize,
-                                                     sigclip=sigclip, back_type=back_type, back_rms_type=back_rms_type,
-                                                     back_maxiters=back_maxiters,sextractor_task=sextractor_task)
-            ## OLD Sky background subtraction
-            # ToDo: the following seems having memory leaking, need to solve the issue or switch to SExtractor.
-            #from astropy.stats import SigmaClip
-            #from photutils import Background2D
-            #from photutils import MeanBackground, MedianBackground, SExtractorBackground
-            #sigma_clip = SigmaClip(sigma=sigclip)
-            #if back_type == 'median':
-            #    bkg_estimator = MedianBackground()
-            #elif back_type == 'mean':
-            #    bkg_estimator = MeanBackground()
-            #else:
-            #    bkg_estimator = SExtractorBackground()
-            #tmp = data.copy()
-            #bkg = Background2D(tmp, back_size, mask=mask_bkg, filter_size=back_filtersize,
-            #                   sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
-            #background_array = bkg.background
-            #background_rms = bkg.background_rms
-            # clean up memory
-            #del tmp, bkg, data, mask_bkg
-            #gc.collect()
-
-            # subtract the background
-            msgs.info('Subtracting 2D background')
-            sci_image = data-background_array
-
-            # CR mask
-            if mask_cr:
-                msgs.info('Identifying cosmic rays using the L.A.Cosmic algorithm')
-                bpm_cr_tmp = lacosmic(sci_image, contrast, cr_threshold, neighbor_threshold,
-                                      error=background_rms, mask=bpm, background=background_array, effective_gain=None,
-                                      readnoise=None, maxiter=lamaxiter, border_mode='mirror')
-                bpm_cr = grow_masked(bpm_cr_tmp, grow, verbose=verbose)
-                # seems not working as good as lacosmic.py
-                # grow=1.5, remove_compact_obj=True, sigfrac=0.3, objlim=5.0,
-                #bpm_cr = lacosmic_pypeit(sci_image, saturation, nonlinear, varframe=None, maxiter=maxiter, grow=grow,
-                #                  remove_compact_obj=remove_compact_obj, sigclip=sigclip, sigfrac=sigfrac, objlim=objlim)
-            else:
-                msgs.warn('Skipped cosmic ray rejection process!')
-                bpm_cr = np.zeros_like(sci_image,dtype=bool)
-
-            # satellite trail mask
-            if mask_sat:
-                msgs.info('Identifying satellite trails using the Canny algorithm following ACSTOOLS.')
-                bpm_sat = satdet(sci_image, bpm=bpm|bpm_cr, sigma=sat_sig, buf=sat_buf, order=sat_order,
-                                 low_thresh=low_thresh, h_thresh=h_thresh, small_edge=small_edge,
-                                 line_len=line_len, line_gap=line_gap, percentile=percentile)
-            else:
-                bpm_sat = np.zeros_like(sci_image,dtype=bool)
-
-            # negative star mask
-            if mask_negative_star:
-                msgs.info('Masking negative stars with {:}'.format(maskbrightstar_method))
-                bpm_negative_tmp = mask_bright_star(0-sci_image, mask=bpm, brightstar_nsigma=brightstar_nsigma, back_nsigma=sigclip,
-                                                back_maxiters=back_maxiters, method=maskbrightstar_method, task=sextractor_task)
-                bpm_negative = grow_masked(bpm_negative_tmp, grow, verbose=verbose)
-            else:
-                bpm_negative = np.zeros_like(sci_image, dtype=bool)
-
-            # add the cosmic ray and satellite trail flag
-            flag_image_new = flag_image + bpm_cr.astype('int32')*np.int(2**6) + bpm_sat.astype('int32')*np.int(2**7)
-            flag_image_new += bpm_negative.astype('int32')*np.int(2**8)
-
-            # make a mask used for statistics.
-            # should not include starmask since they are not bad pixels if you want to use this mask for other purpose
-            mask_all = bpm | bpm_cr | bpm_sat | bpm_negative | starmask
+                todo.append(ii)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            writes = []
+            writer = lambda func, *args: writes.append(pool.submit(func, *args))
+            if len(todo) > 0:
+                prefetch = pool.submit(_load_sciproc_old_inputs, scifiles[todo[0]], flagfiles[todo[0]])
+            for jj, ii in enumerate(todo):
+                inputs = prefetch.result()
+                if jj + 1 < len(todo):
+                    kk = todo[jj + 1]
+                    prefetch = pool.submit(_load_sciproc_old_inputs, scifiles[kk], flagfiles[kk])
+                _sciproc_old_one(scifiles[ii], flagfiles[ii], airmass[ii], inputs=inputs, writer=writer,
+                                 verbose=verbose, **kwargs)
+            # raise any error from the writes
+            for future in writes:
+                future.result()
+    else:
+        msgs.info('Start parallel processing with n_process={:}'.format(n_process))
+        work_queue = Queue()
+        processes = []
+
+        for ii in range(n_file):
+            work_queue.put((scifiles[ii], flagfiles[ii], airmass[ii]))
+        # one sentinel per worker
+        for w in range(n_process):
+            work_queue.put(None)
+
+        # creating processes
+        for w in range(n_process):
+            p = Process(target=_sciproc_old_worker, args=(work_queue,),
+                        kwargs=dict(kwargs, verbose=False))
+            processes.append(p)
+            p.start()
+
+        # completing process
+        for p in processes:
+            p.join()
+        if any(p.exitcode != 0 for p in processes):
+            msgs.error('Science image processing failed for at least one exposure.')
 
-            ## replace cosmic ray and satellite affected pixels?
-            # ToDo: explore the replacement algorithm, replace a bad pixel using the median of a box
-            bpm_replace = bpm_cr | bpm_sat
-            if replace == 'zero':
-                sci_image[bpm_replace] = 0
-            elif replace == 'median':
-                _,sci_image[bpm_replace],_ = stats.sigma_clipped_stats(sci_image, mask_all, sigma=sigclip, maxiters=5)
-            elif replace == 'mean':
-                sci_image[bpm_replace],_,_ = stats.sigma_clipped_stats(sci_image, mask_all, sigma=sigclip, maxiters=5)
-            elif replace == 'min':
-                sci_image[bpm_replace] = np.min(sci_image[np.invert(mask_all)])
-            elif replace == 'max':
-                sci_image[bpm_replace] = np.max(sci_image[np.invert(mask_all)])
-            else:
-                msgs.info('Not replacing bad pixel values')
-
-            # Generate weight map used for SExtractor and SWarp (WEIGHT_TYPE = MAP_WEIGHT)
-            wht_image = utils.inverse(background_array)
-
-            # Always set original zero values to be zero, this can avoid significant negative values after sky subtraction
-            sci_image[bpm_zero] = 0
-            # Also set negative stars to be zero
-            sci_image[bpm_negative] = 0
-
-            # Set bad pixel's weight to be zero
-            wht_image[flag_image_new>0] = 0
+    return sci_fits_list, wht_fits_list, flag_fits_list
 
-            # save images
-            io.save_fits(sci_fits, sci_image, header, 'ScienceImage', overwrite=True)
-            msgs.info('Science image {:} saved'.format(sci_fits))
-            io.save_fits(wht_fits, wht_image, header, 'WeightImage', overwrite=True)
-            msgs.info('Weight image {:} saved'.format(wht_fits))
-            io.save_fits(flag_fits, flag_image_new.astype('int32'), header, 'FlagImage', overwrite=True)
-            msgs.info('Flag image {:} saved'.format(flag_fits))
+def _sciproc_old_one(ifile, flagfile, airmass, mastersuperskyimg=None, coeff_airmass=0.,
+            back_type='median', back_rms_type='std', back_size=(200,200), back_filtersize=(3, 3), back_maxiters=5, grow=1.5,
+            maskbrightstar=True, brightstar_nsigma=3, maskbrightstar_method='sextractor', sextractor_task='sex',
+            mask_cr=True, cr_method='lacosmic', contrast=2, lamaxiter=1, sigclip=5.0, cr_threshold=5.0, neighbor_threshold=2.0,
+            mask_sat=True, sat_sig=3.0, sat_buf=20, sat_order=3, low_thresh=0.1, h_thresh=0.5,
+            small_edge=60, line_len=200, line_gap=75, percentile=(4.5, 93.0),
+            mask_negative_star=False, replace=None, compress=None, inputs=None, writer=None, verbose=True):
+
+    # prepare output file names
+    sci_fits = ifile.replace('_proc.fits','_sci.fits')
+    wht_fits = ifile.replace('_proc.fits','_sci.weight.fits')
+    flag_fits = ifile.replace('_proc.fits','_flag.fits')
+    if os.path.exists(sci_fits):
+        msgs.info('The Science product {:} exists, skipping...'.format(sci_fits))
+    else:
+        msgs.info('Processing {:}'.format(ifile))
+        if inputs is None:
+            inputs = _load_sciproc_old_inputs(ifile, flagfile)
+        header, data, flag_image = inputs
+        bpm = flag_image>0
+        bpm_zero = data == 0.
+
+        ## super flattening and extinction correction in a single pass over data
+        if airmass is not None:
+            mag_ext = coeff_airmass * (airmass-1)
+            flux_scale = 10**(0.4*mag_ext)
+        else:
+            flux_scale = 1.
+        if mastersuperskyimg is not None:
+            scale_image = utils.inverse(mastersuperskyimg)
+            scale_image *= flux_scale
+            data *= scale_image
+            del scale_image
+        elif airmass is not None:
+            data *= flux_scale
+
+        # mask bright stars before estimating the background
+        if maskbrightstar:
+            starmask = mask_bright_star(data, mask=bpm, brightstar_nsigma=brightstar_nsigma, back_nsigma=sigclip,
+                                        back_maxiters=back_maxiters, method=maskbrightstar_method, task=sextractor_task)
+        else:
+            starmask = np.zeros_like(data, dtype=bool)
+
+        # estimate the 2D background with all masks
+        # do not mask viginetting pixels when estimating the background to reduce edge effect
+        bpm_bkg = (bpm | starmask)
+        background_array, background_rms = BKG2D(data, back_size, mask=bpm_bkg, filter_size=back_filtersize,
+                                                 sigclip=sigclip, back_type=back_type, back_rms_type=back_rms_type,
+                                                 back_maxiters=back_maxiters,sextractor_task=sextractor_task)
+        background_array = background_array.astype(np.float32, copy=False)
+        ## OLD Sky background subtraction
+        # ToDo: the following seems having memory leaking, need to solve the issue or switch to SExtractor.
+        #from astropy.stats import SigmaClip
+        #from photutils import Background2D
+        #from photutils import MeanBackground, MedianBackground, SExtractorBackground
+        #sigma_clip = SigmaClip(sigma=sigclip)
+        #if back_type == 'median':
+        #    bkg_estimator = MedianBackground()
+        #elif back_type == 'mean':
+        #    bkg_estimator = MeanBackground()
+        #else:
+        #    bkg_estimator = SExtractorBackground()
+        #tmp = data.copy()
+        #bkg = Background2D(tmp, back_size, mask=mask_bkg, filter_size=back_filtersize,
+        #                   sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
+        #background_array = bkg.background
+        #background_rms = bkg.background_rms
+        # clean up memory
+        #del tmp, bkg, data, mask_bkg
+        #gc.collect()
+
+        # subtract the background
+        msgs.info('Subtracting 2D background')
+        sci_image = data-background_array
+
+        # CR mask
+        if mask_cr and cr_method == 'astroscrappy':
+            # C/OpenMP implementation of L.A.Cosmic (optional dependency), map our thresholds onto the
+            # astroscrappy ones and pass the measured background rms as the variance, the same noise the
+            # lacosmic branch uses. sci_image is already background subtracted, so no inbkg here.
+            try:
+                import astroscrappy
+            except ImportError:
+                msgs.error('Please install astroscrappy with: pip install astroscrappy')
+            msgs.info('Identifying cosmic rays using the L.A.Cosmic algorithm (astroscrappy)')
+            bpm_cr_tmp, _ = astroscrappy.detect_cosmics(sci_image, inmask=bpm,
+                                                        sigclip=cr_threshold, sigfrac=neighbor_threshold/cr_threshold,
+                                                        objlim=contrast, gain=1.0, invar=background_rms**2, satlevel=np.inf,
+                                                        niter=lamaxiter, sepmed=True, cleantype='medmask',
+                                                        fsmode='median', verbose=verbose)
+            bpm_cr = grow_masked(bpm_cr_tmp, grow, verbose=verbose)
+        elif mask_cr:
+            msgs.info('Identifying cosmic rays using the L.A.Cosmic algorithm')
+            bpm_cr_tmp = lacosmic(sci_image, contrast, cr_threshold, neighbor_threshold,
+                                  error=background_rms, mask=bpm, background=background_array, effective_gain=None,
+                                  readnoise=None, maxiter=lamaxiter, border_mode='mirror')
+            bpm_cr = grow_masked(bpm_cr_tmp, grow, verbose=verbose)
+            # seems not working as good as lacosmic.py
+            # grow=1.5, remove_compact_obj=True, sigfrac=0.3, objlim=5.0,
+            #bpm_cr = lacosmic_pypeit(sci_image, saturation, nonlinear, varframe=None, maxiter=maxiter, grow=grow,
+            #                  remove_compact_obj=remove_compact_obj, sigclip=sigclip, sigfrac=sigfrac, objlim=objlim)
+        else:
+            msgs.warn('Skipped cosmic ray rejection process!')
+            bpm_cr = np.zeros_like(sci_image,dtype=bool)
+
+        # satellite trail mask
+        if mask_sat:
+            msgs.info('Identifying satellite trails using the Canny algorithm following ACSTOOLS.')
+            bpm_sat = satdet(sci_image, bpm=bpm|bpm_cr, sigma=sat_sig, buf=sat_buf, order=sat_order,
+                             low_thresh=low_thresh, h_thresh=h_thresh, small_edge=small_edge,
+                             line_len=line_len, line_gap=line_gap, percentile=percentile)
+        else:
+            bpm_sat = np.zeros_like(sci_image,dtype=bool)
 
-    return sci_fits_list, wht_fits_list, flag_fits_list
+        # negative star mask
+        if mask_negative_star:
+            msgs.info('Masking negative stars with {:}'.format(maskbrightstar_method))
+            bpm_negative_tmp = mask_bright_star(0-sci_image, mask=bpm, brightstar_nsigma=brightstar_nsigma, back_nsigma=sigclip,
+                                            back_maxiters=back_maxiters, method=maskbrightstar_method, task=sextractor_task)
+            bpm_negative = grow_masked(bpm_negative_tmp, grow, verbose=verbose)
+        else:
+            bpm_negative = np.zeros_like(sci_image, dtype=bool)
+
+        # add the cosmic ray and satellite trail flag
+        flag_image_new = pack_flags((bpm_cr, bpm_sat, bpm_negative), start_bit=6,
+                                    flag=flag_image.astype('int32'))
+
+        # make a mask used for statistics.
+        # should not include starmask since they are not bad pixels if you want to use this mask for other purpose
+        mask_all = combine_masks(bpm, bpm_cr, bpm_sat, bpm_negative, starmask)
+
+        ## replace cosmic ray and satellite affected pixels?
+        # ToDo: explore the replacement algorithm, replace a bad pixel using the median of a box
+        bpm_replace = bpm_cr | bpm_sat
+        # the clipped statistics are a few passes over the whole image, skip them if there is nothing to replace
+        if replace is not None and not np.any(bpm_replace):
+            msgs.info('No bad pixels to be replaced')
+        elif replace == 'zero':
+            sci_image[bpm_replace] = 0
+        elif replace == 'median':
+            sci_image[bpm_replace] = utils.clipped_stat(sci_image, mask_all, stat='median', sigclip=sigclip, n_clip=5)
+        elif replace == 'mean':
+            sci_image[bpm_replace] = utils.clipped_stat(sci_image, mask_all, stat='mean', sigclip=sigclip, n_clip=5)
+        elif replace == 'min':
+            sci_image[bpm_replace] = np.min(sci_image, where=np.invert(mask_all), initial=np.inf)
+        elif replace == 'max':
+            sci_image[bpm_replace] = np.max(sci_image, where=np.invert(mask_all), initial=-np.inf)
+        else:
+            msgs.info('Not replacing bad pixel values')
+
+        # Generate weight map used for SExtractor and SWarp (WEIGHT_TYPE = MAP_WEIGHT)
+        # Same as utils.inverse(background_array) with bad pixel's weight set to zero. The background is not
+        # needed anymore, so its buffer is reused for the weight map.
+        gpm_wht = (background_array > 0.) & (flag_image_new == 0)
+        wht_image = np.divide(1.0, background_array, out=background_array, where=gpm_wht)
+        wht_image *= gpm_wht
+
+        # Always set original zero values to be zero, this can avoid significant negative values after sky subtraction
+        sci_image[bpm_zero] = 0
+        # Also set negative stars to be zero
+        sci_image[bpm_negative] = 0
+
+        # save images
+        save_args = (sci_fits, sci_image, wht_fits, wht_image, flag_fits, flag_image_new, header, compress)
+        if writer is None:
+            _save_sciproc_old_outputs(*save_args)
+        else:
+            writer(_save_sciproc_old_outputs, *save_args)
+
+    return sci_fits, wht_fits, flag_fits
+
+def _load_sciproc_old_inputs(ifile, flagfile):
+
+    header, data, _ = io.load_fits(ifile)
+    _, flag_image, _ = io.load_fits(flagfile)
+    data = np.ascontiguousarray(data, dtype=np.float32)
+
+    return header, data, flag_image
+
+def _save_sciproc_old_outputs(sci_fits, sci_image, wht_fits, wht_image, flag_fits, flag_image, header, compress=None):
+
+    # the three files are independent, write them concurrently. Each save gets its own
+    # header since save_fits adds the PyPhot cards to the header in place.
+    # The flag image is mostly zeros, PLIO_1 is lossless and ideal for it.
+    flag_compress = None if compress is None else 'PLIO_1'
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = [pool.submit(io.save_fits, sci_fits, sci_image, header.copy(), 'ScienceImage',
+                               overwrite=True, compress=compress),
+                   pool.submit(io.save_fits, wht_fits, wht_image, header.copy(), 'WeightImage',
+                               overwrite=True, compress=compress),
+                   pool.submit(io.save_fits, flag_fits, flag_image.astype('int32', copy=False), header.copy(),
+                               'FlagImage', overwrite=True, compress=flag_compress)]
+        for future in futures:
+            future.result()
+    msgs.info('Science image {:} saved'.format(sci_fits))
+    msgs.info('Weight image {:} saved'.format(wht_fits))
+    msgs.info('Flag image {:} saved'.format(flag_fits))
+
+def _sciproc_old_worker(work_queue, **kwargs):
+
+    """Multiprocessing worker for sciproc_old, stops at the None sentinel."""
+    for ifile, flagfile, airmass in iter(work_queue.get, None):
+        _sciproc_old_one(ifile, flagfile, airmass, **kwargs)
@@ -15,6 +15,9 @@ from pkg_resources import resource_filename
 import pyphot
 from pyphot import msgs
 
+# FITS library used by save_fits and load_fits, either 'astropy' (default) or 'fitsio'
+FITS_BACKEND = os.environ.get('PYPHOT_FITS_BACKEND', 'astropy').lower()
+
 def initialize_header(hdr=None, primary=False):
     """
     Initialize a FITS header.
@@ -54,7 +57,14 @@ def initialize_header(hdr=None, primary=False):
     # Return
     return hdr
 
-def save_fits(fitsname, data, header, img_type, mask=None, overwrite=True):
+def save_fits(fitsname, data, header, img_type, mask=None, overwrite=True, compress=None):
+    """
+    Save an image (and optionally its mask) to a FITS file.
+
+    compress can be set to a CFITSIO tile compression algorithm (e.g. 'RICE_1',
+    'GZIP_1', 'PLIO_1'), the images are then written as compressed extensions
+    after an empty primary HDU. Note that RICE_1 quantizes floating point data.
+    """
 
     if header.get('VERSPYP') is None:
         # Add some Header card
@@ -63,13 +73,23 @@ def save_fits(fitsname, data, header, img_type, mask=None, overwrite=True):
         for i in range(len(hdr)):
             header.append(hdr.cards[i])
 
-    if mask is None:
+    if FITS_BACKEND == 'fitsio':
+        _save_fits_fitsio(fitsname, data, header, mask=mask, overwrite=overwrite, compress=compress)
+    elif mask is None and compress is None:
         hdu = fits.PrimaryHDU(data, header=header)
         hdu.writeto(fitsname, overwrite=overwrite)
+    elif mask is None:
+        hdu = fits.PrimaryHDU()
+        hdu1 = fits.CompImageHDU(data, header=header, compression_type=compress)
+        fits.HDUList([hdu, hdu1]).writeto(fitsname, overwrite=overwrite)
     else:
         hdu = fits.PrimaryHDU(header=header)
-        hdu1 = fits.ImageHDU(data, header=header, name='IMAGE')
-        hdu2 = fits.ImageHDU(mask.astype('int32'), header=header, name='MASK')
+        if compress is None:
+            hdu1 = fits.ImageHDU(data, header=header, name='IMAGE')
+            hdu2 = fits.ImageHDU(mask.astype('int32'), header=header, name='MASK')
+        else:
+            hdu1 = fits.CompImageHDU(data, header=header, name='IMAGE', compression_type=compress)
+            hdu2 = fits.CompImageHDU(mask.astype('int32'), header=header, name='MASK', compression_type=compress)
         new_hdul = fits.HDUList([hdu, hdu1, hdu2])
         new_hdul.writeto(fitsname, overwrite=True)
         #mask_hdu = fits.ImageHDU(mask.astype('int32'), name='MASK')
@@ -81,16 +101,103 @@ def save_fits(fitsname, data, header, img_type, mask=None, overwrite=True):
         gc.collect()
 
 
-def load_fits(fitsname):
+def _import_fitsio():
+    try:
+        import fitsio
+    except ImportError:
+        msgs.error('Please install fitsio with: pip install fitsio, or unset PYPHOT_FITS_BACKEND')
+    return fitsio
+
+def _fitsio_records(header):
+    """Convert an astropy header into the list of records accepted by fitsio."""
+    return [{'name': card.keyword, 'value': card.value, 'comment': card.comment}
+            for card in header.cards if card.keyword not in ('', 'SIMPLE', 'XTENSION', 'BITPIX', 'EXTEND')
+            and not card.keyword.startswith('NAXIS')]
+
+def _astropy_header(fitsio_header):
+    """Convert a fitsio header back into an astropy header."""
+    hdr = fits.Header()
+    for rec in fitsio_header.records():
+        if 'card_string' in rec:
+            hdr.append(fits.Card.fromstring(rec['card_string']))
+        else:
+            hdr.append((rec['name'], rec.get('value'), rec.get('comment', '')))
+    return hdr
+
+def _save_fits_fitsio(fitsname, data, header, mask=None, overwrite=True, compress=None):
+    """save_fits through CFITSIO, producing the same HDU layout as the astropy path."""
+    fitsio = _import_fitsio()
+    records = _fitsio_records(header)
+    with fitsio.FITS(fitsname, 'rw', clobber=overwrite) as f:
+        if mask is None and compress is None:
+            f.write(data, header=records)
+        elif mask is None:
+            f.write(None)
+            f.write(data, header=records, compress=compress)
+        else:
+            f.write(None, header=records)
+            f.write(data, header=records, extname='IMAGE', compress=compress)
+            f.write(mask.astype('int32'), header=records, extname='MASK', compress=compress)
+
+def _load_fits_fitsio(fitsname):
+    """load_fits through CFITSIO, returning astropy headers like the astropy path."""
+    fitsio = _import_fitsio()
+    with fitsio.FITS(fitsname) as f:
+        head0 = _astropy_header(f[0].read_header())
+        if 'PROD_VER' in head0.keys():
+            msgs.info('Loading HST drizzled images')
+        if len(f)==1 or 'PROD_VER' in head0.keys():
+            data = f[0].read()
+            return head0, data, np.zeros(data.shape, dtype='int32')
+        elif len(f)==2 and f[1].is_compressed():
+            data = f[1].read()
+            return _astropy_header(f[1].read_header()), data, np.zeros(data.shape, dtype='int32')
+        elif len(f)==3:
+            return _astropy_header(f[1].read_header()), f[1].read(), f[2].read()
+        else:
+            msgs.error('{:} is not a PyPhot FITS Image.'.format(fitsname))
+            return None
+
+def load_fits(fitsname, memmap=False):
+    """
+    Load a PyPhot FITS image, returning the header, data and flag image.
+    Images without a flag extension get an all-zero flag image, which is allocated
+    with np.zeros so its pages are only backed by memory once they are written.
+
+    With memmap=True the arrays are copy-on-write memory maps of the file, pages are
+    only read when they are used and are shared between the processes that map the same
+    file. The file should not be overwritten while the arrays are still in use.
+    This option is ignored by the fitsio backend.
+    """
+    if FITS_BACKEND == 'fitsio':
+        return _load_fits_fitsio(fitsname)
+
+    if memmap:
+        par = fits.open(fitsname, memmap=True, mode='readonly')
+        if len(par)==3 and 'PROD_VER' not in par[0].header.keys():
+            head, data, flag = par[1].header, par[1].data, par[2].data
+        elif len(par)==2 and isinstance(par[1], fits.CompImageHDU):
+            head, data = par[1].header, par[1].data
+            flag = np.zeros(data.shape, dtype='int32')
+        else:
+            head, data = par[0].header, par[0].data
+            flag = np.zeros(data.shape, dtype='int32')
+        # the mmap stays open as long as the arrays are referenced
+        par.close()
+        return head, data, flag
+
     par = fits.open(fitsname, memmap=False)
     if 'PROD_VER' in par[0].header.keys():
         msgs.info('Loading HST drizzled images')
-        head, data, flag = par[0].header, par[0].data, np.zeros_like(par[0].data,dtype='int32')
+        head, data, flag = par[0].header, par[0].data, np.zeros(par[0].data.shape, dtype='int32')
         del par[0].data
     else:
         if len(par)==1:
-            head, data, flag = par[0].header, par[0].data, np.zeros_like(par[0].data,dtype='int32')
+            head, data, flag = par[0].header, par[0].data, np.zeros(par[0].data.shape, dtype='int32')
             del par[0].data
+        elif len(par)==2 and isinstance(par[1], fits.CompImageHDU):
+            head, data, flag = par[1].header, par[1].data, np.zeros(par[1].data.shape, dtype='int32')
+            del par[1].data
         elif len(par)==3:
             head, data, flag = par[1].header, par[1].data, par[2].data
             del par[1].data
@@ -11,6 +11,7 @@ from scipy.ndimage import gaussian_filter,median_filter
 
 import multiprocessing
 from multiprocessing import Process, Queue
+from concurrent.futures import ThreadPoolExecutor
 
 from astropy import stats
 from astropy.stats import sigma_clipped_stats
@@ -21,12 +22,27 @@ from pyphot import procimg
 from pyphot.photometry import BKG2D, mask_bright_star
 
 
+def _prefetch_rawimages(camera, rawfiles, det):
+    """
+    Yield camera.get_rawimage for each of the raw files, the next file is read
+    in a background thread while the current one is being processed.
+    """
+    if len(rawfiles) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(camera.get_rawimage, rawfiles[0], det)
+        for nextfile in list(rawfiles[1:]) + [None]:
+            rawimage = future.result()
+            if nextfile is not None:
+                future = pool.submit(camera.get_rawimage, nextfile, det)
+            yield rawimage
+
+
 def biasframe(biasfiles, camera, det, masterbias_name, cenfunc='median', stdfunc='std',
               sigma=3, maxiters=3):
 
     images = []
-    for ifile in biasfiles:
-        detector_par, raw, header, exptime, rawdatasec_img, oscansec_img = camera.get_rawimage(ifile, det)
+    for detector_par, raw, header, exptime, rawdatasec_img, oscansec_img in _prefetch_rawimages(camera, biasfiles, det):
         array = procimg.trim_frame(raw, rawdatasec_img < 0.1)
         datasec_img = procimg.trim_frame(rawdatasec_img, rawdatasec_img < 0.1)
         bias_image = utils.gain_correct(array, datasec_img, detector_par['gain'])
@@ -65,8 +81,7 @@ def darkframe(darkfiles, camera, det, masterdark_name, masterbias=None, cenfunc=
         masterbiasimg = None
 
     images = []
-    for ifile in darkfiles:
-        detector_par, raw, header, exptime, rawdatasec_img, oscansec_img = camera.get_rawimage(ifile, det)
+    for detector_par, raw, header, exptime, rawdatasec_img, oscansec_img in _prefetch_rawimages(camera, darkfiles, det):
         array = procimg.trim_frame(raw, rawdatasec_img < 0.1)
         datasec_img = procimg.trim_frame(rawdatasec_img, rawdatasec_img < 0.1)
         dark_image = utils.gain_correct(array, datasec_img, detector_par['gain'])
@@ -103,14 +118,17 @@ def combineflat(flatfiles, maskfiles=None, camera=None, det=None, masterbias=Non
                 maskbrightstar=True, brightstar_nsigma=5, maskbrightstar_method='sextractor', conv='sex',
                 sextractor_task='sex'):
 
-    if masterbias is not None:
-        _, masterbiasimg, maskbiasimg = io.load_fits(masterbias)
-    else:
-        masterbiasimg = None
-    if masterdark is not None:
-        _, masterdarkimg, maskdarkimg = io.load_fits(masterdark)
-    else:
-        masterdarkimg = None
+    # Read the bias and dark masters in the background while the bpm is built
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        fut_bias = pool.submit(io.load_fits, masterbias) if masterbias is not None else None
+        fut_dark = pool.submit(io.load_fits, masterdark) if masterdark is not None else None
+
+        if camera is not None:
+            msgs.info('Get bpm image for flatfielding')
+            bpm = camera.bpm(flatfiles[0], det, shape=None, msbias=None).astype('bool')
+
+        masterbiasimg = fut_bias.result()[1] if fut_bias is not None else None
+        masterdarkimg = fut_dark.result()[1] if fut_dark is not None else None
 
     images = []
     masks = []
@@ -118,13 +136,12 @@ def combineflat(flatfiles, maskfiles=None, camera=None, det=None, masterbias=Non
     norm = []
 
     if camera is not None:
-        msgs.info('Get bpm image for flatfielding')
-        bpm = camera.bpm(flatfiles[0], det, shape=None, msbias=None).astype('bool')
+        rawimages = _prefetch_rawimages(camera, flatfiles, det)
 
     for ii, ifile in enumerate(flatfiles):
 
         if camera is not None:
-            detector_par, raw, header, exptime, rawdatasec_img, oscansec_img = camera.get_rawimage(ifile, det)
+            detector_par, raw, header, exptime, rawdatasec_img, oscansec_img = next(rawimages)
             star_fits_file = ifile.replace('.fits', '_starmask.fits')
             array = procimg.trim_frame(raw, rawdatasec_img < 0.1)
             datasec_img = procimg.trim_frame(rawdatasec_img, rawdatasec_img < 0.1)
@@ -296,6 +313,9 @@ def superskyframe(superskyfiles, mastersupersky_name, maskfiles=None,
     #io.save_fits(mastersupersky_name.replace('.fits','1.fits'), flat, header, 'MasterSuperSky', mask=bpm, overwrite=True)
     io.save_fits(mastersupersky_name, flat, header, 'MasterSuperSky', mask=bpm, overwrite=True)
 
+    # Return the master as it was saved so that it does not need to be read back
+    return flat, bpm.astype('int32')
+
 def fringeframe(fringefiles, masterfringe_name, fringemaskfiles=None, mastersuperskyimg=None, cenfunc='median', stdfunc='std',
                 sigma=3, maxiters=3, maskbrightstar=True, brightstar_nsigma=5, maskbrightstar_method='sextractor',
                 conv='sex',sextractor_task='sex'):
@@ -354,6 +374,9 @@ def fringeframe(fringefiles, masterfringe_name, fringemaskfiles=None, mastersupe
     del data3D, mask3D
     gc.collect()
 
+    # Return the master as it was saved so that it does not need to be read back
+    return stack, bpm
+
 class MasterFrames():
     """
     Build master frames
@@ -390,40 +413,56 @@ class MasterFrames():
         else:
             self.masterpixflat_name = None
 
+    def need_build(self, existing=None):
+        """
+        Whether any of the masters used for this detector has to be (re)built.
+        existing is an optional set of the file names in master_dir, it saves a stat per master.
+        """
+        master_names = [self.masterbias_name, self.masterdark_name, self.masterillumflat_name, self.masterpixflat_name]
+        if not self.reuse_masters:
+            return any(name is not None for name in master_names)
+        if existing is None:
+            return any(name is not None and not os.path.exists(name) for name in master_names)
+        return any(name is not None and os.path.basename(name) not in existing for name in master_names)
+
     def build(self, biasfiles=None, darkfiles=None, illumflatfiles=None, pixflatfiles=None):
 
         ## Load parameters from Calibration Par
+        bias_par = self.par['calibrations']['biasframe']['process']
+        dark_par = self.par['calibrations']['darkframe']['process']
+        illum_par = self.par['calibrations']['illumflatframe']['process']
+        pixel_par = self.par['calibrations']['pixelflatframe']['process']
         # Bias
-        b_cenfunc = self.par['calibrations']['biasframe']['process']['comb_cenfunc']
-        b_stdfunc = self.par['calibrations']['biasframe']['process']['comb_stdfunc']
-        b_sigrej = self.par['calibrations']['biasframe']['process']['comb_sigrej']
-        b_maxiter = self.par['calibrations']['biasframe']['process']['comb_maxiter']
+        b_cenfunc = bias_par['comb_cenfunc']
+        b_stdfunc = bias_par['comb_stdfunc']
+        b_sigrej = bias_par['comb_sigrej']
+        b_maxiter = bias_par['comb_maxiter']
         # Dark
-        d_cenfunc = self.par['calibrations']['darkframe']['process']['comb_cenfunc']
-        d_stdfunc = self.par['calibrations']['darkframe']['process']['comb_stdfunc']
-        d_sigrej = self.par['calibrations']['darkframe']['process']['comb_sigrej']
-        d_maxiter = self.par['calibrations']['darkframe']['process']['comb_maxiter']
+        d_cenfunc = dark_par['comb_cenfunc']
+        d_stdfunc = dark_par['comb_stdfunc']
+        d_sigrej = dark_par['comb_sigrej']
+        d_maxiter = dark_par['comb_maxiter']
         # IllumFlat
-        i_cenfunc = self.par['calibrations']['illumflatframe']['process']['comb_cenfunc']
-        i_stdfunc = self.par['calibrations']['illumflatframe']['process']['comb_stdfunc']
-        i_sigrej = self.par['calibrations']['illumflatframe']['process']['comb_sigrej']
-        i_maxiter = self.par['calibrations']['illumflatframe']['process']['comb_maxiter']
-        i_window = self.par['calibrations']['illumflatframe']['process']['window_size']
-        i_maskbrigtstar = self.par['calibrations']['illumflatframe']['process']['mask_brightstar']
-        i_brightstar_nsigma = self.par['calibrations']['illumflatframe']['process']['brightstar_nsigma']
-        i_maskbrightstar_method = self.par['calibrations']['illumflatframe']['process']['brightstar_method']
-        i_conv = self.par['calibrations']['illumflatframe']['process']['conv']
+        i_cenfunc = illum_par['comb_cenfunc']
+        i_stdfunc = illum_par['comb_stdfunc']
+        i_sigrej = illum_par['comb_sigrej']
+        i_maxiter = illum_par['comb_maxiter']
+        i_window = illum_par['window_size']
+        i_maskbrigtstar = illum_par['mask_brightstar']
+        i_brightstar_nsigma = illum_par['brightstar_nsigma']
+        i_maskbrightstar_method = illum_par['brightstar_method']
+        i_conv = illum_par['conv']
         # PixelFlag
-        p_cenfunc = self.par['calibrations']['pixelflatframe']['process']['comb_cenfunc']
-        p_stdfunc = self.par['calibrations']['pixelflatframe']['process']['comb_stdfunc']
-        p_sigrej = self.par['calibrations']['pixelflatframe']['process']['comb_sigrej']
-        p_maxiter = self.par['calibrations']['pixelflatframe']['process']['comb_maxiter']
-        p_window = self.par['calibrations']['pixelflatframe']['process']['window_size']
-        p_maskbrigtstar = self.par['calibrations']['pixelflatframe']['process']['mask_brightstar']
-        p_brightstar_nsigma = self.par['calibrations']['pixelflatframe']['process']['brightstar_nsigma']
-        p_maskbrightstar_method = self.par['calibrations']['pixelflatframe']['process']['brightstar_method']
-        p_conv = self.par['calibrations']['pixelflatframe']['process']['conv']
-        maskpixvar = self.par['calibrations']['pixelflatframe']['process']['maskpixvar']
+        p_cenfunc = pixel_par['comb_cenfunc']
+        p_stdfunc = pixel_par['comb_stdfunc']
+        p_sigrej = pixel_par['comb_sigrej']
+        p_maxiter = pixel_par['comb_maxiter']
+        p_window = pixel_par['window_size']
+        p_maskbrigtstar = pixel_par['mask_brightstar']
+        p_brightstar_nsigma = pixel_par['brightstar_nsigma']
+        p_maskbrightstar_method = pixel_par['brightstar_method']
+        p_conv = pixel_par['conv']
+        maskpixvar = pixel_par['maskpixvar']
         # all
         minimum_vig = self.par['scienceframe']['process']['minimum_vig']
         sextractor_task = self.par['rdx']['sextractor']
@@ -477,52 +516,55 @@ class MasterFrames():
                                conv=p_conv, sextractor_task=sextractor_task)
 
     def load(self):
+        """
+        Load the master frames. The masters are memory mapped since they are only read,
+        and as they do not depend on each other they are read concurrently.
+        """
+
+        use_names = [(self.use_bias, self.masterbias_name), (self.use_dark, self.masterdark_name),
+                     (self.use_illum, self.masterillumflat_name), (self.use_pixel, self.masterpixflat_name)]
+        with ThreadPoolExecutor(max_workers=len(use_names)) as pool:
+            futures = [pool.submit(io.load_fits, name, memmap=True) if use else None for use, name in use_names]
+            try:
+                bias, dark, illum, pixel = [fut.result() if fut is not None else None for fut in futures]
+            except OSError:
+                msgs.error('Please build master files first!')
 
+        # masks of the calibrations in use, disabled calibrations do not flag any pixel
+        masks = []
         if self.use_bias:
-            if os.path.exists(self.masterbias_name):
-                _, masterbiasimg, maskbiasimg = io.load_fits(self.masterbias_name)
-            else:
-                msgs.error('Please build master files first!')
+            _, masterbiasimg, maskbiasimg = bias
+            masks.append(maskbiasimg)
         else:
             masterbiasimg = np.zeros(self.raw_shape)
-            maskbiasimg = np.zeros(self.raw_shape, dtype='int')
 
         if self.use_dark:
-            if os.path.exists(self.masterdark_name):
-                _, masterdarkimg, maskdarkimg = io.load_fits(self.masterdark_name)
-            else:
-                msgs.error('Please build master files first!')
+            _, masterdarkimg, maskdarkimg = dark
+            masks.append(maskdarkimg)
         else:
             masterdarkimg = np.zeros(self.raw_shape)
-            maskdarkimg = np.zeros(self.raw_shape, dtype='int')
 
         if self.use_illum:
-            if os.path.exists(self.masterillumflat_name):
-                headerillum, masterillumflatimg, maskillumflatimg = io.load_fits(self.masterillumflat_name)
-                norm_illum = headerillum['FNorm']
-            else:
-                msgs.error('Please build master files first!')
+            headerillum, masterillumflatimg, maskillumflatimg = illum
+            masks.append(maskillumflatimg)
+            norm_illum = headerillum['FNorm']
         else:
             masterillumflatimg = np.ones(self.raw_shape)
-            maskillumflatimg = np.zeros(self.raw_shape, dtype='int')
             norm_illum = 1.
 
         if self.use_pixel:
-            if os.path.exists(self.masterpixflat_name):
-                headerpixel, masterpixflatimg, maskpixflatimg = io.load_fits(self.masterpixflat_name)
-                norm_pixel= headerpixel['FNorm']
-            else:
-                msgs.error('Please build master files first!')
+            headerpixel, masterpixflatimg, maskpixflatimg = pixel
+            masks.append(maskpixflatimg)
+            norm_pixel= headerpixel['FNorm']
         else:
             masterpixflatimg = np.ones(self.raw_shape)
-            maskpixflatimg = np.zeros(self.raw_shape, dtype='int')
             norm_pixel = 1.
 
+        bpm_proc = np.zeros(self.raw_shape, dtype='bool')
         if self.par['scienceframe']['process']['mask_proc']:
-            bpm_sum = maskbiasimg + maskdarkimg + maskillumflatimg + maskpixflatimg
-            bpm_proc = bpm_sum.astype('bool')
-        else:
-            bpm_proc = np.zeros(self.raw_shape, dtype='bool')
+            # the masks are flags, so OR them in place instead of summing them
+            for mask in masks:
+                bpm_proc |= mask != 0
 
         return masterbiasimg, masterdarkimg, masterillumflatimg, masterpixflatimg, bpm_proc, norm_illum, norm_pixel
 
@@ -549,8 +591,19 @@ def build_masters(detectors, master_keys, raw_shapes, camera=None, par=None, bia
 
     '''
 
+    # Only the detectors with missing masters are dispatched, so that the processes
+    # are shared among the detectors that actually need to be built. The master directory
+    # is listed once rather than checking every master of every detector.
+    master_dir = par['calibrations']['master_dir']
+    existing = set(os.listdir(master_dir)) if os.path.isdir(master_dir) else set()
+    pending = [ii for ii in range(len(detectors)) if MasterFrames(par, camera, detectors[ii], master_keys[ii],
+                                              raw_shapes[ii], reuse_masters=reuse_masters).need_build(existing)]
+    if len(pending) == 0:
+        msgs.info('Using existing master files for all detectors')
+        return
+
     n_process = par['rdx']['n_process']
-    n_det = len(detectors)
+    n_det = len(pending)
     n_cpu = multiprocessing.cpu_count()
 
     if n_process > n_cpu:
@@ -560,7 +613,7 @@ def build_masters(detectors, master_keys, raw_shapes, camera=None, par=None, bia
         n_process = n_det
 
     if n_process == 1:
-        for ii in range(n_det):
+        for ii in pending:
             Master = MasterFrames(par, camera, detectors[ii], master_keys[ii], raw_shapes[ii],
                                   reuse_masters=reuse_masters)
             # Build MasterFrames
@@ -570,7 +623,7 @@ def build_masters(detectors, master_keys, raw_shapes, camera=None, par=None, bia
         msgs.info('Build master files with n_process={:}'.format(n_process))
         work_queue = Queue()
         processes = []
-        for ii in range(n_det):
+        for ii in pending:
             work_queue.put((detectors[ii], master_keys[ii], raw_shapes[ii]))
         # creating processes
         for w in range(n_process):
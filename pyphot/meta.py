@@ -10,8 +10,6 @@ import numpy as np
 
 from astropy import units, coordinates
 
-from IPython import embed
-
 
 def convert_radec(ra, dec):
     """
@@ -598,7 +598,7 @@ class PyPhotMetaData:
             msgs.info('Setup column already set.  Finding unique configurations.')
             uniq, indx = np.unique(self['setup'], return_index=True)
             ignore = uniq == 'None'
-            if np.sum(ignore) > 0:
+            if ignore.any():
                 msgs.warn('Ignoring {0} frames with configuration set to None.'.format(
                             np.sum(ignore)))
             self.configs = {}
@@ -996,10 +996,12 @@ class PyPhotMetaData:
         """
         if 'framebit' not in self.keys():
             msgs.error('Frame types are not set.  First run get_frame_types.')
+        # Work on the plain array rather than the table column
+        framebit = self['framebit'].data
         if ftype == 'None':
-            return self['framebit'] == 0
+            return framebit == 0
         # Select frames
-        indx = self.type_bitmask.flagged(self['framebit'], ftype)
+        indx = self.type_bitmask.flagged(framebit, ftype)
 
         if calib_ID is not None:
             # Select frames in the same calibration group
@@ -1263,10 +1265,9 @@ class PyPhotMetaData:
             sci_std_idx = np.where(np.any([self.find_frames('science'),
                                            self.find_frames('standard')], axis=0))[0]
 
-            targets = np.unique(self['target'][sci_std_idx])
-            for ii, itarget in enumerate(targets):
-                this_idx = np.intersect1d(sci_std_idx, np.where(self['target']==itarget))
-                self['coadd_id'][this_idx] = ii+1
+            # the inverse of unique numbers the targets in sorted order, starting from 1
+            _, target_idx = np.unique(np.asarray(self['target'][sci_std_idx]), return_inverse=True)
+            self['coadd_id'][sci_std_idx] = target_idx.ravel() + 1
 
     def write_sorted(self, ofile, overwrite=True, ignore=None):
         """
@@ -1013,7 +1013,8 @@ class DetectionPar(ParSet):
     def __init__(self, skip=None, detection_method=None, phot_apertures=None, detect_thresh=None, back_type=None, analysis_thresh=None,
                  back_default=None, back_size=None, back_filtersize=None, detect_minarea=None,check_type=None,
                  weight_type=None, backphoto_type=None, backphoto_thick=None, conv=None, nnw=None, delete=None, log=None,
-                 back_rms_type=None, back_nsigma=None,back_maxiters=None,fwhm=None,nlevels=None,contrast=None,morp_filter=None):
+                 back_rms_type=None, back_nsigma=None,back_maxiters=None,fwhm=None,nlevels=None,contrast=None,morp_filter=None,
+                 compress_maps=None):
 
         # Grab the parameter names and values from the function
         # arguments
@@ -1138,6 +1139,11 @@ class DetectionPar(ParSet):
         descr['morp_filter'] = 'Whether you want to use the kernel filter when measuring morphology and centroid?'\
                                'If set true, it should be similar with SExtractor. False gives a better morphology.'
 
+        defaults['compress_maps'] = False
+        dtypes['compress_maps'] = bool
+        descr['compress_maps'] = 'Write the Photutils rms and background maps as RICE_1 compressed float32 images? '\
+                                 'The compression is lossy and SExtractor can not read the compressed maps, used by Photutils only'
+
 
         # Instantiate the parameter set
         super(DetectionPar, self).__init__(list(pars.keys()),
@@ -1153,7 +1159,7 @@ class DetectionPar(ParSet):
         parkeys = ['skip','detection_method', 'phot_apertures', 'detect_thresh', 'back_type', 'back_default', 'analysis_thresh',
                    'back_size', 'back_filtersize', 'detect_minarea', 'check_type','weight_type','backphoto_type',
                    'backphoto_thick','conv','nnw', 'delete', 'log','back_rms_type','back_nsigma','back_maxiters',
-                   'fwhm','nlevels','contrast','morp_filter']
+                   'fwhm','nlevels','contrast','morp_filter','compress_maps']
 
         badkeys = numpy.array([pk not in parkeys for pk in k])
         if numpy.any(badkeys):
@@ -1958,11 +1964,12 @@ class PyPhotPar(ParSet):
                 (None) and use `merge_with` to provide a set of
                 lines to merge with the defaults to construct the full
                 parameter set.
-            merge_with (:obj:`list`, optional):
+            merge_with (:obj:`list`, :class:`ConfigObj`, optional):
                 A list of strings with lines read, or made to look like
                 they are, from a configuration file that should be
                 merged with the lines provided by `cfg_lines`, or the
-                default parameters.
+                default parameters.  An already parsed `ConfigObj`
+                is merged directly without being parsed again.
             evaluate (:obj:`bool`, optional):
                 Evaluate the values in the config object before
                 assigning them in the subsequent parameter sets.  The
@@ -1996,7 +2003,7 @@ class PyPhotPar(ParSet):
 
         # Merge in additional parameters
         if merge_with is not None:
-            cfg.merge(ConfigObj(merge_with))
+            cfg.merge(merge_with if isinstance(merge_with, ConfigObj) else ConfigObj(merge_with))
 
         # Evaluate the strings if requested
         if evaluate:
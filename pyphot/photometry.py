@@ -1,9 +1,12 @@
-import gc, os
+import gc, os, tempfile
 import numpy as np
 import numpy.ma as ma
-import random, string
+
+from scipy import ndimage
+from scipy.interpolate import RectBivariateSpline
 
 from astropy import wcs
+from astropy.wcs.utils import proj_plane_pixel_scales
 from astropy import stats
 from astropy.io import fits
 from astropy.table import Table, vstack
@@ -17,7 +20,7 @@ from photutils import detect_sources
 from photutils import deblend_sources
 #from photutils import source_properties
 from photutils.utils import calc_total_error
-from photutils import SkyCircularAperture
+from photutils import SkyCircularAperture, CircularAperture
 from photutils import aperture_photometry
 from photutils.segmentation import SourceCatalog
 
@@ -65,59 +68,106 @@ def BKG2D(data, back_size, mask=None, filter_size=(3, 3), sigclip=5, back_type='
     if bkg_estimator == 'sextractor':
         if verbose:
             msgs.info('Estimating BACKGROUND with SExtractor.')
-        letters = string.ascii_letters
-        random_letter = ''.join(random.choice(letters) for i in range(15))
-        tmp_root = 'sex_bkg_tmp_{:}_{:04d}'.format(random_letter, np.random.randint(1,9999))
-
         # perform rejections
         tmp_data = ma.masked_array(data, mask=mask, fill_value=np.nan)
         filtered_data = sigma_clip(tmp_data, sigma=sigclip, maxiters=back_maxiters, masked=True)
         tmp_data = data.copy()
         tmp_data[filtered_data.mask] = np.nan
-        par = fits.PrimaryHDU(tmp_data)
-        par.writeto('{:}.fits'.format(tmp_root),overwrite=True)
-
-        # configuration for the first SExtractor run
-        if np.size(back_size)==1:
-            back_size = [back_size, back_size]
-        sexconfig = {"CHECKIMAGE_TYPE": "BACKGROUND, BACKGROUND_RMS", "WEIGHT_TYPE": "NONE", "CATALOG_TYPE": "FITS_LDAC",
-                      "CHECKIMAGE_NAME":"{:}_bkg.fits, {:}_rms.fits".format(tmp_root,tmp_root),
-                      "DETECT_THRESH": 5, "ANALYSIS_THRESH": 5, "DETECT_MINAREA": 5,
-                      "BACK_SIZE": '{:},{:}'.format(back_size[0],back_size[1]),
-                     "BACK_FILTERSIZE":'{:},{:}'.format(filter_size[0],filter_size[1])}
-        sexparams = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'XWIN_IMAGE', 'YWIN_IMAGE', 'ERRAWIN_IMAGE', 'ERRBWIN_IMAGE',
-                      'ERRTHETAWIN_IMAGE', 'ALPHA_J2000', 'DELTA_J2000', 'ISOAREAF_IMAGE', 'ISOAREA_IMAGE', 'ELLIPTICITY',
-                      'ELONGATION', 'MAG_AUTO', 'MAGERR_AUTO', 'FLUX_AUTO', 'FLUXERR_AUTO', 'MAG_APER', 'MAGERR_APER']
-        sex.sexone('{:}.fits'.format(tmp_root), task=sextractor_task, config=sexconfig, workdir='./', params=sexparams,
-                   defaultconfig='pyphot', conv='sex', nnw=None, dual=False, delete=True, log=False, verbose=verbose)
-        bkg_map = fits.getdata("{:}_bkg.fits".format(tmp_root))
-        rms_map = fits.getdata("{:}_rms.fits".format(tmp_root))
-        if verbose:
-            msgs.info('Removing temporary files generated by SExtractor')
-        os.system('rm {:}.fits'.format(tmp_root))
-        os.system('rm {:}_bkg.fits'.format(tmp_root))
-        os.system('rm {:}_rms.fits'.format(tmp_root))
-        os.system('rm {:}_cat.fits'.format(tmp_root))
+
+        # SExtractor intermediates live in a private scratch directory (honours TMPDIR, e.g. /dev/shm)
+        # which is removed together with everything in it once the maps are read back.
+        with tempfile.TemporaryDirectory(prefix='sex_bkg_tmp_') as tmp_dir:
+            tmp_root = os.path.join(tmp_dir, 'sex_bkg_tmp')
+            par = fits.PrimaryHDU(tmp_data)
+            par.writeto('{:}.fits'.format(tmp_root),overwrite=True)
+
+            # configuration for the first SExtractor run
+            if np.size(back_size)==1:
+                back_size = [back_size, back_size]
+            sexconfig = {"CHECKIMAGE_TYPE": "BACKGROUND, BACKGROUND_RMS", "WEIGHT_TYPE": "NONE", "CATALOG_TYPE": "FITS_LDAC",
+                          "CATALOG_NAME": "{:}_cat.fits".format(tmp_root),
+                          "CHECKIMAGE_NAME":"{:}_bkg.fits, {:}_rms.fits".format(tmp_root,tmp_root),
+                          "DETECT_THRESH": 5, "ANALYSIS_THRESH": 5, "DETECT_MINAREA": 5,
+                          "BACK_SIZE": '{:},{:}'.format(back_size[0],back_size[1]),
+                         "BACK_FILTERSIZE":'{:},{:}'.format(filter_size[0],filter_size[1])}
+            sexparams = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'XWIN_IMAGE', 'YWIN_IMAGE', 'ERRAWIN_IMAGE', 'ERRBWIN_IMAGE',
+                          'ERRTHETAWIN_IMAGE', 'ALPHA_J2000', 'DELTA_J2000', 'ISOAREAF_IMAGE', 'ISOAREA_IMAGE', 'ELLIPTICITY',
+                          'ELONGATION', 'MAG_AUTO', 'MAGERR_AUTO', 'FLUX_AUTO', 'FLUXERR_AUTO', 'MAG_APER', 'MAGERR_APER']
+            sex.sexone('sex_bkg_tmp.fits', catname=sexconfig['CATALOG_NAME'], task=sextractor_task, config=sexconfig,
+                       workdir=tmp_dir, params=sexparams, defaultconfig='pyphot', conv='sex', nnw=None, dual=False,
+                       delete=True, log=False, verbose=verbose)
+            bkg_map = fits.getdata("{:}_bkg.fits".format(tmp_root))
+            rms_map = fits.getdata("{:}_rms.fits".format(tmp_root))
+            if verbose:
+                msgs.info('Removing temporary files generated by SExtractor')
         del tmp_data, filtered_data
         gc.collect()
     else:
         if verbose:
             msgs.info('Estimating {:} BACKGROUND with Photutils Background2D.'.format(back_type))
-        tmp = data.copy()
+        # Background2D works on its own copy of the data, so the input is passed directly
         Sigma_Clip = SigmaClip(sigma=sigclip, maxiters=back_maxiters)
-        bkg = Background2D(tmp, back_size, mask=mask, filter_size=filter_size, sigma_clip=Sigma_Clip,
+        bkg = Background2D(data, back_size, mask=mask, filter_size=filter_size, sigma_clip=Sigma_Clip,
                            bkg_estimator=bkg_estimator, bkgrms_estimator=bkgrms_estimator)
         bkg_map, rms_map = bkg.background, bkg.background_rms
-        bkg_map[tmp==0.] = 0.
-        del tmp, bkg
+        bkg_map[data==0.] = 0.
+        del bkg
         gc.collect()
 
     if back_type == 'GlobalMedian':
         bkg_map = np.ones_like(bkg_map) * np.nanmedian(bkg_map[np.invert(mask)])
 
+    # Background2D always works in double precision, return the maps with the precision of
+    # the input image so that single precision images do not get double sized background maps
+    if np.issubdtype(data.dtype, np.floating):
+        bkg_map = bkg_map.astype(data.dtype, copy=False)
+        rms_map = rms_map.astype(data.dtype, copy=False)
+
     return bkg_map, rms_map
 
 
+def coarse_background(data, box_size, mask=None, filter_size=(3, 3)):
+    '''
+    Cheap 2D background: median of each box_size mesh, median filtered over
+    filter_size meshes and bilinearly interpolated back to the full image.
+
+    There is no sigma clipping and no external call, so this is much faster
+    than BKG2D and is meant for rough thresholds such as vignetting masks.
+
+    Args:
+        data (2D array): image
+        box_size (int or tuple): mesh size in pixels
+        mask (2D bool array): True for pixels to be ignored
+        filter_size (tuple): median filter size in units of meshes
+
+    Returns:
+        2D array: background map with the same shape as data
+    '''
+    box_size = np.broadcast_to(box_size, 2).astype(int)
+    ny, nx = data.shape
+    nby, nbx = -(-ny // box_size[0]), -(-nx // box_size[1])
+
+    # pad with NaN to a whole number of meshes and take the median of each mesh
+    padded = np.full((nby*box_size[0], nbx*box_size[1]), np.nan, dtype=np.float32)
+    padded[:ny, :nx] = data
+    if mask is not None:
+        padded[:ny, :nx][mask] = np.nan
+    mesh = np.nanmedian(padded.reshape(nby, box_size[0], nbx, box_size[1]).transpose(0, 2, 1, 3).reshape(nby, nbx, -1),
+                        axis=2)
+    del padded
+    mesh[np.isnan(mesh)] = np.nanmedian(mesh) if np.any(np.isfinite(mesh)) else 0.
+    mesh = ndimage.median_filter(mesh, size=filter_size, mode='nearest')
+
+    if nby < 2 or nbx < 2:
+        return np.full(data.shape, np.median(mesh), dtype=np.float32)
+
+    # bilinear interpolation from the mesh centers to every pixel
+    yy = np.clip((np.arange(ny) + 0.5) / box_size[0] - 0.5, 0, nby-1)
+    xx = np.clip((np.arange(nx) + 0.5) / box_size[1] - 0.5, 0, nbx-1)
+    spline = RectBivariateSpline(np.arange(nby), np.arange(nbx), mesh, kx=1, ky=1)
+    return spline(yy, xx).astype(np.float32)
+
+
 def photutils_detect(data, wcs_info=None, rmsmap=None, bkgmap=None, mask=None,
                      effective_gain=None, nsigma=2., npixels=5, fwhm=5, zpt=0.,
                      nlevels=32, contrast=0.001, back_nsigma=3, back_maxiters=10, back_type='median', back_rms_type='std',
@@ -166,7 +216,6 @@ def photutils_detect(data, wcs_info=None, rmsmap=None, bkgmap=None, mask=None,
             bkgmap = background_array
 
     threshold = bkgmap + nsigma * rmsmap
-    error = calc_total_error(data,rmsmap, effective_gain)
 
     ## Build a Gaussian kernel
     sigma = fwhm * gaussian_fwhm_to_sigma
@@ -181,6 +230,9 @@ def photutils_detect(data, wcs_info=None, rmsmap=None, bkgmap=None, mask=None,
     if return_seg_only:
         return segm
 
+    # the error map is only needed for the source catalog, not for the segmentation
+    error = calc_total_error(data,rmsmap, effective_gain)
+
     # Source Deblending
     if verbose:
         msgs.info('Deblending with deblend_sources')
@@ -262,31 +314,29 @@ def mask_bright_star(data, mask=None, brightstar_nsigma=3, back_nsigma=3, back_m
             data_copy[mask] = np.nan # set to zero would create junk detections at the edges
         if verbose:
             msgs.info('Masking bright stars with SExtractor.')
-        letters = string.ascii_letters
-        random_letter = ''.join(random.choice(letters) for i in range(15))
-        tmp_root = 'mask_bright_star_tmp_{:}_{:04d}'.format(random_letter, np.random.randint(1,9999))
-        par = fits.PrimaryHDU(data_copy)
-        par.writeto('{:}.fits'.format(tmp_root),overwrite=True)
-        # configuration for the first SExtractor run
-        sexconfig0 = {"CHECKIMAGE_TYPE": "OBJECTS", "WEIGHT_TYPE": "NONE", "CATALOG_NAME": "dummy.cat",
-                      "CATALOG_TYPE": "FITS_LDAC",
-                      "CHECKIMAGE_NAME":"{:}_check.fits".format(tmp_root),
-                      "DETECT_THRESH": brightstar_nsigma,
-                      "ANALYSIS_THRESH": brightstar_nsigma,
-                      "DETECT_MINAREA": npixels}
-        sexparams0 = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'XWIN_IMAGE', 'YWIN_IMAGE', 'ERRAWIN_IMAGE', 'ERRBWIN_IMAGE',
-                      'ERRTHETAWIN_IMAGE', 'ALPHA_J2000', 'DELTA_J2000', 'ISOAREAF_IMAGE', 'ISOAREA_IMAGE',
-                      'ELLIPTICITY',
-                      'ELONGATION', 'MAG_AUTO', 'MAGERR_AUTO', 'FLUX_AUTO', 'FLUXERR_AUTO', 'MAG_APER', 'MAGERR_APER']
-        sex.sexone('{:}.fits'.format(tmp_root), task=task, config=sexconfig0, workdir='./', params=sexparams0,
-                   defaultconfig='pyphot', conv=conv, nnw=None, dual=False, delete=True, log=False, verbose=verbose)
-        data_check = fits.getdata("{:}_check.fits".format(tmp_root))
-        mask = data_check>0
-        if verbose:
-            msgs.info('Removing temporary files generated by SExtractor')
-        os.system('rm {:}.fits'.format(tmp_root))
-        os.system('rm {:}_check.fits'.format(tmp_root))
-        os.system('rm {:}_cat.fits'.format(tmp_root))
+        with tempfile.TemporaryDirectory(prefix='mask_bright_star_tmp_') as tmp_dir:
+            tmp_root = os.path.join(tmp_dir, 'mask_bright_star_tmp')
+            par = fits.PrimaryHDU(data_copy)
+            par.writeto('{:}.fits'.format(tmp_root),overwrite=True)
+            # configuration for the first SExtractor run
+            sexconfig0 = {"CHECKIMAGE_TYPE": "OBJECTS", "WEIGHT_TYPE": "NONE",
+                          "CATALOG_NAME": "{:}_cat.fits".format(tmp_root),
+                          "CATALOG_TYPE": "FITS_LDAC",
+                          "CHECKIMAGE_NAME":"{:}_check.fits".format(tmp_root),
+                          "DETECT_THRESH": brightstar_nsigma,
+                          "ANALYSIS_THRESH": brightstar_nsigma,
+                          "DETECT_MINAREA": npixels}
+            sexparams0 = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'XWIN_IMAGE', 'YWIN_IMAGE', 'ERRAWIN_IMAGE', 'ERRBWIN_IMAGE',
+                          'ERRTHETAWIN_IMAGE', 'ALPHA_J2000', 'DELTA_J2000', 'ISOAREAF_IMAGE', 'ISOAREA_IMAGE',
+                          'ELLIPTICITY',
+                          'ELONGATION', 'MAG_AUTO', 'MAGERR_AUTO', 'FLUX_AUTO', 'FLUXERR_AUTO', 'MAG_APER', 'MAGERR_APER']
+            sex.sexone('mask_bright_star_tmp.fits', catname=sexconfig0['CATALOG_NAME'], task=task, config=sexconfig0,
+                       workdir=tmp_dir, params=sexparams0, defaultconfig='pyphot', conv=conv, nnw=None, dual=False,
+                       delete=True, log=False, verbose=verbose)
+            data_check = fits.getdata("{:}_check.fits".format(tmp_root))
+            mask = data_check>0
+            if verbose:
+                msgs.info('Removing temporary files generated by SExtractor')
         del data_copy
         gc.collect()
 
@@ -294,7 +344,7 @@ def mask_bright_star(data, mask=None, brightstar_nsigma=3, back_nsigma=3, back_m
 
 def mag_limit(image, Nsigma=5, image_type='science', zero_point=None, phot_apertures=[1.0,2.0,3.0,4.0,5.0], Npositions=10000,
               sigclip=3, maxiters=10, back_type='median', back_size=(200,200), back_filtersize=(3, 3),
-              maskbrightstar_method='sextractor', conv='sex', brightstar_nsigma=5, sextractor_task='sex'):
+              maskbrightstar_method='sextractor', conv='sex', brightstar_nsigma=5, sextractor_task='sex', seed=123):
     '''
         Estimating limiting magnitude for a given fits image
     Args:
@@ -312,6 +362,7 @@ def mag_limit(image, Nsigma=5, image_type='science', zero_point=None, phot_apert
         maskbrightstar_method (str): Method for masking bright stars. Only used for science image_type
         brightstar_nsigma (int or float): Nsigma used for masking bright star. Only used for science image_type
         sextractor_task (str): how to call your sextractor, sex or sextractor? Only used for science image_type
+        seed (int or None): seed for drawing the random positions, None gives a different draw on each call
     Returns:
         maglims (1D numpy array): limiting magnitudes for the given apertures.
     '''
@@ -343,7 +394,7 @@ def mag_limit(image, Nsigma=5, image_type='science', zero_point=None, phot_apert
         _, rmsmap = BKG2D(data, back_size, mask=mask_bkg, filter_size=back_filtersize,
                           sigclip=sigclip, back_type=back_type, back_rms_type='std',
                           back_maxiters=maxiters, sextractor_task=sextractor_task)
-        variancemap = rmsmap**2
+        variancemap = np.square(rmsmap)
     elif image_type=='rms':
         msgs.info('Getting limiting magnitudes from RMS image {:}'.format(image))
         variancemap = data**2
@@ -357,18 +408,18 @@ def mag_limit(image, Nsigma=5, image_type='science', zero_point=None, phot_apert
         msgs.error('Only the following image_type are acceptable: science, rms, variance, invar.')
         variancemap = None
 
-    # Generate random positions
-    nx, ny = data.shape
-    xx = np.random.randint(0,nx,Npositions)
-    yy = np.random.randint(0,ny,Npositions)
-    positions = wcs_info.pixel_to_world(xx, yy)
-
-    apertures = [SkyCircularAperture(positions, r= d/2*u.arcsec) for d in phot_apertures]
-    tbl_aper = aperture_photometry(variancemap, apertures, error=None, mask=None, method='exact', wcs=wcs_info)
+    # Generate random positions, apertures are centered on pixel centers
+    ny, nx = data.shape
+    rng = np.random.default_rng(seed)
+    xx, yy = rng.integers(0, (nx, ny), size=(Npositions, 2)).T
+    pixscale = np.mean(proj_plane_pixel_scales(wcs_info)) * 3600.0
+    # non-finite pixels do not contribute to the aperture sums, as in aperture_photometry
+    variancemap = np.where(np.isfinite(variancemap), variancemap, 0.)
 
     maglims = np.zeros(len(phot_apertures))
     for ii in range(len(phot_apertures)):
-        flux = tbl_aper['aperture_sum_{:d}'.format(ii)]
+        kernel = CircularAperture((0., 0.), r=phot_apertures[ii]/2./pixscale).to_mask(method='exact').data
+        flux = _aperture_sums(variancemap, kernel, xx, yy)
         mask = np.isnan(flux) | (flux==0.)
         mean, median, stddev = stats.sigma_clipped_stats(flux, mask=mask, sigma=sigclip, maxiters=maxiters,
                                                          cenfunc='median', stdfunc='std')
@@ -377,6 +428,22 @@ def mag_limit(image, Nsigma=5, image_type='science', zero_point=None, phot_apert
 
     return maglims
 
+def _aperture_sums(image, kernel, xx, yy, chunk_size=1000):
+    '''
+    Sum image within the (odd sized) aperture weight kernel centered on each of the pixels (xx, yy).
+    Pixels outside of the image count as zero. The cutouts are gathered for chunks of positions
+    at once instead of doing photometry for each aperture.
+    '''
+    half = kernel.shape[0] // 2
+    padded = np.pad(image, half, mode='constant')
+    dy, dx = np.mgrid[0:kernel.shape[0], 0:kernel.shape[1]]
+    sums = np.zeros(len(xx))
+    for start in range(0, len(xx), chunk_size):
+        this_x, this_y = xx[start:start+chunk_size], yy[start:start+chunk_size]
+        cutouts = padded[this_y[:, None, None] + dy, this_x[:, None, None] + dx]
+        sums[start:start+chunk_size] = np.tensordot(cutouts, kernel, axes=([1, 2], [0, 1]))
+    return sums
+
 def mergecat(catalogs, outfile=None, cat_ids=None, unique_dist=1.0):
 
     ncat = np.size(catalogs)
@@ -493,6 +560,9 @@ def ForcedAperPhot(input_table, images, rmsmaps=None, flagmaps=None, phot_apertu
     ## Let's perform the forced aperture photometry on each image
     positions = SkyCoord(ra=ra, dec=dec, unit=(u.deg, u.deg))
 
+    ## Set up apertures, the sky apertures do not depend on the image so they are shared by all images
+    apertures = [SkyCircularAperture(positions, r=d/2*u.arcsec) for d in phot_apertures]
+
     ## Perform aperture photometry for your targets
     ## Loops over each images
     for ii, this_image in enumerate(images):
@@ -544,9 +614,6 @@ def ForcedAperPhot(input_table, images, rmsmaps=None, flagmaps=None, phot_apertu
         ## Get the total error, i.e. including both background noise and photon noise
         total_error = calc_total_error(data, error, gain)
 
-        ## Set up apertures
-        apertures = [SkyCircularAperture(positions, r=d/2*u.arcsec) for d in phot_apertures]
-
         ## Get the Aperture flux with exact method
         if flux_no_flagpix:
             # Exclude flagged pixels when measure the flux
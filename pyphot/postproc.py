@@ -1,6 +1,6 @@
-import os,gc
+import os,gc,re,shutil
+import queue
 import numpy as np
-import matplotlib.pyplot as plt
 
 import multiprocessing
 from multiprocessing import Process, Queue
@@ -17,11 +17,39 @@ from pyphot.query import query, ldac
 from pyphot.photometry import mask_bright_star, photutils_detect
 from pyphot.psf import  psf
 
+# trailing extension of a raw file name, the processed products replace it with _detNN_*.fits
+_FITS_SUFFIX = re.compile(r'\.fits(\.gz|\.fz)?$')
+
+# SExtractor output parameters of detect, the aperture columns are sized by the number of apertures
+_DETECT_PARAMS = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'XWIN_IMAGE', 'YWIN_IMAGE', 'ERRAWIN_IMAGE',
+                  'ERRBWIN_IMAGE', 'ERRTHETAWIN_IMAGE', 'ALPHA_J2000', 'DELTA_J2000', 'ISOAREAF_IMAGE',
+                  'ISOAREA_IMAGE', 'ELLIPTICITY', 'ELONGATION', 'MAG_AUTO', 'MAGERR_AUTO', 'FLUX_AUTO',
+                  'FLUXERR_AUTO', 'MAG_APER({n_aper})', 'MAGERR_APER({n_aper})', 'FLUX_APER({n_aper})',
+                  'FLUXERR_APER({n_aper})', 'IMAFLAGS_ISO', 'NIMAFLAGS_ISO', 'CLASS_STAR', 'FLAGS']
+
+
+def _outputs_up_to_date(outputs, inputs):
+    '''
+    Whether all the outputs exist and none of them is older than any of the inputs
+    '''
+    try:
+        oldest_output = min(os.path.getmtime(ifile) for ifile in outputs)
+        newest_input = max(os.path.getmtime(ifile) for ifile in inputs)
+    except OSError:
+        return False
+    return oldest_output >= newest_input
+
+def _remove_file(filename):
+    '''
+    Remove a scratch file if it is there, without going through a shell rm
+    '''
+    if os.path.exists(filename):
+        os.remove(filename)
 
 def coadd(scifiles, flagfiles, ivarfiles, coaddroot, pixscale, science_path, coadddir, weight_type='MAP_WEIGHT',
           rescale_weights=False, combine_type='median', clip_ampfrac=0.3, clip_sigma=4.0, blank_badpixels=False,
           subtract_back= False, back_type='AUTO', back_default=0.0, back_size=100, back_filtersize=3,
-          back_filtthresh=0.0, resampling_type='LANCZOS3', delete=True, log=True):
+          back_filtthresh=0.0, resampling_type='LANCZOS3', n_process=None, delete=True, log=True):
 
     ## configuration for the Swarp run and do the coadd with Swarp
     msgs.info('Coadding image for {:}'.format(os.path.join(coadddir,coaddroot)))
@@ -45,6 +73,9 @@ def coadd(scifiles, flagfiles, ivarfiles, coaddroot, pixscale, science_path, coa
                    "COMBINE_TYPE": combine_type.upper(),"CLIP_AMPFRAC":clip_ampfrac,"CLIP_SIGMA":clip_sigma,
                    "SUBTRACT_BACK": subtract,"BACK_TYPE":back_type,"BACK_DEFAULT":back_default,"BACK_SIZE":back_size,
                    "BACK_FILTERSIZE":back_filtersize,"BACK_FILTTHRESH":back_filtthresh, "RESAMPLING_TYPE":resampling_type}
+    if n_process is not None:
+        # otherwise SWarp takes NTHREADS from the default configuration, 0 means all the cores
+        swarpconfig["NTHREADS"] = n_process
     ## Run swarp for science image
     msgs.info('Coadding science images.')
     swarp.run_swarp(scifiles, config=swarpconfig, workdir=science_path, defaultconfig='pyphot',
@@ -73,13 +104,12 @@ def coadd(scifiles, flagfiles, ivarfiles, coaddroot, pixscale, science_path, coa
     msgs.info('Generating inverse variance image for coadded science image.')
     swarp.run_swarp(scifiles, config=swarpconfig_ivar, workdir=science_path, defaultconfig='pyphot',
                     coadddir=coadddir, coaddroot=coaddroot + '_ivar', delete=True, log=False)
-    os.system('mv {:} {:}'.format(os.path.join(coadddir, coaddroot + '_ivar.weight.fits'),
-                                  os.path.join(coadddir, coaddroot + '_ivar.fits')))
+    os.replace(os.path.join(coadddir, coaddroot + '_ivar.weight.fits'), os.path.join(coadddir, coaddroot + '_ivar.fits'))
     # delete unnecessary files
-    os.system('rm {:}'.format(ivarlist))
+    os.remove(ivarlist)
     #os.system('rm {:}'.format(os.path.join(coadddir, coaddroot + '_ivar.swarp.xml')))
     #os.system('rm {:}'.format(os.path.join(coadddir, coaddroot + '_flag.swarp.xml')))
-    os.system('rm {:}'.format(os.path.join(coadddir, coaddroot + '_flag.weight.fits')))
+    _remove_file(os.path.join(coadddir, coaddroot + '_flag.weight.fits'))
 
     # useful file names
     coadd_file = os.path.join(coadddir,coaddroot+'_sci.fits')
@@ -96,7 +126,7 @@ def detect(sci_image, outroot=None, flag_image=None, weight_image=None, bkg_imag
            effective_gain=None, pixscale=1.0, detect_thresh=2., analysis_thresh=2., detect_minarea=5, fwhm=5, nlevels=32, contrast=0.001,
            back_type='median', back_rms_type='std', back_size=(100, 100), back_filter_size=(3, 3), back_default=0.,
            backphoto_type='GLOBAL', backphoto_thick=100, weight_type='MAP_WEIGHT', check_type='BACKGROUND_RMS',
-           back_nsigma=3, back_maxiters=10, morp_filter=False,
+           back_nsigma=3, back_maxiters=10, morp_filter=False, compress_maps=False,
            defaultconfig='pyphot', dual=False, conv=None, nnw=None, delete=True, log=False,
            sextractor_task='sex', phot_apertures=[1.0,2.0,3.0,4.0,5.0]):
 
@@ -111,7 +141,9 @@ def detect(sci_image, outroot=None, flag_image=None, weight_image=None, bkg_imag
     if detection_method.lower() == 'photutils':
         # detection with photoutils
         msgs.info('Detecting sources with Photutils.')
-        header, data, _ = io.load_fits(os.path.join(workdir,sci_image))
+        # The images are only read here, so they are memory mapped rather than copied into memory,
+        # for a large coadd this saves a full copy of the image and of each of the maps.
+        header, data, _ = io.load_fits(os.path.join(workdir,sci_image), memmap=True)
         wcs_info = wcs.WCS(header)
         if effective_gain is None:
             try:
@@ -121,18 +153,18 @@ def detect(sci_image, outroot=None, flag_image=None, weight_image=None, bkg_imag
 
         # prepare mask
         if flag_image is not None:
-            _, flag, _ = io.load_fits(os.path.join(workdir,flag_image))
+            _, flag, _ = io.load_fits(os.path.join(workdir,flag_image), memmap=True)
             mask = flag > 0.
         else:
             mask = np.isinf(data) | np.isnan(data) | (data == 0.)
 
         if rms_image is not None:
-            _, rmsmap, _ = io.load_fits(os.path.join(workdir,rms_image))
+            _, rmsmap, _ = io.load_fits(os.path.join(workdir,rms_image), memmap=True)
         else:
             rmsmap = None
 
         if bkg_image is not None:
-            _, bkgmap, _ = io.load_fits(os.path.join(workdir,bkg_image))
+            _, bkgmap, _ = io.load_fits(os.path.join(workdir,bkg_image), memmap=True)
         else:
             bkgmap = None
 
@@ -145,10 +177,17 @@ def detect(sci_image, outroot=None, flag_image=None, weight_image=None, bkg_imag
                                                       morp_filter=morp_filter, phot_apertures=phot_apertures)
         ## save the table and maps
         phot_table.write(os.path.join(workdir, catname), overwrite=True)
+        # the maps are optionally written as RICE tile-compressed float32, it is lossy and SExtractor can not read them
+        if compress_maps:
+            phot_rmsmap, phot_bkgmap, map_compress = phot_rmsmap.astype('float32'), phot_bkgmap.astype('float32'), 'RICE_1'
+        else:
+            map_compress = None
         if rms_image is None:
-            io.save_fits(os.path.join(workdir, '{:}_rms.fits'.format(outroot)), phot_rmsmap, header, 'RMSMAP', overwrite=True)
+            io.save_fits(os.path.join(workdir, '{:}_rms.fits'.format(outroot)), phot_rmsmap, header, 'RMSMAP', overwrite=True,
+                         compress=map_compress)
         if bkg_image is None:
-            io.save_fits(os.path.join(workdir, '{:}_bkg.fits'.format(outroot)), phot_rmsmap, header, 'BKGMAP', overwrite=True)
+            io.save_fits(os.path.join(workdir, '{:}_bkg.fits'.format(outroot)), phot_bkgmap, header, 'BKGMAP', overwrite=True,
+                         compress=map_compress)
 
     elif detection_method.lower() == 'sextractor':
         # detection with SExtractor
@@ -169,14 +208,8 @@ def detect(sci_image, outroot=None, flag_image=None, weight_image=None, bkg_imag
             check_type='NONE'
             check_name='NONE'
         # configuration for the SExtractor run
-        det_params = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'XWIN_IMAGE', 'YWIN_IMAGE', 'ERRAWIN_IMAGE',
-                      'ERRBWIN_IMAGE', 'ERRTHETAWIN_IMAGE', 'ALPHA_J2000', 'DELTA_J2000', 'ISOAREAF_IMAGE',
-                      'ISOAREA_IMAGE', 'ELLIPTICITY', 'ELONGATION', 'MAG_AUTO', 'MAGERR_AUTO', 'FLUX_AUTO',
-                      'FLUXERR_AUTO', 'MAG_APER({:})'.format(len(phot_apertures)),
-                      'MAGERR_APER({:})'.format(len(phot_apertures)),
-                      'FLUX_APER({:})'.format(len(phot_apertures)),
-                      'FLUXERR_APER({:})'.format(len(phot_apertures)),
-                      'IMAFLAGS_ISO', 'NIMAFLAGS_ISO', 'CLASS_STAR', 'FLAGS']
+        n_aper = np.size(phot_apertures)
+        det_params = [param.format(n_aper=n_aper) for param in _DETECT_PARAMS]
         det_config = {"CATALOG_TYPE": "FITS_LDAC",
                       "MAG_ZEROPOINT": zpt,
                       "BACK_TYPE": back_type, "BACK_VALUE": back_default, "BACK_SIZE": back_size,
@@ -187,15 +220,16 @@ def detect(sci_image, outroot=None, flag_image=None, weight_image=None, bkg_imag
                       "DEBLEND_MINCONT": contrast, "CHECKIMAGE_TYPE": check_type,
                       "CHECKIMAGE_NAME": check_name,
                       "GAIN": effective_gain,
-                      "PHOT_APERTURES": np.array(phot_apertures) * utils.inverse(pixscale)}
+                      "PHOT_APERTURES": np.atleast_1d(phot_apertures) * utils.inverse(pixscale)}
         if weight_image is None and weight_type!= 'NONE':
             msgs.error('Please either provide weight_image or set weight_type to be NONE.')
         if flag_image is None:
             msgs.warn('flag_image is not given, generate a mock zero flag image')
-            flag_image = os.path.join(workdir, 'flag_tmp_{:03d}.fits'.format(np.random.randint(1, 999)))
+            flag_image = os.path.join(workdir, '{:}_flag_tmp.fits'.format(outroot))
             tmp_flag = flag_image
-            header, data, _ = io.load_fits(os.path.join(workdir, sci_image))
-            io.save_fits(flag_image, np.zeros_like(data,dtype='int32'), header, 'FLAGMAP', overwrite=True)
+            # only the header and the shape are needed, the memory map does not read the pixels
+            header, data, _ = io.load_fits(os.path.join(workdir, sci_image), memmap=True)
+            io.save_fits(flag_image, np.zeros(data.shape, dtype='int32'), header, 'FLAGMAP', overwrite=True)
         else:
             tmp_flag=None
 
@@ -206,18 +240,18 @@ def detect(sci_image, outroot=None, flag_image=None, weight_image=None, bkg_imag
 
         # delete temperary file
         if tmp_flag is not None:
-            os.system('rm {:}'.format(tmp_flag))
+            os.remove(tmp_flag)
         if 'BACKGROUND_RMS' in check_list:
             phot_rmsmap = fits.getdata(os.path.join(workdir, '{:}_rms.fits'.format(outroot)))
         elif rms_image is not None:
-            _, phot_rmsmap, _ = io.load_fits(os.path.join(workdir,rms_image))
+            _, phot_rmsmap, _ = io.load_fits(os.path.join(workdir,rms_image), memmap=True)
         else:
             phot_rmsmap = None
 
         if 'BACKGROUND' in check_list:
             phot_bkgmap = fits.getdata(os.path.join(workdir, '{:}_bkg.fits'.format(outroot)))
         elif bkg_image is not None:
-            _, phot_bkgmap, _ = io.load_fits(os.path.join(workdir,bkg_image))
+            _, phot_bkgmap, _ = io.load_fits(os.path.join(workdir,bkg_image), memmap=True)
         else:
             phot_bkgmap = None
 
@@ -232,11 +266,14 @@ def detect(sci_image, outroot=None, flag_image=None, weight_image=None, bkg_imag
 def calzpt(catalogfits, refcatalog='Panstarrs', primary='i', secondary='z', coefficients=[0.,0.,0.],
            oversize=1.0, external_flag=True, FLXSCALE=1.0, FLASCALE=1.0,
            nstar_min=10, out_refcat=None, outqaroot=None, verbose=True):
+    import matplotlib.pyplot as plt
 
     try:
         if verbose:
             msgs.info('Reading SExtractor catalog')
-        catalog = Table.read(catalogfits, 2)
+        # memory map the LDAC table, only the columns used for the selection are read in full and
+        # only the good rows of the other columns are copied out when the catalog is trimmed below
+        catalog = Table.read(catalogfits, hdu=2, memmap=True)
         # ToDo:  (catalog['NIMAFLAGS_ISO']<1) will reject most of the targets for dirty IR detector, i.e. WIRCam
         #       So, we should save another flat image that only counts for the number of bad exposures associated to the pixel
         #       and then use this number as a cut.
@@ -427,19 +464,20 @@ def _cal_chip(cat_fits, sci_fits=None, ref_fits=None, outqa_root=None, ZP=25.0,
     else:
         msgs.info('Calibrating the zero point for {:}'.format(sci_fits))
 
-    par = fits.open(sci_fits, memmap=False)
+    # only the header is needed here, the data are not read
+    header = fits.getheader(sci_fits, 0)
     ## ToDo: If we read in FLXSCALE, the zpt would change if you run this code twice
     ##  Maybe just give the input of 1.0/EXPTIME and measure the FLXSCALE use calzpt?
     ##  Thus that the ZPT won't change no matter how many times you run the code.
     try:
-        FLXSCALE = 1.0 * utils.inverse(par[0].header['EXPTIME'])
+        FLXSCALE = 1.0 * utils.inverse(header['EXPTIME'])
         #FLXSCALE = par[0].header['FLXSCALE']
     except:
         if verbose:
             msgs.warn('EXPTIME was not found in the FITS Image Header, assuming the image unit is counts/sec.')
         FLXSCALE = 1.0
     try:
-        FLASCALE = par[0].header['FLASCALE']
+        FLASCALE = header['FLASCALE']
     except:
         if verbose:
             msgs.warn('FLASCALE was not found in the FITS Image Header.')
@@ -472,14 +510,14 @@ def _cal_chip(cat_fits, sci_fits=None, ref_fits=None, outqa_root=None, ZP=25.0,
         fwhm, _, _,_ = psf.buildPSF(star_table, sci_fits, size=51, sigclip=5, maxiters=10, norm_radius=2.5,
                                pixscale=pixscale, cenfunc='median', outroot=outqa_root, verbose=verbose)
 
-        # Save the important parameters
-        par[0].header['FLXSCALE'] = FLXSCALE
-        par[0].header['FLASCALE'] = FLASCALE
-        par[0].header['ZP'] = (zp_this, 'Zero point measured from stars')
-        par[0].header['ZP_STD'] = (zp_this_std, 'The standard deviration of ZP')
-        par[0].header['ZP_NSTAR'] = (nstar, 'The number of stars used for ZP and FWHM')
-        par[0].header['FWHM'] = (fwhm, 'FWHM in units of arcsec measured from stars')
-        par.writeto(sci_fits, overwrite=True)
+        # Save the important parameters, updating the header in place rather than rewriting the image
+        with fits.open(sci_fits, mode='update') as par:
+            par[0].header['FLXSCALE'] = FLXSCALE
+            par[0].header['FLASCALE'] = FLASCALE
+            par[0].header['ZP'] = (zp_this, 'Zero point measured from stars')
+            par[0].header['ZP_STD'] = (zp_this_std, 'The standard deviration of ZP')
+            par[0].header['ZP_NSTAR'] = (nstar, 'The number of stars used for ZP and FWHM')
+            par[0].header['FWHM'] = (fwhm, 'FWHM in units of arcsec measured from stars')
     else:
         msgs.warn('The number of stars found for calibration is smaller than nstar_min. skipping the ZPT calibrations.')
         fwhm = 0
@@ -549,6 +587,9 @@ def cal_chips(cat_fits_list, sci_fits_list=None, ref_fits_list=None, outqa_root_
 
         for ii in range(n_file):
             work_queue.put((ii, cat_fits_list[ii], sci_fits_list[ii], ref_fits_list[ii], outqa_root_list[ii]))
+        # one sentinel per worker, checking work_queue.empty() before get() is racy between workers
+        for w in range(n_process):
+            work_queue.put(None)
 
         # creating processes
         for w in range(n_process):
@@ -559,28 +600,45 @@ def cal_chips(cat_fits_list, sci_fits_list=None, ref_fits_list=None, outqa_root_
             processes.append(p)
             p.start()
 
+        # collect the results before joining, a worker only exits once its results have been read
+        # from the queue, so joining first can hang when there are many chips
+        results = []
+        while len(results) < n_file:
+            try:
+                results.append(done_queue.get(timeout=1))
+            except queue.Empty:
+                if not any(p.is_alive() for p in processes):
+                    break
+        # a worker can put its last result and exit between the timeout and the is_alive check
+        while len(results) < n_file:
+            try:
+                results.append(done_queue.get_nowait())
+            except queue.Empty:
+                break
+
         # completing process
         for p in processes:
             p.join()
+        if any(p.exitcode != 0 for p in processes) or len(results) != n_file:
+            msgs.error('Photometric calibration failed, got results for {:} of the {:} chips.'.format(len(results), n_file))
 
         # print the output
-        ii = 0
-        while not done_queue.empty():
-            idx_this, sci_fits_this, zp_this, zp_this_std, nstar, fwhm = done_queue.get()
+        for ii, result in enumerate(results):
+            idx_this, sci_fits_this, zp_this, zp_this_std, nstar, fwhm = result
             idx_all[ii] = idx_this
             sci_fits_all[ii] = sci_fits_this
             zp_all[ii] = zp_this
             zp_std_all[ii] = zp_this_std
             nstar_all[ii] = nstar
             fwhm_all[ii] = fwhm
-            ii +=1
 
     # sort the data based on input. This is necessary for multiproccessing at least. I do this for both way just in case.
-    zp_all_sort = zp_all[np.argsort(idx_all)]
-    zp_std_all_sort = zp_std_all[np.argsort(idx_all)]
-    nstar_all_sort = nstar_all[np.argsort(idx_all)]
-    fwhm_all_sort = fwhm_all[np.argsort(idx_all)]
-    sci_fits_all_sort = sci_fits_all[np.argsort(idx_all)]
+    sort_idx = np.argsort(idx_all)
+    zp_all_sort = zp_all[sort_idx]
+    zp_std_all_sort = zp_std_all[sort_idx]
+    nstar_all_sort = nstar_all[sort_idx]
+    fwhm_all_sort = fwhm_all[sort_idx]
+    sci_fits_all_sort = sci_fits_all[sort_idx]
 
     '''
     zp_all_sort, zp_std_all_sort = np.zeros(n_file), np.zeros(n_file)
@@ -602,9 +660,8 @@ def cal_chips(cat_fits_list, sci_fits_list=None, ref_fits_list=None, outqa_root_
 def _cal_chip_worker(work_queue, done_queue, ZP=25.0, external_flag=True, refcatalog='Panstarrs',
                      primary='i', secondary='z', coefficients=[0.,0.,0.], nstar_min=10, pixscale=None, verbose=False):
 
-    """Multiprocessing worker for cal_chips."""
-    while not work_queue.empty():
-        idx, cat_fits, sci_fits, ref_fits, outqa_root = work_queue.get()
+    """Multiprocessing worker for cal_chips, it runs until it gets the None sentinel."""
+    for idx, cat_fits, sci_fits, ref_fits, outqa_root in iter(work_queue.get, None):
         zp_this, zp_this_std, nstar, fwhm = _cal_chip(cat_fits, sci_fits=sci_fits, ref_fits=ref_fits, outqa_root=outqa_root,
                 ZP=ZP, external_flag=external_flag, refcatalog=refcatalog, primary=primary, secondary=secondary,
                 coefficients=coefficients, nstar_min=nstar_min, pixscale=pixscale, verbose=verbose)
@@ -613,6 +670,15 @@ def _cal_chip_worker(work_queue, done_queue, ZP=25.0, external_flag=True, refcat
 
 
 
+def _postproc_group_worker(work_queue, post, method, n_process=1):
+
+    """Multiprocessing worker for PostProc methods that run on a single coadd group, stops at the None sentinel."""
+    # the n_process budget left for the tools run on each group, set on this worker's copy of post
+    post.n_process = n_process
+    for igroup in iter(work_queue.get, None):
+        getattr(post, method)(igroup)
+
+
 class PostProc():
 
     def __init__(self, par, detectors, setup_id, scifiles, coadd_ids, sci_ra, sci_dec, sci_airmass, sci_exptime,
@@ -838,22 +904,36 @@ class PostProc():
         self.master_phoref_cats = []  # reference catalog for photometric calibrations
         self.outqa_list = []  # for ploting resampled images
 
-        ## Coadd root names
+        ## Coadd root names, the target and filter of each group are taken from its first exposure
+        self.coadd_groups, first_indx = np.unique(self.coadd_ids.data, return_index=True)
         self.coadd_root_ids = []
         self.coadd_root_names = []
-        groups = np.unique(self.coadd_ids.data)
-        for igroup in groups:
-            this_target = self.sci_target[self.coadd_ids==igroup][0]
-            this_filter = self.sci_filter[self.coadd_ids==igroup][0]
-            this_coadd_root = '{:}_{:}_coadd_ID{:03d}'.format(this_target, this_filter, igroup)
+        for igroup, ifirst in zip(self.coadd_groups, first_indx):
+            this_coadd_root = '{:}_{:}_coadd_ID{:03d}'.format(self.sci_target[ifirst], self.sci_filter[ifirst], igroup)
             self.coadd_root_ids.append(igroup)
             self.coadd_root_names.append(this_coadd_root)
+        self.coadd_root_dict = dict(zip(self.coadd_root_ids, self.coadd_root_names))
+
+        ## The reference catalogs only depend on the coadd_id of each exposure, so their names are
+        ## built once per exposure rather than once per exposure and detector
+        master_dir = self.par['calibrations']['master_dir']
+        skip_astrometry = self.par['rdx']['skip_astrometry']
+        astref_cats = [os.path.join(master_dir, 'MasterAstRefCat_{:}_{:}_ID{:03d}.fits'.format(
+                       self.astref_catalog, self.setup_id, icoadd)) for icoadd in self.coadd_ids]
+        phoref_cats = [os.path.join(master_dir, 'MasterPhoRefCat_{:}_{:}_ID{:03d}.fits'.format(
+                       self.photref_catalog, self.setup_id, icoadd)) for icoadd in self.coadd_ids]
+        # the resampled images that already exist, listed once instead of a stat per exposure and detector
+        if skip_astrometry and os.path.isdir(self.science_path):
+            existing = set(os.listdir(self.science_path))
+        else:
+            existing = set()
 
         if self.mosaic:
             # Prepare list for mosaic mode
             for ii, ifile in enumerate(self.scifiles):
                 # Save MEF files
                 rootname = os.path.join(self.science_path, os.path.basename(ifile))
+                stem = os.path.join(self.science_path, _FITS_SUFFIX.sub('', os.path.basename(ifile)))
                 sci_proc_file = io.build_mef(rootname, self.detectors, img_type='SCI', returnname_only=True)
                 ivar_proc_file = io.build_mef(rootname, self.detectors, img_type='IVAR', returnname_only=True)
                 wht_proc_file = io.build_mef(rootname, self.detectors, img_type='WEIGHT', returnname_only=True)
@@ -864,19 +944,21 @@ class PostProc():
                 self.flag_proc_list.append(flag_proc_file)
                 self.cat_proc_list.append(sci_proc_file.replace('.fits','_cat.fits'))
                 self.proc_coadd_ids.append(self.coadd_ids[ii])
+                this_astcat, this_phocat = astref_cats[ii], phoref_cats[ii]
                 for jj, idet in enumerate(self.detectors):
                     sci_resample_file = sci_proc_file.replace('.fits', '.{:04d}.resamp.fits'.format(jj+1))
                     wht_resample_file = sci_proc_file.replace('.fits', '.{:04d}.resamp.weight.fits'.format(jj+1))
                     ivar_resample_file = sci_proc_file.replace('.fits', '.ivar.{:04d}.resamp.fits'.format(jj+1))
                     flag_resample_file = sci_proc_file.replace('sci.fits', 'flag.{:04d}.resamp.fits'.format(jj+1))
                     cat_resample_file = sci_proc_file.replace('.fits', '.{:04d}.resamp_cat.fits'.format(jj+1))
-                    if (self.par['rdx']['skip_astrometry']) and not (os.path.exists(sci_resample_file)):
-                        self.sci_resample_list.append(rootname.replace('.fits', '_det{:02d}_sci.fits'.format(idet)))
-                        self.ivar_resample_list.append(rootname.replace('.fits', '_det{:02d}_sci.ivar.fits'.format(idet)))
-                        self.wht_resample_list.append(rootname.replace('.fits', '_det{:02d}_sci.weight.fits'.format(idet)))
-                        self.flag_resample_list.append(rootname.replace('.fits', '_det{:02d}_flag.fits'.format(idet)))
-                        self.cat_resample_list.append(rootname.replace('.fits', '_det{:02d}_sci_cat.fits'.format(idet)))
-                        this_qa = os.path.basename(rootname.replace('.fits', '_det{:02d}_sci.fits'.format(idet))).replace('.fits', '')
+                    if skip_astrometry and os.path.basename(sci_resample_file) not in existing:
+                        det_stem = stem + '_det{:02d}_'.format(idet)
+                        self.sci_resample_list.append(det_stem + 'sci.fits')
+                        self.ivar_resample_list.append(det_stem + 'sci.ivar.fits')
+                        self.wht_resample_list.append(det_stem + 'sci.weight.fits')
+                        self.flag_resample_list.append(det_stem + 'flag.fits')
+                        self.cat_resample_list.append(det_stem + 'sci_cat.fits')
+                        this_qa = os.path.basename(det_stem + 'sci')
                     else:
                         self.sci_resample_list.append(sci_resample_file)
                         self.wht_resample_list.append(wht_resample_file)
@@ -885,37 +967,36 @@ class PostProc():
                         self.cat_resample_list.append(cat_resample_file)
                         this_qa = os.path.basename(sci_resample_file).replace('.fits', '')
                     self.outqa_list.append(os.path.join(self.qa_path, this_qa))
-                    this_astcat = 'MasterAstRefCat_{:}_{:}_ID{:03d}.fits'.format(self.astref_catalog, self.setup_id,
-                                                                                  self.coadd_ids[ii])
-                    this_phocat = 'MasterPhoRefCat_{:}_{:}_ID{:03d}.fits'.format(self.photref_catalog, self.setup_id,
-                                                                                  self.coadd_ids[ii])
-                    self.master_astref_cats.append(os.path.join(self.par['calibrations']['master_dir'], this_astcat))
-                    self.master_phoref_cats.append(os.path.join(self.par['calibrations']['master_dir'], this_phocat))
+                    self.master_astref_cats.append(this_astcat)
+                    self.master_phoref_cats.append(this_phocat)
                     self.resamp_coadd_ids.append(self.coadd_ids[ii])
                     self.resamp_det_ids.append(idet)
         else:
             # Prepare list for non-mosaic mode
+            det_tags = ['_det{:02d}_'.format(idet) for idet in self.detectors]
             for ii, ifile in enumerate(self.scifiles):
-                rootname = os.path.join(self.science_path, os.path.basename(ifile))
-                for idet in self.detectors:
-                    sci_proc_file = rootname.replace('.fits', '_det{:02d}_sci.fits'.format(idet))
-                    ivar_proc_file = rootname.replace('.fits', '_det{:02d}_sci.ivar.fits'.format(idet))
-                    wht_proc_file = rootname.replace('.fits', '_det{:02d}_sci.weight.fits'.format(idet))
-                    flag_proc_file = rootname.replace('.fits', '_det{:02d}_flag.fits'.format(idet))
-                    cat_proc_file = rootname.replace('.fits', '_det{:02d}_sci_cat.fits'.format(idet))
+                stem = os.path.join(self.science_path, _FITS_SUFFIX.sub('', os.path.basename(ifile)))
+                this_astcat, this_phocat = astref_cats[ii], phoref_cats[ii]
+                for idet, det_tag in zip(self.detectors, det_tags):
+                    det_stem = stem + det_tag
+                    sci_proc_file = det_stem + 'sci.fits'
+                    ivar_proc_file = det_stem + 'sci.ivar.fits'
+                    wht_proc_file = det_stem + 'sci.weight.fits'
+                    flag_proc_file = det_stem + 'flag.fits'
+                    cat_proc_file = det_stem + 'sci_cat.fits'
                     self.sci_proc_list.append(sci_proc_file)
                     self.ivar_proc_list.append(ivar_proc_file)
                     self.wht_proc_list.append(wht_proc_file)
                     self.flag_proc_list.append(flag_proc_file)
                     self.cat_proc_list.append(cat_proc_file)
 
-                    sci_resample_file = rootname.replace('.fits', '_det{:02d}_sci.resamp.fits'.format(idet))
-                    ivar_resample_file = rootname.replace('.fits', '_det{:02d}_sci.ivar.resamp.fits'.format(idet))
-                    wht_resample_file = rootname.replace('.fits', '_det{:02d}_sci.resamp.weight.fits'.format(idet))
-                    flag_resample_file = rootname.replace('.fits', '_det{:02d}_flag.resamp.fits'.format(idet))
-                    cat_resample_file = rootname.replace('.fits', '_det{:02d}_sci.resamp_cat.fits'.format(idet))
+                    sci_resample_file = det_stem + 'sci.resamp.fits'
+                    ivar_resample_file = det_stem + 'sci.ivar.resamp.fits'
+                    wht_resample_file = det_stem + 'sci.resamp.weight.fits'
+                    flag_resample_file = det_stem + 'flag.resamp.fits'
+                    cat_resample_file = det_stem + 'sci.resamp_cat.fits'
 
-                    if (self.par['rdx']['skip_astrometry']) and not (os.path.exists(sci_resample_file)):
+                    if skip_astrometry and os.path.basename(sci_resample_file) not in existing:
                         self.sci_resample_list.append(sci_proc_file)
                         self.ivar_resample_list.append(ivar_proc_file)
                         self.wht_resample_list.append(wht_proc_file)
@@ -931,12 +1012,8 @@ class PostProc():
                         this_qa = os.path.basename(sci_resample_file).replace('.fits', '')
 
                     self.outqa_list.append(os.path.join(self.qa_path, this_qa))
-                    this_astcat = 'MasterAstRefCat_{:}_{:}_ID{:03d}.fits'.format(self.astref_catalog, self.setup_id,
-                                                                                  self.coadd_ids[ii])
-                    this_phocat = 'MasterPhoRefCat_{:}_{:}_ID{:03d}.fits'.format(self.photref_catalog, self.setup_id,
-                                                                                  self.coadd_ids[ii])
-                    self.master_astref_cats.append(os.path.join(self.par['calibrations']['master_dir'], this_astcat))
-                    self.master_phoref_cats.append(os.path.join(self.par['calibrations']['master_dir'], this_phocat))
+                    self.master_astref_cats.append(this_astcat)
+                    self.master_phoref_cats.append(this_phocat)
                     self.proc_coadd_ids.append(self.coadd_ids[ii])
                     self.resamp_coadd_ids.append(self.coadd_ids[ii])
                     self.resamp_det_ids.append(idet)
@@ -1003,8 +1080,8 @@ class PostProc():
                 #del par[0].data
                 #par.close()
                 #gc.collect()
-                os.system('rm {:}'.format(flag_fits.replace('.fits', '.weight.fits')))
-                os.system('rm {:}'.format(ivar_proc_list[ii].replace('.fits', '.weight.fits')))
+                _remove_file(flag_fits.replace('.fits', '.weight.fits'))
+                _remove_file(ivar_proc_list[ii].replace('.fits', '.weight.fits'))
 
         if self.mosaic:
             msgs.info('Build MEF format fits files')
@@ -1041,10 +1118,10 @@ class PostProc():
         ## Step two: run scamp on extracted catalog
         #ToDo: The scamp part need to be grouped if use SCAMP non-supported reference catalogs.
         #ToDo: Group them by calibID?
-        groups = np.unique(self.coadd_ids.data)
+        groups = self.coadd_groups
         for igroup in groups:
-            this_group = self.proc_coadd_ids == igroup
-            this_cat_proc_list = np.array(self.cat_proc_list)[this_group].tolist()
+            this_group = np.flatnonzero(self.proc_coadd_ids == igroup)
+            this_cat_proc_list = [self.cat_proc_list[ii] for ii in this_group]
 
             if self.astref_catalog in self.pyphot_supported_cat:
                 self.scampconfig['ASTREFCAT_NAME'] = self.get_astref_cat(igroup)
@@ -1058,15 +1135,14 @@ class PostProc():
                                 log=self.log, verbose=self.verbose)
                 # Copy .head to .ahead
                 for ii, icat in enumerate(this_cat_proc_list):
-                    os.system('mv {:} {:}'.format(icat.replace('.fits', '.head'),
-                                                  icat.replace('.fits', '.ahead')))
+                    os.replace(icat.replace('.fits', '.head'), icat.replace('.fits', '.ahead'))
                 msgs.info('Running SCAMP for the second loop with {:} mode.'.format(self.scampconfig['MOSAIC_TYPE']))
                 scamp.run_scamp(this_cat_proc_list, config=self.scampconfig, workdir=self.science_path, QAdir=self.qa_path,
                                 n_process=self.n_process, defaultconfig='pyphot', group=self.group, delete=self.delete,
                                 log=self.log, verbose=self.verbose)
                 for ii, icat in enumerate(this_cat_proc_list):
                     # remove .ahead
-                    os.system('rm {:}'.format(icat.replace('.fits', '.ahead')))
+                    _remove_file(icat.replace('.fits', '.ahead'))
             else:
                 msgs.info('Running SCAMP to solve the astronometric solutions.')
                 scamp.run_scamp(this_cat_proc_list, config=self.scampconfig, workdir=self.science_path, QAdir=self.qa_path,
@@ -1086,8 +1162,7 @@ class PostProc():
         msgs.info('Running Swarp to resample flag images.')
         # copy the .head for flag images
         for ii, icat in enumerate(self.cat_proc_list):
-            os.system('cp {:} {:}'.format(icat.replace('.fits', '.head'),
-                                          self.flag_proc_list[ii].replace('.fits', '_cat.head')))
+            shutil.copyfile(icat.replace('.fits', '.head'), self.flag_proc_list[ii].replace('.fits', '_cat.head'))
         swarp.run_swarp(self.flag_proc_list, config=self.swarpconfig_flag, workdir=self.science_path, defaultconfig='pyphot',
                         n_process=self.n_process, delete=self.delete, log=False, verbose=False)
 
@@ -1095,33 +1170,31 @@ class PostProc():
         msgs.info('Running Swarp to resample flag images.')
         # copy the .head for flag images
         for ii, icat in enumerate(self.cat_proc_list):
-            os.system('cp {:} {:}'.format(icat.replace('.fits', '.head'),
-                                          self.ivar_proc_list[ii].replace('.fits', '_cat.head')))
+            shutil.copyfile(icat.replace('.fits', '.head'), self.ivar_proc_list[ii].replace('.fits', '_cat.head'))
         swarp.run_swarp(self.ivar_proc_list, config=self.swarpconfig_ivar, workdir=self.science_path, defaultconfig='pyphot',
                         n_process=self.n_process, delete=self.delete, log=False, verbose=False)
 
         # remove useless data and change flag image type
         msgs.info('Cleaning up temporary files.')
         for ii, flag_fits in enumerate(self.flag_resample_list):
-            par = fits.open(flag_fits, memmap=False)
             # Force the exptime=1 and FLXSCALE=1 (FLXSCALE was generated from the scamp run and will be used by Swarp later on)
-            # in order to get the correct flag when doing the coadd with swarp in the later step
-            par[0].header['EXPTIME'] = 1.0
-            par[0].header['FLXSCALE'] = 1.0
-            par[0].header['FLASCALE'] = 1.0
-            par[0].data = par[0].data.astype('int32')
-            par[0].writeto(flag_fits, overwrite=True)
-            del par[0].data
-            par.close()
+            # in order to get the correct flag when doing the coadd with swarp in the later step.
+            # The file is updated in place, the image is only rewritten when it is not int32 yet.
+            with fits.open(flag_fits, mode='update', memmap=False) as par:
+                par[0].header['EXPTIME'] = 1.0
+                par[0].header['FLXSCALE'] = 1.0
+                par[0].header['FLASCALE'] = 1.0
+                if par[0].header['BITPIX'] != 32 or 'BZERO' in par[0].header:
+                    par[0].data = par[0].data.astype('int32')
             gc.collect()
             # remove weight map for flag and ivar
-            os.system('rm {:}'.format(self.flag_resample_list[ii].replace('.fits', '.weight.fits')))
-            os.system('rm {:}'.format(self.ivar_resample_list[ii].replace('.fits', '.weight.fits')))
+            _remove_file(self.flag_resample_list[ii].replace('.fits', '.weight.fits'))
+            _remove_file(self.ivar_resample_list[ii].replace('.fits', '.weight.fits'))
         for ii, sci_fits in enumerate(self.sci_proc_list): # not that for mosaic, sci_proc_list has different size with sci_resample_list
             # remove _cat.head
-            os.system('rm {:}'.format(self.sci_proc_list[ii].replace('.fits', '_cat.head')))
-            os.system('rm {:}'.format(self.flag_proc_list[ii].replace('.fits', '_cat.head')))
-            os.system('rm {:}'.format(self.ivar_proc_list[ii].replace('.fits', '_cat.head')))
+            _remove_file(self.sci_proc_list[ii].replace('.fits', '_cat.head'))
+            _remove_file(self.flag_proc_list[ii].replace('.fits', '_cat.head'))
+            _remove_file(self.ivar_proc_list[ii].replace('.fits', '_cat.head'))
 
         ## Step four: run SExtractor on resampled sciproc images
         msgs.info('Running SExtractor for the second pass to extract catalog from resampled images.')
@@ -1137,7 +1210,7 @@ class PostProc():
 
         '''
         # Prepare reference catalogs
-        groups = np.unique(self.coadd_ids.data)
+        groups = self.coadd_groups
         for igroup in groups:
             _ = self.get_phoref_cat(igroup)
 
@@ -1201,74 +1274,91 @@ class PostProc():
         if self.par['postproc']['coadd']['pixscale'] is not None:
             self.pixscale = self.par['postproc']['coadd']['pixscale'] # Update pixscale
 
-        # Coadd by group
-        groups = np.unique(self.coadd_ids.data)
-        for igroup in groups:
-            this_group = self.resamp_coadd_ids == igroup
-            this_sci_list = np.array(self.sci_resample_list)[this_group].tolist()
-            this_flag_list = np.array(self.flag_resample_list)[this_group].tolist()
-            this_ivar_list = np.array(self.ivar_resample_list)[this_group].tolist()
-            #this_target = self.sci_target[self.coadd_ids==igroup][0]
-            #this_filter = self.sci_filter[self.coadd_ids==igroup][0]
-            #this_coadd_root = '{:}_{:}_coadd_ID{:03d}'.format(this_target, this_filter, igroup)
-            this_coadd_root = self.coadd_root_names[np.where(np.array(self.coadd_root_ids)==igroup)[0][0]]
-            this_photref_cat = np.array(self.master_phoref_cats)[this_group].tolist()[0]
-
-            # run it
-            coadd_file, coadd_wht_file, coadd_flag_file, coadd_ivar_file = coadd(this_sci_list, this_flag_list, this_ivar_list, this_coadd_root,
-                                                        self.pixscale, self.science_path, self.coadd_path,
-                                                        weight_type=self.par['postproc']['coadd']['weight_type'],
-                                                        rescale_weights=self.par['postproc']['coadd']['rescale_weights'],
-                                                        combine_type=self.par['postproc']['coadd']['combine_type'],
-                                                        clip_ampfrac=self.par['postproc']['coadd']['clip_ampfrac'],
-                                                        clip_sigma=self.par['postproc']['coadd']['clip_sigma'],
-                                                        blank_badpixels=self.par['postproc']['coadd']['blank_badpixels'],
-                                                        subtract_back=self.par['postproc']['coadd']['subtract_back'],
-                                                        back_type=self.par['postproc']['coadd']['back_type'],
-                                                        back_default=self.par['postproc']['coadd']['back_default'],
-                                                        back_size=self.par['postproc']['coadd']['back_size'],
-                                                        back_filtersize=self.par['postproc']['coadd']['back_filtersize'],
-                                                        back_filtthresh=self.par['postproc']['coadd']['back_filtthresh'],
-                                                        resampling_type=self.par['postproc']['coadd']['resampling_type'],
-                                                        delete=self.par['postproc']['coadd']['delete'],
-                                                        log=self.par['postproc']['coadd']['log'])
-
-            # Extract a catalog for zero point calibration.
+        # Coadd by group, the groups are independent and run in parallel
+        groups = self.coadd_groups
+        self._run_by_group('_coadd_group', groups)
+
+    def _coadd_group(self, igroup):
+        '''
+        Coadd images and calibrate the zeropoint for a single coadd_id
+        '''
+        # index the path lists directly rather than converting the full lists to arrays
+        this_group = np.flatnonzero(self.resamp_coadd_ids == igroup)
+        this_sci_list = [self.sci_resample_list[ii] for ii in this_group]
+        this_flag_list = [self.flag_resample_list[ii] for ii in this_group]
+        this_ivar_list = [self.ivar_resample_list[ii] for ii in this_group]
+        #this_target = self.sci_target[self.coadd_ids==igroup][0]
+        #this_filter = self.sci_filter[self.coadd_ids==igroup][0]
+        #this_coadd_root = '{:}_{:}_coadd_ID{:03d}'.format(this_target, this_filter, igroup)
+        this_coadd_root = self.coadd_root_dict[igroup]
+        this_photref_cat = self.master_phoref_cats[this_group[0]]
+        coadd_par = self.par['postproc']['coadd']
+
+        # A coadd that is newer than all of its inputs and already has its zero point was
+        # finished by a previous run, so it is reused unless overwrite is requested
+        coadd_outputs = [os.path.join(self.coadd_path, this_coadd_root + suffix) for suffix in
+                         ['_sci.fits', '_sci.weight.fits', '_flag.fits', '_ivar.fits']]
+        if not self.overwrite and _outputs_up_to_date(coadd_outputs, this_sci_list + this_flag_list + this_ivar_list) \
+                and 'ZP' in fits.getheader(coadd_outputs[0]):
+            msgs.info('The coadded image {:} is up to date, skipping...'.format(coadd_outputs[0]))
+            return
+
+        # run it
+        coadd_file, coadd_wht_file, coadd_flag_file, coadd_ivar_file = coadd(this_sci_list, this_flag_list, this_ivar_list, this_coadd_root,
+                                                    self.pixscale, self.science_path, self.coadd_path,
+                                                    weight_type=coadd_par['weight_type'],
+                                                    rescale_weights=coadd_par['rescale_weights'],
+                                                    combine_type=coadd_par['combine_type'],
+                                                    clip_ampfrac=coadd_par['clip_ampfrac'],
+                                                    clip_sigma=coadd_par['clip_sigma'],
+                                                    blank_badpixels=coadd_par['blank_badpixels'],
+                                                    subtract_back=coadd_par['subtract_back'],
+                                                    back_type=coadd_par['back_type'],
+                                                    back_default=coadd_par['back_default'],
+                                                    back_size=coadd_par['back_size'],
+                                                    back_filtersize=coadd_par['back_filtersize'],
+                                                    back_filtthresh=coadd_par['back_filtthresh'],
+                                                    resampling_type=coadd_par['resampling_type'],
+                                                    n_process=self.n_process,
+                                                    delete=coadd_par['delete'],
+                                                    log=coadd_par['log'])
+
+        # Calibrate zeropoint for the coadded image
+        if coadd_par['cal_zpt']:
+            # Extract a catalog for zero point calibration, it is only used by calzpt.
             msgs.info('Extracting a catalog using SExtractor for zero-point calibration.')
             sex.sexone(coadd_file, catname=coadd_file.replace('.fits', '_zptcat.fits'),
                        flag_image=coadd_flag_file, weight_image=coadd_wht_file,
                        task=self.sextask, config=self.sexconfig, workdir=self.coadd_path, params=self.sexparams,
                        defaultconfig='pyphot', dual=False, conv='sex', nnw=None, delete=True, log=False)
 
-            # Calibrate zeropoint for the coadded image
-            if self.par['postproc']['coadd']['cal_zpt']:
-                msgs.info('Calcuating the zeropoint for {:}'.format(coadd_file))
-                zpt, zpt_std, nstar, matched_table = calzpt(coadd_file.replace('.fits', '_zptcat.fits'),
-                        refcatalog=self.photref_catalog, primary=self.primary, secondary=self.secondary,
-                        coefficients=self.coefficients, FLXSCALE=1.0, FLASCALE=1.0,
-                        out_refcat=this_photref_cat, external_flag=self.external_flag, nstar_min=self.nstar_min,
-                        outqaroot=os.path.join(self.qa_path, this_coadd_root))
-
-                if matched_table is not None:
-                    star_table = Table()
-                    star_table['x'] = matched_table['XWIN_IMAGE']
-                    star_table['y'] = matched_table['YWIN_IMAGE']
-                    fwhm, _, _, _ = psf.buildPSF(star_table, coadd_file, pixscale=self.pixscale,
-                                                 outroot=os.path.join(self.qa_path, this_coadd_root))
-                else:
-                    fwhm = 0.
+            msgs.info('Calcuating the zeropoint for {:}'.format(coadd_file))
+            zpt, zpt_std, nstar, matched_table = calzpt(coadd_file.replace('.fits', '_zptcat.fits'),
+                    refcatalog=self.photref_catalog, primary=self.primary, secondary=self.secondary,
+                    coefficients=self.coefficients, FLXSCALE=1.0, FLASCALE=1.0,
+                    out_refcat=this_photref_cat, external_flag=self.external_flag, nstar_min=self.nstar_min,
+                    outqaroot=os.path.join(self.qa_path, this_coadd_root))
+
+            if matched_table is not None:
+                star_table = Table()
+                star_table['x'] = matched_table['XWIN_IMAGE']
+                star_table['y'] = matched_table['YWIN_IMAGE']
+                fwhm, _, _, _ = psf.buildPSF(star_table, coadd_file, pixscale=self.pixscale,
+                                             outroot=os.path.join(self.qa_path, this_coadd_root))
             else:
-                zpt = self.par['postproc']['photometry']['zpt']
-                zpt_std = 0.
-                nstar = 0
+                fwhm = 0.
+        else:
+            zpt = self.par['postproc']['photometry']['zpt']
+            zpt_std = 0.
+            nstar = 0
+            fwhm = 0.
 
-            ## Write the ZPT into fits header
-            par = fits.open(coadd_file, memmap=False)
+        ## Write the ZPT into fits header, in place so that the coadd is not read and written again
+        with fits.open(coadd_file, mode='update') as par:
             par[0].header['ZP'] = (zpt, 'Zero point')
             par[0].header['ZP_STD'] = (zpt_std, 'The standard deviration of ZP')
             par[0].header['ZP_NSTAR'] = (nstar, 'The number of stars used for ZP and FWHM')
             par[0].header['FWHM'] = (fwhm, 'FWHM in units of arcsec measured from stars')
-            par.writeto(coadd_file, overwrite=True)
 
     def extract_catalog(self):
         '''
@@ -1280,49 +1370,88 @@ class PostProc():
         if self.par['postproc']['coadd']['pixscale'] is not None:
             self.pixscale = self.par['postproc']['coadd']['pixscale'] # Update pixscale
 
-        # Coadd by group
-        groups = np.unique(self.coadd_ids.data)
-        for igroup in groups:
-            this_group = self.resamp_coadd_ids == igroup
-            this_photref_cat = np.array(self.master_phoref_cats)[this_group].tolist()[0]
-            this_coadd_root = self.coadd_root_names[np.where(np.array(self.coadd_root_ids)==igroup)[0][0]]
-
-            coadd_file = this_coadd_root + '_sci.fits'
-            coadd_wht_file = this_coadd_root + '_sci.weight.fits'
-            coadd_flag_file = this_coadd_root + '_flag.fits'
-
-            this_zpt = fits.getheader(os.path.join(self.coadd_path, coadd_file))['ZP']
-
-            phot_table, rmsmap, bkgmap = detect(coadd_file, outroot=this_coadd_root,
-                                            flag_image=coadd_flag_file, weight_image=coadd_wht_file,
-                                            workdir=self.coadd_path, bkg_image=None, rms_image=None,
-                                            zpt=this_zpt, effective_gain=None, pixscale=self.pixscale,
-                                            detection_method=self.par['postproc']['detection']['detection_method'],
-                                            detect_thresh=self.par['postproc']['detection']['detect_thresh'],
-                                            analysis_thresh=self.par['postproc']['detection']['analysis_thresh'],
-                                            detect_minarea=self.par['postproc']['detection']['detect_minarea'],
-                                            fwhm=self.par['postproc']['detection']['fwhm'],
-                                            nlevels=self.par['postproc']['detection']['nlevels'],
-                                            contrast=self.par['postproc']['detection']['contrast'],
-                                            back_type=self.par['postproc']['detection']['back_type'],
-                                            back_rms_type=self.par['postproc']['detection']['back_rms_type'],
-                                            back_size=self.par['postproc']['detection']['back_size'],
-                                            back_filter_size=self.par['postproc']['detection']['back_filtersize'],
-                                            back_default=self.par['postproc']['detection']['back_default'],
-                                            backphoto_type=self.par['postproc']['detection']['backphoto_type'],
-                                            backphoto_thick=self.par['postproc']['detection']['backphoto_thick'],
-                                            weight_type=self.par['postproc']['detection']['weight_type'],
-                                            check_type=self.par['postproc']['detection']['check_type'],
-                                            back_nsigma=self.par['postproc']['detection']['back_nsigma'],
-                                            back_maxiters=self.par['postproc']['detection']['back_maxiters'],
-                                            morp_filter=self.par['postproc']['detection']['morp_filter'],
-                                            defaultconfig='pyphot', dual=False,
-                                            conv=self.par['postproc']['detection']['conv'],
-                                            nnw=self.par['postproc']['detection']['nnw'],
-                                            delete=self.par['postproc']['detection']['delete'],
-                                            log=self.par['postproc']['detection']['log'],
-                                            phot_apertures=self.par['postproc']['detection']['phot_apertures'],
-                                            sextractor_task = self.sextask)
+        # Extract by group, the groups are independent and run in parallel
+        groups = self.coadd_groups
+        self._run_by_group('_extract_group', groups)
+
+    def _extract_group(self, igroup):
+        '''
+        Extract catalog from the coadded image of a single coadd_id
+        '''
+        this_photref_cat = self.master_phoref_cats[np.flatnonzero(self.resamp_coadd_ids == igroup)[0]]
+        this_coadd_root = self.coadd_root_dict[igroup]
+        detect_par = self.par['postproc']['detection']
+
+        coadd_file = this_coadd_root + '_sci.fits'
+        coadd_wht_file = this_coadd_root + '_sci.weight.fits'
+        coadd_flag_file = this_coadd_root + '_flag.fits'
+
+        this_zpt = fits.getheader(os.path.join(self.coadd_path, coadd_file))['ZP']
+
+        phot_table, rmsmap, bkgmap = detect(coadd_file, outroot=this_coadd_root,
+                                        flag_image=coadd_flag_file, weight_image=coadd_wht_file,
+                                        workdir=self.coadd_path, bkg_image=None, rms_image=None,
+                                        zpt=this_zpt, effective_gain=None, pixscale=self.pixscale,
+                                        detection_method=detect_par['detection_method'],
+                                        detect_thresh=detect_par['detect_thresh'],
+                                        analysis_thresh=detect_par['analysis_thresh'],
+                                        detect_minarea=detect_par['detect_minarea'],
+                                        fwhm=detect_par['fwhm'],
+                                        nlevels=detect_par['nlevels'],
+                                        contrast=detect_par['contrast'],
+                                        back_type=detect_par['back_type'],
+                                        back_rms_type=detect_par['back_rms_type'],
+                                        back_size=detect_par['back_size'],
+                                        back_filter_size=detect_par['back_filtersize'],
+                                        back_default=detect_par['back_default'],
+                                        backphoto_type=detect_par['backphoto_type'],
+                                        backphoto_thick=detect_par['backphoto_thick'],
+                                        weight_type=detect_par['weight_type'],
+                                        check_type=detect_par['check_type'],
+                                        back_nsigma=detect_par['back_nsigma'],
+                                        back_maxiters=detect_par['back_maxiters'],
+                                        morp_filter=detect_par['morp_filter'],
+                                        compress_maps=detect_par['compress_maps'],
+                                        defaultconfig='pyphot', dual=False,
+                                        conv=detect_par['conv'],
+                                        nnw=detect_par['nnw'],
+                                        delete=detect_par['delete'],
+                                        log=detect_par['log'],
+                                        phot_apertures=detect_par['phot_apertures'],
+                                        sextractor_task = self.sextask)
+
+    def _run_by_group(self, method, groups):
+        '''
+        Run a PostProc method for each of the coadd groups, in parallel if n_process>1.
+        The n_process budget is shared between the groups and the tools run on each group.
+        '''
+        n_process = min(self.n_process, len(groups))
+        if n_process <= 1:
+            for igroup in groups:
+                getattr(self, method)(igroup)
+        else:
+            msgs.info('Start parallel processing with n_process={:}'.format(n_process))
+            work_queue = Queue()
+            processes = []
+
+            for igroup in groups:
+                work_queue.put(igroup)
+            # one sentinel per worker
+            for w in range(n_process):
+                work_queue.put(None)
+
+            # creating processes
+            for w in range(n_process):
+                p = Process(target=_postproc_group_worker, args=(work_queue, self, method),
+                            kwargs={'n_process': max(1, self.n_process // n_process)})
+                processes.append(p)
+                p.start()
+
+            # completing process, a failed group would otherwise only show up as missing files
+            for p in processes:
+                p.join()
+            if any(p.exitcode != 0 for p in processes):
+                msgs.error('{:} failed for at least one of the coadd groups.'.format(method))
 
     def get_astref_cat(self, igroup):
         '''
@@ -3,12 +3,15 @@
 """
 import gc
 import os
+import re
 import numpy as np
+from functools import lru_cache
 
 import multiprocessing
 from multiprocessing import Process, Queue
 
-from astropy import stats
+from scipy import ndimage
+from scipy.linalg import blas
 
 from pyphot import msgs
 from pyphot import utils
@@ -16,7 +19,15 @@ from pyphot import io
 from pyphot import masterframe, postproc
 from pyphot.lacosmic import lacosmic
 from pyphot.satdet import satdet
-from pyphot.photometry import BKG2D, mask_bright_star
+from pyphot.photometry import BKG2D, coarse_background, mask_bright_star
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# compression suffix stripped from raw file names when naming the processed products
+_COMPRESS_SUFFIX = re.compile(r'\.(gz|fz)$')
 
 def detproc(scifiles, camera, det, n_process=4, science_path=None, masterbiasimg=None, masterdarkimg=None, masterpixflatimg=None,
             masterillumflatimg=None, bpm_proc=None, mask_vig=False, minimum_vig=0.5, apply_gain=False, grow=1.5,
@@ -82,13 +93,9 @@ def _detproc_one(scifile, camera, det, science_path=None, masterbiasimg=None, ma
                  maskbrightstar=True, brightstar_nsigma=3, maskbrightstar_method='sextractor', conv='sex',
                  sextractor_task='sex', verbose=True, overwrite=True):
 
-    rootname = scifile.split('/')[-1]
+    rootname = os.path.basename(scifile)
     if science_path is not None:
-        rootname = os.path.join(science_path,rootname)
-        if '.gz' in rootname:
-            rootname = rootname.replace('.gz','')
-        elif '.fz' in rootname:
-            rootname = rootname.replace('.fz','')
+        rootname = os.path.join(science_path, _COMPRESS_SUFFIX.sub('', rootname))
 
     # prepare output file names
     sci_fits_file = rootname.replace('.fits','_det{:02d}_proc.fits'.format(det))
@@ -135,14 +142,9 @@ def _detproc_one(scifile, camera, det, science_path=None, masterbiasimg=None, ma
             header['UNITS'] = ('ADU', 'Data units')
 
         # Detector Processing
-        if masterbiasimg is not None:
-            sci_image -= masterbiasimg # should I assume masterbiasimg has zero error?
-        if masterdarkimg is not None:
-            sci_image -= masterdarkimg*exptime # should I assume masterdarkimg has zero error?
-        if masterpixflatimg is not None:
-            sci_image *= utils.inverse(masterpixflatimg)
-        if masterillumflatimg is not None:
-            sci_image *= utils.inverse(masterillumflatimg)
+        # should I assume masterbiasimg and masterdarkimg have zero error?
+        detector_process(sci_image, masterbiasimg=masterbiasimg, masterdarkimg=masterdarkimg, exptime=exptime,
+                         masterpixflatimg=masterpixflatimg, masterillumflatimg=masterillumflatimg)
 
         # Mask Vignetting pixels, should be done after gain correction and detector processing!
         if mask_vig:
@@ -160,15 +162,17 @@ def _detproc_one(scifile, camera, det, science_path=None, masterbiasimg=None, ma
                 #  Basically, we are using the sky background for vignetting.
                 #  IMACS need this since the guider moves around the detector.
                 #  Keck LIRS also need this given its weid illumination at the edge.
-                bpm_for_vig = bpm | bpm_sat | bpm_zero | bpm_proc | bpm_vig_1
+                bpm_for_vig = combine_masks(bpm, bpm_sat, bpm_zero, bpm_proc, bpm_vig_1)
                 #starmask = mask_bright_star(sci_image, mask=bpm_for_vig, brightstar_nsigma=5., back_nsigma=3.,
                 #                            back_maxiters=5, method='sextractor', conv=conv,
                 #                            task=sextractor_task, verbose=verbose)
-                bkg_for_vig, _ = BKG2D(sci_image, (50,50), mask=bpm_for_vig, filter_size=(3,3),
-                                       sigclip=5., back_type='sextractor', verbose=verbose)
-                bpm_vig_2 = sci_image < (1-minimum_vig) * np.median(bkg_for_vig[np.invert(bpm_for_vig)])
-                bpm_vig_3 = bkg_for_vig < (1-minimum_vig) * np.median(bkg_for_vig[np.invert(bpm_for_vig)])
-                bpm_vig_all = bpm_vig_1 | bpm_vig_2 | bpm_vig_3
+                # A coarse mesh median is enough for a 50% threshold and avoids a full SExtractor background run
+                bkg_for_vig = coarse_background(sci_image, (50,50), mask=bpm_for_vig, filter_size=(3,3))
+                vig_thresh = (1-minimum_vig) * np.median(bkg_for_vig[~bpm_for_vig])
+                # a pixel is vignetted if either the image or its background falls below the threshold,
+                # fmin skips NaNs so this matches (sci_image < vig_thresh) | (bkg_for_vig < vig_thresh)
+                bpm_vig_all = np.fmin(sci_image, bkg_for_vig) < vig_thresh
+                bpm_vig_all |= bpm_vig_1
                 bpm_vig = grow_masked(bpm_vig_all, grow, verbose=verbose)
             else:
                 bpm_vig = bpm_vig_1
@@ -176,7 +180,7 @@ def _detproc_one(scifile, camera, det, science_path=None, masterbiasimg=None, ma
             bpm_vig = np.zeros_like(sci_image, dtype=bool)
 
         # Get a total mask up to this stage
-        bpm_for_wht = bpm | bpm_sat | bpm_zero | bpm_nan | bpm_proc | bpm_vig
+        bpm_for_wht = combine_masks(bpm, bpm_sat, bpm_zero, bpm_nan, bpm_proc, bpm_vig)
 
         if maskbrightstar:
             msgs.info('Masking bright stars before calculating median sky background')
@@ -231,9 +235,8 @@ def _detproc_one(scifile, camera, det, science_path=None, masterbiasimg=None, ma
         io.save_fits(wht_fits_file, wht_image, header, 'WEIGHT', overwrite=True)
         msgs.info('Weight image {:} saved'.format(wht_fits_file))
         # save flag image
-        flag_image = bpm*np.int(2**0) + bpm_proc*np.int(2**1) + bpm_sat*np.int(2**2) + \
-                     bpm_zero * np.int(2**3) + bpm_nan*np.int(2**4) + bpm_vig*np.int(2**5)
-        io.save_fits(flag_fits_file, flag_image.astype('int32'), header, 'FLAG', overwrite=True)
+        flag_image = pack_flags((bpm, bpm_proc, bpm_sat, bpm_zero, bpm_nan, bpm_vig))
+        io.save_fits(flag_fits_file, flag_image, header, 'FLAG', overwrite=True)
         msgs.info('Flag image {:} saved'.format(flag_fits_file))
         # I save star mask here to avoid running maskbrightstar again in the future
         io.save_fits(star_fits_file, starmask.astype('int32'), header, 'FLAG', overwrite=True)
@@ -365,23 +368,36 @@ def _sciproc_one(scifile, flagfile, airmass, coeff_airmass=0., mastersuperskyimg
         _, ivar_image, _ = io.load_fits(scifile.replace('_proc.fits','_proc.ivar.fits'))
         _, wht_image, _ = io.load_fits(scifile.replace('_proc.fits','_proc.weight.fits'))
         _, flag_image, _ = io.load_fits(flagfile)
+        # single precision is plenty for sky levels and halves the memory traffic of everything below
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        ivar_image = np.ascontiguousarray(ivar_image, dtype=np.float32)
+        wht_image = np.ascontiguousarray(wht_image, dtype=np.float32)
         bpm = flag_image>0
         bpm_zero = (data == 0.)
         bpm_saturation = (flag_image & 2**2)>0
         bpm_vig = (flag_image & 2**5)>0
+        gpm_saturation = np.invert(bpm_saturation)
         bpm_vig_only = np.logical_and(bpm_vig, np.invert(bpm_zero)) # pixels identified by vig but not zeros
-        ## super flattening your images
-        if mastersuperskyimg is not None:
-            data *= utils.inverse(mastersuperskyimg)
-            ivar_image *= mastersuperskyimg**2
-            wht_image *= mastersuperskyimg**2
-
-        # do the extinction correction.
+        ## super flattening and extinction correction, folded into one scale image so that
+        ## each of data, ivar_image and wht_image is only multiplied once
         if airmass is not None:
             mag_ext = coeff_airmass * (airmass-1)
-            data *= 10**(0.4*mag_ext)
-            ivar_image *= 10**(-0.8*mag_ext)
-            wht_image *= 10**(-0.8*mag_ext)
+            flux_scale = 10**(0.4*mag_ext)
+        else:
+            flux_scale = 1.
+        if mastersuperskyimg is not None:
+            scale_image = utils.inverse(mastersuperskyimg)
+            scale_image *= flux_scale
+            data *= scale_image
+            np.square(mastersuperskyimg, out=scale_image)
+            scale_image *= flux_scale**-2
+            ivar_image *= scale_image
+            wht_image *= scale_image
+            del scale_image
+        elif airmass is not None:
+            data *= flux_scale
+            ivar_image *= flux_scale**-2
+            wht_image *= flux_scale**-2
 
         # mask bright stars before estimating the background
         if maskbrightstar:
@@ -419,6 +435,7 @@ def _sciproc_one(scifile, flagfile, airmass, coeff_airmass=0., mastersuperskyimg
                                                      sigclip=sigclip, back_type=back_type, back_rms_type=back_rms_type,
                                                      back_maxiters=back_maxiters, sextractor_task=sextractor_task,
                                                      verbose=verbose)
+            background_array = background_array.astype(np.float32, copy=False)
         # set the background for zero pixels to zero
         background_array[bpm_zero] = 0.
 
@@ -429,7 +446,7 @@ def _sciproc_one(scifile, flagfile, airmass, coeff_airmass=0., mastersuperskyimg
 
         # CR mask
         # do not trade saturation as bad pixel when searching for CR and satellite trail
-        bpm_for_cr = np.logical_and(bpm, np.invert(bpm_saturation))
+        bpm_for_cr = np.logical_and(bpm, gpm_saturation)
         if mask_cr:
             if verbose:
                 msgs.info('Identifying cosmic rays using the L.A.Cosmic algorithm')
@@ -468,33 +485,36 @@ def _sciproc_one(scifile, flagfile, airmass, coeff_airmass=0., mastersuperskyimg
             bpm_negative = np.zeros_like(sci_image, dtype=bool)
 
         # add the cosmic ray and satellite trail flag to the flag images
-        flag_image_new = flag_image + bpm_cr.astype('int32')*np.int(2**6) + bpm_sat.astype('int32')*np.int(2**7)
-        flag_image_new += bpm_negative.astype('int32')*np.int(2**8)
+        flag_image_new = pack_flags((bpm_cr, bpm_sat, bpm_negative), start_bit=6,
+                                    flag=flag_image.astype('int32'))
 
         ## replace bad pixels but not saturated pixels to make the image nicer
         #flag_image = bpm*np.int(2**0) + bpm_proc*np.int(2**1) + bpm_sat*np.int(2**2) + \
         #             bpm_zero * np.int(2**3) + bpm_nan*np.int(2**4) + bpm_vig*np.int(2**5)
         # ToDo: explore the replacement algorithm, replace a bad pixel using the median of a box
         bpm_all = flag_image_new>0
-        bpm_replace = np.logical_and(bpm_all, np.invert(bpm_saturation))
-        if replace == 'zero':
+        bpm_replace = np.logical_and(bpm_all, gpm_saturation)
+        # the clipped statistics are a few passes over the whole image, skip them if there is nothing to replace
+        if replace is not None and not np.any(bpm_replace):
+            msgs.info('No bad pixels to be replaced')
+        elif replace == 'zero':
             sci_image[bpm_replace] = 0
         elif replace == 'median':
-            _,sci_image[bpm_replace],_ = stats.sigma_clipped_stats(sci_image, bpm_all, sigma=sigclip, maxiters=5)
+            sci_image[bpm_replace] = utils.clipped_stat(sci_image, bpm_all, stat='median', sigclip=sigclip, n_clip=5)
         elif replace == 'mean':
-            sci_image[bpm_replace],_,_ = stats.sigma_clipped_stats(sci_image, bpm_all, sigma=sigclip, maxiters=5)
+            sci_image[bpm_replace] = utils.clipped_stat(sci_image, bpm_all, stat='mean', sigclip=sigclip, n_clip=5)
         elif replace == 'min':
-            sci_image[bpm_replace] = np.min(sci_image[np.invert(bpm_all)])
+            sci_image[bpm_replace] = np.min(sci_image, where=np.invert(bpm_all), initial=np.inf)
         elif replace == 'max':
-            sci_image[bpm_replace] = np.max(sci_image[np.invert(bpm_all)])
+            sci_image[bpm_replace] = np.max(sci_image, where=np.invert(bpm_all), initial=-np.inf)
         else:
             if verbose:
                 msgs.info('Not replacing bad pixel values')
 
         ## Generate weight map used for SExtractor and SWarp (WEIGHT_TYPE = MAP_WEIGHT)
         #wht_image = utils.inverse(background_array)
-        # Set bad pixel's weight to be zero
-        wht_image[flag_image_new>0] = 0
+        # Set bad pixel's weight to be zero, bpm_all already holds flag_image_new>0
+        wht_image[bpm_all] = 0
 
         # Update header
         header['MEDSKY'] = (med_sky, 'Median Sky Value, units e-')
@@ -507,11 +527,11 @@ def _sciproc_one(scifile, flagfile, airmass, coeff_airmass=0., mastersuperskyimg
         msgs.info('Inverse variance image {:} saved'.format(ivar_fits_file))
         io.save_fits(wht_fits_file, wht_image, header, 'WEIGHT', overwrite=True)
         msgs.info('Weight image {:} saved'.format(wht_fits_file))
-        io.save_fits(flag_fits_file, flag_image_new.astype('int32'), header, 'FLAG', overwrite=True)
+        io.save_fits(flag_fits_file, flag_image_new, header, 'FLAG', overwrite=True)
         msgs.info('Flag image {:} saved'.format(flag_fits_file))
 
         del(data, sci_image, ivar_image, wht_image, flag_image, flag_image_new, rms_image, background_array)
-        del(bpm_all, bpm, bpm_replace, bpm_saturation, bpm_zero, bpm_vig_only, bpm_vig)
+        del(bpm_all, bpm, bpm_replace, bpm_saturation, gpm_saturation, bpm_zero, bpm_vig_only, bpm_vig)
         del(bpm_for_bkg, bpm_negative, bpm_sat, bpm_for_cr, bpm_cr)
         gc.collect()
 
@@ -551,7 +571,7 @@ def defringing(sci_fits_list, masterfringeimg):
         if 'DEFRING' in header.keys():
             msgs.info('The De-fringed image {:} exists, skipping...'.format(sci_fits_list[i]))
         else:
-            data -= masterfringeimg * header['EXPTIME']
+            subtract_scaled(data, masterfringeimg, header['EXPTIME'])
             data[mask_zero] = 0
             header['DEFRING'] = ('TRUE', 'De-Fringing is done?')
             io.save_fits(sci_fits_list[i], data, header, 'ScienceImage', overwrite=True)
@@ -578,41 +598,190 @@ def trim_frame(frame, mask):
             Error raised if the trimmed image includes masked values
             because the shape of the valid region is odd.
     """
-    if np.any(mask[np.invert(np.all(mask,axis=1)),:][:,np.invert(np.all(mask,axis=0))]):
+    good_rows = np.invert(np.all(mask,axis=1))
+    good_cols = np.invert(np.all(mask,axis=0))
+    if np.any(mask[good_rows,:][:,good_cols]):
         msgs.error('Data section is oddly shaped.  Trimming does not exclude all '
                    'pixels outside the data sections.')
-    return frame[np.invert(np.all(mask,axis=1)),:][:,np.invert(np.all(mask,axis=0))]
+    return frame[good_rows,:][:,good_cols]
 
-def grow_masked(img, grow, verbose=True):
+def detector_process(sci_image, masterbiasimg=None, masterdarkimg=None, exptime=1., masterpixflatimg=None,
+                     masterillumflatimg=None, block_size=2**15):
+    """
+    Bias and dark subtraction and flat fielding of an image, in place.
 
-    img = img.astype(float)
-    growval =1.0
-    if verbose:
-        msgs.info('Growing mask by {:}'.format(grow))
-    if not np.any(img == growval):
-        return img.astype(bool)
+    The image is processed in blocks of rows, and every step is applied to a
+    block before moving on. Each block stays in cache across the steps, and
+    temporaries such as the inverse flats are only block sized.
+
+    Args:
+        sci_image (:obj:`numpy.ndarray`):
+            Trimmed image to be processed in place
+        masterbiasimg, masterdarkimg, masterpixflatimg, masterillumflatimg (:obj:`numpy.ndarray`, optional):
+            Master frames with the same shape as sci_image. Steps with a None master are skipped.
+        exptime (:obj:`float`, optional):
+            Exposure time used to scale the master dark
+        block_size (:obj:`int`, optional):
+            Approximate number of pixels per block
+
+    Return:
+        :obj:`numpy.ndarray`:
+            The processed input image
+    """
+    nrows = max(1, block_size // max(1, sci_image.shape[1]))
+    for start in range(0, sci_image.shape[0], nrows):
+        blk = slice(start, start+nrows)
+        this_sci = sci_image[blk]
+        if masterbiasimg is not None:
+            this_sci -= masterbiasimg[blk]
+        if masterdarkimg is not None:
+            subtract_scaled(this_sci, masterdarkimg[blk], exptime)
+        if masterpixflatimg is not None:
+            this_sci *= utils.inverse(masterpixflatimg[blk])
+        if masterillumflatimg is not None:
+            this_sci *= utils.inverse(masterillumflatimg[blk])
+    return sci_image
+
+def combine_masks(*masks):
+    """
+    Combine boolean masks with a logical OR.
+
+    The result is accumulated in place into a single output array, so
+    combining N masks allocates one image instead of N-1 temporaries.
+    When the masks are contiguous booleans the OR is done on uint64 words,
+    i.e. on eight pixels per operation.
+
+    Args:
+        *masks (:obj:`numpy.ndarray`):
+            Boolean images of the same shape
+
+    Return:
+        :obj:`numpy.ndarray`:
+            Boolean image set to True where any input mask is True
+    """
+    out = np.array(masks[0], dtype=bool, copy=True)
+    out_words = _mask_words(out)
+    for mask in masks[1:]:
+        mask_words = _mask_words(mask) if out_words is not None else None
+        if mask_words is not None:
+            np.bitwise_or(out_words, mask_words, out=out_words)
+        else:
+            np.logical_or(out, mask, out=out)
+    return out
+
+def _mask_words(mask):
+    """
+    Return a uint64 view of a contiguous boolean mask, or None if the mask
+    cannot be viewed that way. Each word holds eight pixels (one byte each).
+    """
+    if not isinstance(mask, np.ndarray) or mask.dtype != bool or not mask.flags.c_contiguous \
+            or mask.size % 8 != 0:
+        return None
+    return mask.reshape(-1).view(np.uint64)
 
-    _img = img.copy()
-    sz_x, sz_y = img.shape
-    d = int(1+grow)
-    rsqr = grow*grow
+def pack_flags(masks, start_bit=0, flag=None):
+    """
+    Pack boolean masks into the bits of an int32 flag image.
+
+    ``masks[i]`` sets bit ``start_bit+i``. Bits are OR-ed in place with
+    ``where=``, so no integer copy of the boolean masks is ever made.
+
+    Args:
+        masks (:obj:`list`, :obj:`tuple`):
+            Boolean images of the same shape
+        start_bit (:obj:`int`, optional):
+            Bit used for the first mask
+        flag (:obj:`numpy.ndarray`, optional):
+            Existing int32 flag image to be updated in place. If None,
+            a new one is started from zero.
+
+    Return:
+        :obj:`numpy.ndarray`:
+            int32 flag image
+    """
+    if flag is None:
+        flag = np.zeros(np.shape(masks[0]), dtype='int32')
+    for ibit, mask in enumerate(masks):
+        np.bitwise_or(flag, np.int32(2**(start_bit+ibit)), out=flag, where=mask)
+    return flag
+
+def subtract_scaled(image, frame, scale):
+    """
+    Subtract a scaled frame from an image in place, i.e. ``image -= frame*scale``.
 
-    # Grow any masked values by the specified amount
-    for x in range(sz_x):
-        for y in range(sz_y):
-            if img[x,y] != growval:
-                continue
+    When both arrays are contiguous floats of the same type this is done
+    with a single BLAS axpy call, so the scaled frame is never allocated.
 
+    Args:
+        image (:obj:`numpy.ndarray`):
+            Image to be modified in place
+        frame (:obj:`numpy.ndarray`):
+            Frame to be scaled and subtracted, e.g. a master dark
+        scale (:obj:`float`):
+            Scale factor, e.g. the exposure time
+
+    Return:
+        :obj:`numpy.ndarray`:
+            The modified input image
+    """
+    if image.dtype in (np.float32, np.float64) and image.dtype == frame.dtype and \
+            image.shape == frame.shape and image.flags.c_contiguous and frame.flags.c_contiguous:
+        axpy = blas.get_blas_funcs('axpy', (image, frame))
+        axpy(frame.ravel(), image.ravel(), a=-float(scale))
+    else:
+        image -= frame*scale
+    return image
+
+def grow_masked(img, grow, verbose=True):
+
+    if verbose:
+        msgs.info('Growing mask by {:}'.format(grow))
+    if njit is not None:
+        mask = np.ascontiguousarray(img, dtype=bool)
+        if not np.any(mask):
+            return mask
+        return _grow_masked_numba(mask, float(grow))
+
+    mask = np.asarray(img, dtype=bool)
+    if not np.any(mask):
+        return mask
+    return ndimage.binary_dilation(mask, structure=_disk_structure(float(grow)))
+
+@lru_cache(maxsize=None)
+def _disk_structure(grow):
+    """
+    Circular structuring element of radius ``grow`` used by :func:`grow_masked`.
+    Cached since the same radius is used for every mask of every frame.
+    """
+    d = int(np.ceil(grow))
+    xx, yy = np.mgrid[-d:d+1, -d:d+1]
+    return xx*xx + yy*yy <= grow*grow
+
+if njit is not None:
+    @njit(cache=True, parallel=True)
+    def _grow_masked_numba(mask, grow):
+        """
+        Numba kernel for :func:`grow_masked`. Each output pixel is flagged if any
+        masked pixel lies within ``grow`` of it, so rows can be done in parallel.
+        """
+        sz_x, sz_y = mask.shape
+        d = int(1+grow)
+        rsqr = grow*grow
+        _mask = np.zeros_like(mask)
+        for x in prange(sz_x):
             mnx = 0 if x-d < 0 else x-d
             mxx = x+d+1 if x+d+1 < sz_x else sz_x
-            mny = 0 if y-d < 0 else y-d
-            mxy = y+d+1 if y+d+1 < sz_y else sz_y
-
-            for i in range(mnx,mxx):
-                for j in range(mny, mxy):
-                    if (i-x)*(i-x)+(j-y)*(j-y) <= rsqr:
-                        _img[i,j] = growval
-    return _img.astype(bool)
+            for y in range(sz_y):
+                mny = 0 if y-d < 0 else y-d
+                mxy = y+d+1 if y+d+1 < sz_y else sz_y
+                for i in range(mnx, mxx):
+                    if _mask[x,y]:
+                        break
+                    for j in range(mny, mxy):
+                        if mask[i,j] and (i-x)*(i-x)+(j-y)*(j-y) <= rsqr:
+                            _mask[x,y] = True
+                            break
+        return _mask
 
 class ImageProc():
     """
@@ -641,6 +810,36 @@ class ImageProc():
         self.maskbrightstar_method = self.par['scienceframe']['process']['brightstar_method']
         self.conv= self.par['scienceframe']['process']['conv']
 
+        # Parameters passed to sciproc, looked up once here instead of on every call
+        process_par = self.par['scienceframe']['process']
+        self.sciproc_kwargs = {key: process_par[key] for key in
+                               ['use_medsky', 'back_type', 'back_rms_type', 'back_size', 'back_filtersize',
+                                'sigclip', 'mask_cr', 'lamaxiter', 'cr_threshold', 'neighbor_threshold',
+                                'contrast', 'grow', 'mask_sat', 'sat_sig', 'sat_buf', 'sat_order', 'low_thresh',
+                                'h_thresh', 'small_edge', 'line_len', 'line_gap', 'percentile', 'replace',
+                                'mask_negative_star']}
+        self.sciproc_kwargs['coeff_airmass'] = self.par['postproc']['photometry']['coeff_airmass']
+
+    def derived_paths(self, rawfiles, *suffixes):
+        '''
+        Names of the products of this detector in science_path for a list of raw files
+        Parameters
+        ----------
+        rawfiles
+        suffixes: product suffixes, e.g. 'proc' gives *_det01_proc.fits
+
+        Returns
+        -------
+        one list of file names per suffix
+        '''
+        endings = ['_det{:02d}_{:}.fits'.format(self.det, suffix) for suffix in suffixes]
+        paths = [[] for _ in suffixes]
+        for ifile in rawfiles:
+            rootname = os.path.join(self.science_path, _COMPRESS_SUFFIX.sub('', os.path.basename(ifile)))
+            for path_list, ending in zip(paths, endings):
+                path_list.append(rootname.replace('.fits', ending))
+        return paths
+
     def run_detproc(self, procfiles, masterbiasimg, masterdarkimg, masterpixflatimg, masterillumflatimg, bpm_proc):
         '''
         Bias, dark subtraction and flat fielding, support parallel processing
@@ -691,38 +890,33 @@ class ImageProc():
 
         mastersupersky_name = os.path.join(self.par['calibrations']['master_dir'],
                                            'MasterSuperSky_{:}'.format(self.master_key))
-        if os.path.exists(mastersupersky_name) and self.reuse_masters:
-            msgs.info('Using existing master file {:}'.format(mastersupersky_name))
-        else:
-            if np.size(superskyrawfiles) < 3:
-                msgs.warn('The number of SuperSky frames should be generally >=3.')
-            superskyfiles = []
-            superskymaskfiles = []
-            for ifile in superskyrawfiles:
-                rootname = os.path.join(self.science_path, ifile.split('/')[-1])
-                if '.gz' in rootname:
-                    rootname = rootname.replace('.gz', '')
-                elif '.fz' in rootname:
-                    rootname = rootname.replace('.fz', '')
-                # prepare input file names
-                superskyfile = rootname.replace('.fits', '_det{:02d}_proc.fits'.format(self.det))
-                superskyfiles.append(superskyfile)
-                superskymaskfile = rootname.replace('.fits', '_det{:02d}_detmask.fits'.format(self.det))
-                superskymaskfiles.append(superskymaskfile)
-
-            masterframe.superskyframe(superskyfiles, mastersupersky_name,
-                                      maskfiles=superskymaskfiles,
-                                      cenfunc=self.par['calibrations']['superskyframe']['process']['comb_cenfunc'],
-                                      stdfunc=self.par['calibrations']['superskyframe']['process']['comb_stdfunc'],
-                                      sigma=self.par['calibrations']['superskyframe']['process']['comb_sigrej'],
-                                      maxiters=self.par['calibrations']['superskyframe']['process']['comb_maxiter'],
-                                      window_size=self.par['calibrations']['superskyframe']['process']['window_size'],
-                                      maskbrightstar=self.maskbrightstar,
-                                      brightstar_nsigma=self.brightstar_nsigma,
-                                      maskbrightstar_method=self.maskbrightstar_method,
-                                      conv=self.conv,
-                                      sextractor_task=self.sextask)
-        _, self.mastersuperskyimg, self.masksuperskyimg = io.load_fits(mastersupersky_name)
+        # Try to reuse the master directly instead of checking for it first, this
+        # saves a stat on network file systems. Missing or unreadable masters are rebuilt.
+        if self.reuse_masters:
+            try:
+                _, self.mastersuperskyimg, self.masksuperskyimg = io.load_fits(mastersupersky_name)
+                msgs.info('Using existing master file {:}'.format(mastersupersky_name))
+                return
+            except OSError:
+                pass
+
+        if np.size(superskyrawfiles) < 3:
+            msgs.warn('The number of SuperSky frames should be generally >=3.')
+        superskyfiles, superskymaskfiles = self.derived_paths(superskyrawfiles, 'proc', 'detmask')
+        proc_par = self.par['calibrations']['superskyframe']['process']
+
+        self.mastersuperskyimg, self.masksuperskyimg = masterframe.superskyframe(superskyfiles, mastersupersky_name,
+                                                                                 maskfiles=superskymaskfiles,
+                                                                                 cenfunc=proc_par['comb_cenfunc'],
+                                                                                 stdfunc=proc_par['comb_stdfunc'],
+                                                                                 sigma=proc_par['comb_sigrej'],
+                                                                                 maxiters=proc_par['comb_maxiter'],
+                                                                                 window_size=proc_par['window_size'],
+                                                                                 maskbrightstar=self.maskbrightstar,
+                                                                                 brightstar_nsigma=self.brightstar_nsigma,
+                                                                                 maskbrightstar_method=self.maskbrightstar_method,
+                                                                                 conv=self.conv,
+                                                                                 sextractor_task=self.sextask)
 
     def run_sciproc(self, sciprocfiles, sciproc_airmass):
         '''
@@ -738,50 +932,17 @@ class ImageProc():
         '''
 
         # Prepare lists for sciproc
-        sciproc_fits_list = []
-        scimask_fits_list = []
-        for ifile in sciprocfiles:
-            rootname = os.path.join(self.science_path, os.path.basename(ifile))
-            sci_fits_file = rootname.replace('.fits', '_det{:02d}_proc.fits'.format(self.det))
-            flag_fits_file = rootname.replace('.fits', '_det{:02d}_detmask.fits'.format(self.det))
-            sciproc_fits_list.append(sci_fits_file)
-            scimask_fits_list.append(flag_fits_file)
+        sciproc_fits_list, scimask_fits_list = self.derived_paths(sciprocfiles, 'proc', 'detmask')
 
         ## Do the sciproc
         sci_fits_list, wht_fits_list, flag_fits_list = sciproc(sciproc_fits_list, scimask_fits_list,
                                                     mastersuperskyimg=self.mastersuperskyimg,
                                                     airmass=sciproc_airmass,
-                                                    coeff_airmass=self.par['postproc']['photometry']['coeff_airmass'],
-                                                    use_medsky=self.par['scienceframe']['process']['use_medsky'],
-                                                    back_type=self.par['scienceframe']['process']['back_type'],
-                                                    back_rms_type=self.par['scienceframe']['process']['back_rms_type'],
-                                                    back_size=self.par['scienceframe']['process']['back_size'],
-                                                    back_filtersize=self.par['scienceframe']['process']['back_filtersize'],
                                                     maskbrightstar=self.maskbrightstar,
                                                     brightstar_nsigma=self.brightstar_nsigma,
                                                     maskbrightstar_method=self.maskbrightstar_method,
                                                     conv=self.conv,
-                                                    sigclip=self.par['scienceframe']['process']['sigclip'],
-                                                    mask_cr=self.par['scienceframe']['process']['mask_cr'],
-                                                    lamaxiter=self.par['scienceframe']['process']['lamaxiter'],
-                                                    cr_threshold=self.par['scienceframe']['process']['cr_threshold'],
-                                                    neighbor_threshold=self.par['scienceframe']['process']['neighbor_threshold'],
-                                                    contrast=self.par['scienceframe']['process']['contrast'],
-                                                    grow=self.par['scienceframe']['process']['grow'],
-                                                    # sigfrac=self.par['scienceframe']['process']['sigfrac'],
-                                                    # objlim=self.par['scienceframe']['process']['objlim'],
-                                                    mask_sat=self.par['scienceframe']['process']['mask_sat'],
-                                                    sat_sig=self.par['scienceframe']['process']['sat_sig'],
-                                                    sat_buf=self.par['scienceframe']['process']['sat_buf'],
-                                                    sat_order=self.par['scienceframe']['process']['sat_order'],
-                                                    low_thresh=self.par['scienceframe']['process']['low_thresh'],
-                                                    h_thresh=self.par['scienceframe']['process']['h_thresh'],
-                                                    small_edge=self.par['scienceframe']['process']['small_edge'],
-                                                    line_len=self.par['scienceframe']['process']['line_len'],
-                                                    line_gap=self.par['scienceframe']['process']['line_gap'],
-                                                    percentile=self.par['scienceframe']['process']['percentile'],
-                                                    replace=self.par['scienceframe']['process']['replace'],
-                                                    mask_negative_star=self.par['scienceframe']['process']['mask_negative_star'],
+                                                    **self.sciproc_kwargs,
                                                     sextractor_task=self.sextask,
                                                     n_process=self.n_process, overwrite=self.overwrite)
 
@@ -799,37 +960,32 @@ class ImageProc():
 
         masterfringe_name = os.path.join(self.par['calibrations']['master_dir'],
                                          'MasterFringe_{:}'.format(self.master_key))
-        if os.path.exists(masterfringe_name) and self.reuse_masters:
-            msgs.info('Using existing master file {:}'.format(masterfringe_name))
-        else:
-            if np.size(fringerawfiles) < 3:
-                msgs.warn('The number of Fringe images should be generally >=3.')
-            fringefiles = []
-            fringemaskfiles = []
-            for ifile in fringerawfiles:
-                rootname = os.path.join(self.science_path, ifile.split('/')[-1])
-                if '.gz' in rootname:
-                    rootname = rootname.replace('.gz', '')
-                elif '.fz' in rootname:
-                    rootname = rootname.replace('.fz', '')
-                # prepare input file names
-                fringefile = rootname.replace('.fits', '_det{:02d}_sci.fits'.format(self.det))
-                fringefiles.append(fringefile)
-                fringemaskfile = rootname.replace('.fits', '_det{:02d}_flag.fits'.format(self.det))
-                fringemaskfiles.append(fringemaskfile)
-
-            masterframe.fringeframe(fringefiles, masterfringe_name,
-                                    fringemaskfiles=fringemaskfiles, mastersuperskyimg=self.mastersuperskyimg,
-                                    cenfunc=self.par['calibrations']['fringeframe']['process']['comb_cenfunc'],
-                                    stdfunc=self.par['calibrations']['fringeframe']['process']['comb_stdfunc'],
-                                    sigma=self.par['calibrations']['fringeframe']['process']['comb_sigrej'],
-                                    maxiters=self.par['calibrations']['fringeframe']['process']['comb_maxiter'],
-                                    maskbrightstar=self.maskbrightstar,
-                                    brightstar_nsigma=self.brightstar_nsigma,
-                                    maskbrightstar_method=self.maskbrightstar_method,
-                                    conv=self.conv,
-                                    sextractor_task=self.sextask)
-        _, self.masterfringeimg, self.maskfringeimg = io.load_fits(masterfringe_name)
+        # Try to reuse the master directly instead of checking for it first, this
+        # saves a stat on network file systems. Missing or unreadable masters are rebuilt.
+        if self.reuse_masters:
+            try:
+                _, self.masterfringeimg, self.maskfringeimg = io.load_fits(masterfringe_name)
+                msgs.info('Using existing master file {:}'.format(masterfringe_name))
+                return
+            except OSError:
+                pass
+
+        if np.size(fringerawfiles) < 3:
+            msgs.warn('The number of Fringe images should be generally >=3.')
+        fringefiles, fringemaskfiles = self.derived_paths(fringerawfiles, 'sci', 'flag')
+        proc_par = self.par['calibrations']['fringeframe']['process']
+
+        self.masterfringeimg, self.maskfringeimg = masterframe.fringeframe(fringefiles, masterfringe_name,
+                                                                           fringemaskfiles=fringemaskfiles, mastersuperskyimg=self.mastersuperskyimg,
+                                                                           cenfunc=proc_par['comb_cenfunc'],
+                                                                           stdfunc=proc_par['comb_stdfunc'],
+                                                                           sigma=proc_par['comb_sigrej'],
+                                                                           maxiters=proc_par['comb_maxiter'],
+                                                                           maskbrightstar=self.maskbrightstar,
+                                                                           brightstar_nsigma=self.brightstar_nsigma,
+                                                                           maskbrightstar_method=self.maskbrightstar_method,
+                                                                           conv=self.conv,
+                                                                           sextractor_task=self.sextask)
 
     def run_defringing(self, scifiles):
         '''
@@ -844,11 +1000,7 @@ class ImageProc():
         '''
 
         # Prepare lists for defringing
-        sci_fits_list = []
-        for ifile in scifiles:
-            rootname = os.path.join(self.science_path, os.path.basename(ifile))
-            sci_fits_file = rootname.replace('.fits', '_det{:02d}_sci.fits'.format(self.det))
-            sci_fits_list.append(sci_fits_file)
+        sci_fits_list, = self.derived_paths(scifiles, 'sci')
 
         defringing(sci_fits_list, self.masterfringeimg)
 
@@ -1,6 +1,4 @@
 import numpy as np
-from matplotlib import gridspec
-import matplotlib.pyplot as plt
 from scipy.interpolate import UnivariateSpline
 
 from astropy import stats
@@ -40,6 +38,7 @@ def buildPSF(table, image, size=51, oversampling=4.0, sigclip=5, maxiters=10, sh
         ndarray: mask of cosmic rays (0=no CR, 1=CR)
 
     '''
+    import matplotlib.pyplot as plt
 
     if isinstance(image, str):
         head, data, flag = io.load_fits(image)
@@ -223,6 +222,8 @@ def buildPSF(table, image, size=51, oversampling=4.0, sigclip=5, maxiters=10, sh
 
 def growth_curve(table, image, min_max=[0.,8.0], dr=0.2, rmsimage=None, flagimage=None,
                  effective_gain=None, sigclip=5, maxiters=10, outroot=None):
+    from matplotlib import gridspec
+    import matplotlib.pyplot as plt
 
     if isinstance(table, str):
         ## ToDo: distinguish SExtractor catalog from photutils catalog
@@ -6,6 +6,9 @@ Modified from PyPeIt.
 import time
 import os
 import numpy as np
+
+import multiprocessing
+from multiprocessing import Process, Queue
 from astropy.io import fits
 from astropy.table import Table
 
@@ -93,7 +96,7 @@ class PyPhot(object):
 
         #   - Build the full set, merging with any user-provided
         #     parameters
-        self.par = PyPhotPar.from_cfg_lines(cfg_lines=camera_cfg_lines, merge_with=cfg_lines)
+        self.par = PyPhotPar.from_cfg_lines(cfg_lines=camera_cfg_lines, merge_with=cfg)
         msgs.info('Built full PyPhot parameter set.')
 
         # Check the output paths are ready
@@ -123,14 +126,9 @@ class PyPhot(object):
         # Set paths
         self.calibrations_path = os.path.join(self.par['rdx']['redux_path'], self.par['calibrations']['master_dir'])
 
-        if self.qa_path is not None and not os.path.isdir(self.qa_path):
-            os.makedirs(self.qa_path)
-        if self.calibrations_path is not None and not os.path.isdir(self.calibrations_path):
-            os.makedirs(self.calibrations_path)
-        if self.science_path is not None and not os.path.isdir(self.science_path):
-            os.makedirs(self.science_path)
-        if self.coadd_path is not None and not os.path.isdir(self.coadd_path):
-            os.makedirs(self.coadd_path)
+        for path in [self.qa_path, self.calibrations_path, self.science_path, self.coadd_path]:
+            if path is not None:
+                os.makedirs(path, exist_ok=True)
 
         # Report paths
         msgs.info('Setting reduction path to {0}'.format(self.par['rdx']['redux_path']))
@@ -170,7 +168,7 @@ class PyPhot(object):
         """
         # Validate the parameter set
         self.par.validate_keys(required=['rdx', 'calibrations', 'scienceframe', 'postproc'])
-        self.tstart = time.time()
+        self.tstart = time.monotonic()
 
         # Find the standard frames
         is_standard = self.fitstbl.find_frames('standard')
@@ -198,6 +196,8 @@ class PyPhot(object):
 
         # Frame indices
         frame_indx = np.arange(len(self.fitstbl))
+        # Full paths of all the frames, the per group file lists below index into it
+        all_paths = np.array(self.fitstbl.frame_paths(frame_indx))
 
         # Find the detectors to reduce
         detectors = PyPhot.select_detectors(detnum=self.par['rdx']['detnum'],
@@ -215,59 +215,70 @@ class PyPhot(object):
         #           - Coadd images according to coadd_ids
         #           - Generate source catalogs
 
+        # Frames that need detproc, and both detproc and sciproc. These do not depend on
+        # the calibration group, so they are combined only once.
+        is_proc = is_science | is_supersky | is_fringe
+        is_sciproc = is_science | is_fringe
+
+        # The processed detector shape only depends on the setup, so it is read from disk
+        # once per setup and detector rather than once per calibration group.
+        raw_shape_cache = {}
+
         ## Step one and two are iterate over n_calib_groups
         for i in range(self.fitstbl.n_calib_groups):
             # Find all the frames in this calibration group
             in_grp = self.fitstbl.find_calib_group(i)
-            in_grp_sci = is_science & in_grp
-            in_grp_supersky = is_supersky & in_grp
-            in_grp_fringe = is_fringe & in_grp
 
-            if np.sum(in_grp)<1:
+            if not in_grp.any():
                 msgs.info('No frames found for the {:}th calibration group, skipping.'.format(i))
             else:
-                this_setup = self.fitstbl[in_grp]['setup'][0]
-                # Find the indices of the science frames in this calibration group:
+                # Find the indices of the science frames in this calibration group. The frame types
+                # are only looked up for the frames of the group rather than masked over the whole table.
                 grp_all = frame_indx[in_grp] # science only
-                grp_science = frame_indx[in_grp_sci] # science only
-                grp_proc = frame_indx[in_grp_sci | in_grp_supersky | in_grp_fringe] # need run detproc
-                grp_supersky = frame_indx[in_grp_supersky] # supersky
-                grp_fringe = frame_indx[in_grp_fringe] # fringe
-                grp_sciproc = frame_indx[in_grp_sci | in_grp_fringe] # need run both detproc and sciproc
+                grp_science = grp_all[is_science[grp_all]] # science only
+                grp_proc = grp_all[is_proc[grp_all]] # need run detproc
+                grp_supersky = grp_all[is_supersky[grp_all]] # supersky
+                grp_fringe = grp_all[is_fringe[grp_all]] # fringe
+                grp_sciproc = grp_all[is_sciproc[grp_all]] # need run both detproc and sciproc
+                # index the column rather than the table, which would copy every column of the group
+                this_setup = self.fitstbl['setup'][grp_all[0]]
 
-                allfiles = self.fitstbl.frame_paths(grp_all)  # list for all files in this grp
+                allfiles = all_paths[grp_all].tolist()  # list for all files in this grp
 
                 # science file lists
-                scifiles = self.fitstbl.frame_paths(grp_science)  # list for scifiles
+                scifiles = all_paths[grp_science].tolist()  # list for scifiles
 
                 # calibration file lists
-                grp_bias = frame_indx[is_bias & in_grp]
-                biasfiles = self.fitstbl.frame_paths(grp_bias)
+                grp_bias = grp_all[is_bias[grp_all]]
+                biasfiles = all_paths[grp_bias].tolist()
 
-                grp_dark = frame_indx[is_dark & in_grp]
-                darkfiles = self.fitstbl.frame_paths(grp_dark)
+                grp_dark = grp_all[is_dark[grp_all]]
+                darkfiles = all_paths[grp_dark].tolist()
 
-                grp_illumflat = frame_indx[is_illumflat & in_grp]
-                illumflatfiles = self.fitstbl.frame_paths(grp_illumflat)
+                grp_illumflat = grp_all[is_illumflat[grp_all]]
+                illumflatfiles = all_paths[grp_illumflat].tolist()
 
-                grp_pixflat = frame_indx[is_pixflat & in_grp]
-                pixflatfiles = self.fitstbl.frame_paths(grp_pixflat)
+                grp_pixflat = grp_all[is_pixflat[grp_all]]
+                pixflatfiles = all_paths[grp_pixflat].tolist()
 
-                superskyfiles = self.fitstbl.frame_paths(grp_supersky) # supersky files
-                fringefiles = self.fitstbl.frame_paths(in_grp_fringe) # Fringe files
+                superskyfiles = all_paths[grp_supersky].tolist() # supersky files
+                fringefiles = all_paths[grp_fringe].tolist() # Fringe files
 
                 # proc file lists
-                procfiles = self.fitstbl.frame_paths(grp_proc)  # need run detproc
-                proc_airmass = self.fitstbl[grp_proc]['airmass']
+                procfiles = all_paths[grp_proc].tolist()  # need run detproc
 
-                sciprocfiles = self.fitstbl.frame_paths(grp_sciproc)  # need run both detproc and sciproc
-                sciproc_airmass = self.fitstbl[grp_sciproc]['airmass']
+                sciprocfiles = all_paths[grp_sciproc].tolist()  # need run both detproc and sciproc
+                sciproc_airmass = self.fitstbl['airmass'][grp_sciproc]
 
+                # only the shape of the bpm is needed, so it is not cast to bool
                 master_keys = []
                 raw_shapes = []
                 for ii, idet in enumerate(detectors):
                     master_key = self.fitstbl.master_key(grp_all[0], det=idet)
-                    raw_shape = self.camera.bpm(allfiles[0], idet, shape=None, msbias=None).astype('bool').shape
+                    if (this_setup, idet) not in raw_shape_cache:
+                        raw_shape_cache[(this_setup, idet)] = self.camera.bpm(allfiles[0], idet, shape=None,
+                                                                              msbias=None).shape
+                    raw_shape = raw_shape_cache[(this_setup, idet)]
                     master_keys.append(master_key)
                     raw_shapes.append(raw_shape)
 
@@ -281,48 +292,48 @@ class PyPhot(object):
                     if len(detectors)>1:
                         masterframe.rescale_flat(self.camera, self.par, detectors, master_keys, raw_shapes)
 
-                if np.sum(in_grp_sci) > 0:
+                if grp_science.size > 0:
                     ## Data processing, including detproc and sciproc
-                    ## Loop over detectors for detproc and sciproc
-                    for ii, idet in enumerate(detectors):
-                        master_key = master_keys[ii]
-                        raw_shape = raw_shapes[ii]
-                        ## Load master files
-                        Master = masterframe.MasterFrames(self.par, self.camera, idet, master_key, raw_shape,
-                                                          reuse_masters=self.reuse_masters)
-                        masterbiasimg, masterdarkimg, masterillumflatimg, masterpixflatimg, bpm_proc,\
-                            norm_illum, norm_pixel = Master.load()
-
-                        ## Initialize ImageProc
-                        Proc = procimg.ImageProc(self.par, self.camera, idet, self.science_path, master_key, raw_shape,
-                                                 reuse_masters=self.reuse_masters, overwrite=self.overwrite)
-
-                        ## DETPROC -- bias, dark subtraction and flat fielding, support parallel processing
-                        if not self.par['rdx']['skip_detproc']:
-                            Proc.run_detproc(procfiles, masterbiasimg, masterdarkimg,
-                                             masterpixflatimg, masterillumflatimg, bpm_proc)
-
-                        ## SCIPROC -- supersky flattening, extinction correction based on airmass, and background subtraction.
-                        if not self.par['rdx']['skip_sciproc']:
-
-                            ## Build SuperSkyFlat first
-                            if self.par['scienceframe']['process']['use_supersky']:
-                                Proc.build_supersky(superskyfiles)
-
-                            ## Run sciproc
-                            Proc.run_sciproc(sciprocfiles, sciproc_airmass)
-
-                            ## Build Master Fringing and Defringing
-                            if self.par['scienceframe']['process']['use_fringe']:
-                                Proc.build_fringe(fringefiles)
-                                # Defringing
-                                Proc.run_defringing(scifiles)
+                    ## Detectors are independent, so they are processed in parallel and the n_process
+                    ## budget is shared between the detectors and the exposures of each detector.
+                    n_process = self.par['rdx']['n_process']
+                    n_det_process = min(n_process, len(detectors), multiprocessing.cpu_count())
+                    proc_kwargs = {'par': self.par, 'camera': self.camera, 'science_path': self.science_path,
+                                   'procfiles': procfiles, 'sciprocfiles': sciprocfiles,
+                                   'sciproc_airmass': sciproc_airmass, 'superskyfiles': superskyfiles,
+                                   'fringefiles': fringefiles, 'scifiles': scifiles,
+                                   'n_process': max(1, n_process // max(1, n_det_process)),
+                                   'reuse_masters': self.reuse_masters, 'overwrite': self.overwrite}
+                    if n_det_process <= 1:
+                        for ii, idet in enumerate(detectors):
+                            _reduce_detector(idet, master_keys[ii], raw_shapes[ii], **proc_kwargs)
+                    else:
+                        msgs.info('Processing {:} detectors with n_process={:}'.format(len(detectors), n_det_process))
+                        work_queue = Queue()
+                        processes = []
+                        for ii, idet in enumerate(detectors):
+                            work_queue.put((idet, master_keys[ii], raw_shapes[ii]))
+                        # one sentinel per worker
+                        for w in range(n_det_process):
+                            work_queue.put(None)
+                        # creating processes
+                        for w in range(n_det_process):
+                            p = Process(target=_reduce_detector_worker, args=(work_queue,), kwargs=proc_kwargs)
+                            processes.append(p)
+                            p.start()
+
+                        # completing process, a failed detector would otherwise only show up
+                        # as missing files in the post processing
+                        for p in processes:
+                            p.join()
+                        if any(p.exitcode != 0 for p in processes):
+                            msgs.error('Processing failed for at least one detector in the {:}th calibration group.'.format(i))
                 else:
                     msgs.info('No science images for the {:}th calibration group.'.format(i))
 
         ## Step three is iterated over coadd_ids
         # prepare some useful lists
-        scifiles = self.fitstbl.frame_paths(is_science)  # list for scifiles
+        scifiles = all_paths[is_science].tolist()  # list for scifiles
         sci_airmass = self.fitstbl['airmass'][is_science]
         sci_exptime = self.fitstbl['exptime'][is_science]
         sci_filter = self.fitstbl['filter'][is_science]
@@ -386,7 +397,11 @@ class PyPhot(object):
 
         """
         if detnum is None:
-            return np.arange(1, ndet+1).tolist()
+            return list(range(1, ndet+1))
+        elif isinstance(detnum, int):
+            return [detnum]
+        elif isinstance(detnum, (list, tuple)):
+            return list(detnum)
         else:
             return np.atleast_1d(detnum).tolist()
 
@@ -404,22 +419,74 @@ class PyPhot(object):
         Print the elapsed time
         """
         # Capture the end time and print it to user
-        tend = time.time()
+        tend = time.monotonic()
         codetime = tend-self.tstart
-        if codetime < 60.0:
-            msgs.info('Execution time: {0:.2f}s'.format(codetime))
-        elif codetime/60.0 < 60.0:
-            mns = int(codetime/60.0)
-            scs = codetime - 60.0*mns
-            msgs.info('Execution time: {0:d}m {1:.2f}s'.format(mns, scs))
+        hrs, rem = divmod(codetime, 3600.0)
+        mns, scs = divmod(rem, 60.0)
+        hrs, mns = int(hrs), int(mns)
+        if hrs > 0:
+            msgs.info('Execution time: %dh %dm %.2fs', hrs, mns, scs)
+        elif mns > 0:
+            msgs.info('Execution time: %dm %.2fs', mns, scs)
         else:
-            hrs = int(codetime/3600.0)
-            mns = int(60.0*(codetime/3600.0 - hrs))
-            scs = codetime - 60.0*mns - 3600.0*hrs
-            msgs.info('Execution time: {0:d}h {1:d}m {2:.2f}s'.format(hrs, mns, scs))
+            msgs.info('Execution time: %.2fs', scs)
 
     def __repr__(self):
         # Generate sets string
-        return '<{:s}: pyphot_file={}>'.format(self.__class__.__name__, self.pyphot_file)
+        return '<{0}: pyphot_file={1}>'.format(type(self).__name__, self.pyphot_file)
 
 
+def _reduce_detector(idet, master_key, raw_shape, par=None, camera=None, science_path=None, procfiles=None,
+                     sciprocfiles=None, sciproc_airmass=None, superskyfiles=None, fringefiles=None, scifiles=None,
+                     n_process=1, reuse_masters=False, overwrite=True):
+    """
+    Run detproc and sciproc (including supersky and fringe) for a single detector.
+    """
+    ## Initialize ImageProc
+    Proc = procimg.ImageProc(par, camera, idet, science_path, master_key, raw_shape,
+                             reuse_masters=reuse_masters, overwrite=overwrite)
+    Proc.n_process = n_process
+
+    ## Nothing to do if all the products exist and are not overwritten, so the masters are not loaded.
+    ## Defringing works in place on the sciproc products, so it always needs the masters.
+    if not overwrite and not par['scienceframe']['process']['use_fringe']:
+        products = []
+        if not par['rdx']['skip_detproc']:
+            products += Proc.derived_paths(procfiles, 'proc')[0]
+        if not par['rdx']['skip_sciproc']:
+            products += Proc.derived_paths(sciprocfiles, 'sci')[0]
+        existing = set(os.listdir(science_path))
+        if all(os.path.basename(product) in existing for product in products):
+            msgs.info('All the products of detector {:} exist, skipping...'.format(idet))
+            return
+
+    ## Load master files
+    Master = masterframe.MasterFrames(par, camera, idet, master_key, raw_shape, reuse_masters=reuse_masters)
+    masterbiasimg, masterdarkimg, masterillumflatimg, masterpixflatimg, bpm_proc,\
+        norm_illum, norm_pixel = Master.load()
+
+    ## DETPROC -- bias, dark subtraction and flat fielding, support parallel processing
+    if not par['rdx']['skip_detproc']:
+        Proc.run_detproc(procfiles, masterbiasimg, masterdarkimg,
+                         masterpixflatimg, masterillumflatimg, bpm_proc)
+
+    ## SCIPROC -- supersky flattening, extinction correction based on airmass, and background subtraction.
+    if not par['rdx']['skip_sciproc']:
+
+        ## Build SuperSkyFlat first
+        if par['scienceframe']['process']['use_supersky']:
+            Proc.build_supersky(superskyfiles)
+
+        ## Run sciproc
+        Proc.run_sciproc(sciprocfiles, sciproc_airmass)
+
+        ## Build Master Fringing and Defringing
+        if par['scienceframe']['process']['use_fringe']:
+            Proc.build_fringe(fringefiles)
+            # Defringing
+            Proc.run_defringing(scifiles)
+
+def _reduce_detector_worker(work_queue, **kwargs):
+    """Multiprocessing worker for _reduce_detector, stops at the None sentinel."""
+    for idet, master_key, raw_shape in iter(work_queue.get, None):
+        _reduce_detector(idet, master_key, raw_shape, **kwargs)
@@ -10,6 +10,8 @@ import numpy as np
 
 from astropy.table import Table
 
+from configobj import ConfigObj
+
 from pyphot import msgs
 from pyphot.metadata import PyPhotMetaData
 
@@ -120,9 +122,10 @@ class PyPhotSetup:
         self.pyphot_file = pyphot_file
         self.user_cfg = cfg_lines
 
-        # Determine the camera name
-        _camera_name = camera_name if cfg_lines is None \
-                    else PyPhotPar.from_cfg_lines(merge_with=cfg_lines)['rdx']['camera']
+        # Determine the camera name; only the user lines are parsed here,
+        # the full parameter set is built once below
+        cfg = None if cfg_lines is None else ConfigObj(cfg_lines)
+        _camera_name = camera_name if cfg is None else cfg.get('rdx', {}).get('camera')
 
         # Cannot proceed without camera name
         if _camera_name is None:
@@ -137,7 +140,7 @@ class PyPhotSetup:
 
         # Instantiate the pyphot parameters.  The user input
         # configuration (cfg_lines) can be None.
-        self.par = PyPhotPar.from_cfg_lines(cfg_lines=camera_cfg_lines, merge_with=cfg_lines)
+        self.par = PyPhotPar.from_cfg_lines(cfg_lines=camera_cfg_lines, merge_with=cfg)
 
         # Prepare internals for execution
         self.fitstbl = None
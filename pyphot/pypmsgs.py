@@ -101,10 +101,17 @@ class Messages:
             devmsg = ''
         return devmsg
 
-    def _print(self, premsg, msg, last=True):
+    def _print(self, premsg, msg, *args, last=True):
         """
         Print to standard error and the log file
+
+        Any args are %-interpolated into msg, which is only done when the
+        message is actually printed or logged.
         """
+        if self._verbosity == 0 and not self._log:
+            return
+        if args:
+            msg = msg % args
         devmsg = self._devmsg()
         _msg = premsg+devmsg+msg
         if self._verbosity != 0:
@@ -152,10 +159,12 @@ class Messages:
             self._log = None
         self._initialize_log_file(log=log)
 
-    def error(self, msg, usage=False):
+    def error(self, msg, *args, usage=False):
         """
         Print an error message
         """
+        if args:
+            msg = msg % args
         premsg = '\n'+self._start + self._white_RD + '[ERROR]   ::' + self._end + ' '
         self._print(premsg, msg)
 
@@ -170,43 +179,43 @@ class Messages:
         raise PyquasarError(msg)
         sys.exit(1)
 
-    def info(self, msg):
+    def info(self, msg, *args):
         """
         Print an information message
         """
         premsg = self._start + self._green_CL + '[INFO]    ::' + self._end + ' '
-        self._print(premsg, msg)
+        self._print(premsg, msg, *args)
 
-    def info_update(self, msg, last=False):
+    def info_update(self, msg, *args, last=False):
         """
         Print an information message that needs to be updated
         """
         premsg = '\r' + self._start + self._green_CL + '[INFO]    ::' + self._end + ' '
-        self._print(premsg, msg, last=last)
+        self._print(premsg, msg, *args, last=last)
 
-    def test(self, msg):
+    def test(self, msg, *args):
         """
         Print a test message
         """
         if self._verbosity == 2:
             premsg = self._start + self._white_BL + '[TEST]    ::' + self._end + ' '
-            self._print(premsg, msg)
+            self._print(premsg, msg, *args)
 
-    def warn(self, msg):
+    def warn(self, msg, *args):
         """
         Print a warning message
         """
         premsg = self._start + self._red_CL + '[WARNING] ::' + self._end + ' '
-        self._print(premsg, msg)
+        self._print(premsg, msg, *args)
 
-    def bug(self, msg):
+    def bug(self, msg, *args):
         """
         Print a bug message
         """
         premsg = self._start + self._white_BK + '[BUG]     ::' + self._end + ' '
-        self._print(premsg, msg)
+        self._print(premsg, msg, *args)
 
-    def work(self, msg):
+    def work(self, msg, *args):
         """
         Print a work in progress message
         """
@@ -214,14 +223,14 @@ class Messages:
             #premsgp = self._start + self._black_CL + '[WORK IN ]::' + self._end + '\n'
             premsgs = self._start + self._yellow_CL + '[PROGRESS]::' + self._end + ' '
             #self._print(premsgp+premsgs, msg)
-            self._print(premsgs, msg)
+            self._print(premsgs, msg, *args)
 
-    def prindent(self, msg):
+    def prindent(self, msg, *args):
         """
         Print an indent
         """
         premsg = '             '
-        self._print(premsg, msg)
+        self._print(premsg, msg, *args)
 
     def input(self):
         """
@@ -2,24 +2,55 @@
 ToDo: Improve it and change to a class
 """
 
-import os,re,subprocess
+import os,re,sys,shlex,shutil,subprocess,tempfile,resource
+from functools import lru_cache
+
+import multiprocessing
+from multiprocessing import Process, Queue
 
 from pyphot import msgs
 from pkg_resources import resource_filename
 config_dir = resource_filename('pyphot', '/config/')
 
+# matched against the raw banner SCAMP prints to stderr
+_VERSION_RE = re.compile(rb"[Vv]ersion (\d+(?:\.\d+)*)")
+
+# get_config strips the spaces of the values and puts these output catalogs into workdir
+_NOSPACE = str.maketrans('', '', ' ')
+_OUTCAT_KEYS = frozenset(("MERGEDOUTCAT_NAME", "FULLOUTCAT_NAME"))
+
+@lru_cache(maxsize=1)
 def get_version():
     """
-    To find the SCAMP version
+    To find the SCAMP version, the executable is only called once
     returns: a string (e.g. '2.4.4')
     """
-    v = subprocess.Popen("scamp", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = v.communicate()
-    version_match = re.search("[Vv]ersion ([0-9\.])+", err.decode("utf-8"))
-    version = str(version_match.group()[8:])
+    # only read stderr up to the line with the version rather than the whole usage text
+    v = subprocess.Popen("scamp", stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    version_match = None
+    with v.stderr:
+        for line in v.stderr:
+            version_match = _VERSION_RE.search(line)
+            if version_match is not None:
+                break
+    v.wait()
+    version = version_match.group(1).decode("ascii")
     return version
 
 
+@lru_cache(maxsize=1)
+def _spawn_kwargs():
+    """
+    Popen arguments that let subprocess start SCAMP with posix_spawn rather than fork+exec, which
+    needs the full path of the executable and close_fds=False (file descriptors opened by Python are
+    not inheritable anyway). This avoids copying the page tables of a large parent process.
+    """
+    executable = shutil.which("scamp")
+    if executable is None:
+        return {}
+    return {'executable': executable, 'close_fds': False}
+
+
 def get_default_config(defaultconfig='pyphot', workdir='./', outroot='pyphot', verbose=True):
     """
     To get the default SCAMP configuration file
@@ -28,17 +59,16 @@ def get_default_config(defaultconfig='pyphot', workdir='./', outroot='pyphot', v
     if defaultconfig == "scamp":
         p = subprocess.Popen(["scamp", "-d"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         out, err = p.communicate()
-        f = open(os.path.join(workdir, outroot+"_config.scamp"), "w")
-        f.write(out)
-        f.close()
+        with open(os.path.join(workdir, outroot+"_config.scamp"), "wb") as f:
+            f.write(out)
         if verbose:
             msgs.info("config.scamp generated from Scamp default configuration")
     elif defaultconfig == "pyphot":
-        os.system("cp " + os.path.join(config_dir,"scamp.config") + ' ' + os.path.join(workdir, outroot+"_config.scamp"))
+        shutil.copyfile(os.path.join(config_dir,"scamp.config"), os.path.join(workdir, outroot+"_config.scamp"))
         if verbose:
             msgs.info("config.scamp generated from PyPhot default configuration")
     else:
-        os.system("cp " + defaultconfig + ' ' + os.path.join(workdir, outroot+"_config.scamp"))
+        shutil.copyfile(defaultconfig, os.path.join(workdir, outroot+"_config.scamp"))
         if verbose:
             msgs.info("Using user provided configuration for Scamp")
 
@@ -52,24 +82,35 @@ def get_config(config=None, workdir="./"):
                      "MAGZERO_OUT":24.5,"ASTREFMAG_LIMITS":"10,30"}
     """
     if config is None:
-        configapp = []
-    else:
-        configapp = []
+        return []
+    # the output catalogs go to workdir, the input config itself is left untouched
+    return [arg for (key, value) in config.items()
+            for arg in ("-" + str(key),
+                        str(os.path.join(workdir, value) if key in _OUTCAT_KEYS else value).translate(_NOSPACE))]
 
-        if "MERGEDOUTCAT_NAME" in config:
-            config["MERGEDOUTCAT_NAME"] = os.path.join(workdir, config["MERGEDOUTCAT_NAME"])
-        if "FULLOUTCAT_NAME" in config:
-            config["FULLOUTCAT_NAME"] = os.path.join(workdir, config["FULLOUTCAT_NAME"])
 
-        for (key, value) in config.items():
-            configapp.append("-" + str(key))
-            configapp.append(str(value).replace(' ', ''))
+def get_command(input, catroot, configcomd, config=None, QAdir='./'):
+    """
+    Build the SCAMP command line without running it, e.g. to hand the runs over to an external
+    workflow manager. input is the catalog path (or an @list), catroot names the check plots and
+    configcomd comes from get_default_config. The caller's config is never modified.
+    """
+    this_config = config if config is not None else {}
+    if 'CHECKPLOT_NAME' in this_config:
+        # the plots are named after the catalog, only the file name (not QAdir) has its dots replaced
+        plotroot = os.path.basename(catroot)
+        checkplot_name = ','.join(
+            os.path.join(QAdir, '{:}_{:}'.format(plotroot, iname).replace('.','_').replace('_cat',''))
+            for iname in this_config['CHECKPLOT_NAME'].split(','))
+        this_config = dict(this_config, CHECKPLOT_NAME=checkplot_name)
 
-    return configapp
+    configapp = get_config(config=this_config)
+
+    return ["scamp"] + [input] + configcomd + configapp
 
 
 def scampone(catname, config=None, workdir='./', QAdir='./', defaultconfig='pyphot',
-             group=False, delete=True, log=False, verbose=True):
+             group=False, delete=True, log=False, verbose=True, configcomd=None):
 
     if verbose:
         ## Get the version of your SCAMP
@@ -88,47 +129,78 @@ def scampone(catname, config=None, workdir='./', QAdir='./', defaultconfig='pyph
         catroot = catname.replace('.fits', '')
         input = os.path.join(workdir, catname)
 
-    ## Generate the configuration file
-    configcomd = get_default_config(defaultconfig=defaultconfig, workdir=workdir, outroot=catroot, verbose=verbose)
+    ## Generate the configuration file, unless the caller shares one between catalogs
+    if configcomd is None:
+        configcomd = get_default_config(defaultconfig=defaultconfig, workdir=workdir, outroot=catroot, verbose=verbose)
+
+    comd = get_command(input, catroot, configcomd, config=config, QAdir=QAdir)
 
-    if config is not None:
-        this_config = config.copy()  # need to copy this since the config would be possibly changed!
+    # The console output of SCAMP goes straight into the log file, or is discarded, instead of
+    # being buffered in memory.
+    log_path = os.path.join(workdir, catroot+".scamp.log")
+    if log:
+        with open(log_path, "w") as logfile:
+            # the command is quoted so that it can be pasted back into a shell
+            logfile.write("SCAMP was called with :\n{:}\n\n####### stdout and stderr #######\n".format(shlex.join(comd)))
+            logfile.flush()
+            result = subprocess.run(comd, stdout=logfile, stderr=subprocess.STDOUT, **_spawn_kwargs())
     else:
-        this_config = None
+        result = subprocess.run(comd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **_spawn_kwargs())
+    if delete:
+        # a single directory scan, matching the names directly so that glob characters in them are harmless
+        scratch_dir, scratch_root = os.path.split(os.path.join(workdir, catroot))
+        for entry in os.scandir(scratch_dir or '.'):
+            if entry.name.startswith(scratch_root) and entry.name.endswith('.scamp'):
+                os.remove(entry.path)
+        if group:
+            os.remove(catlist)
 
-    ## append your configuration
-    if 'CHECKPLOT_NAME' in this_config:
-        checkplot_name = this_config['CHECKPLOT_NAME'].split(',')
-        checkplot_name_new = []
-        for iname in checkplot_name:
-            tmp = os.path.join(QAdir,'{:}_{:}'.format(os.path.split(catroot)[1],iname))
-            checkplot_name_new.append(tmp.replace('.','_').replace('_cat',''))
-        separator = ','
-        this_config['CHECKPLOT_NAME'] = separator.join(checkplot_name_new)
+    # fail here rather than leaving the later steps without .head files
+    if result.returncode != 0:
+        if log:
+            msgs.error('SCAMP failed on {:} with exit code {:}, see {:}'.format(input, result.returncode, log_path))
+        else:
+            msgs.error('SCAMP failed on {:} with exit code {:}, run with log=True for its output'.format(
+                input, result.returncode))
+    if verbose:
+        msgs.info("Header files are generated in {:}".format(workdir))
+        if log:
+            msgs.info("Processing log generated: " + log_path)
 
-    configapp = get_config(config=this_config)
+def _scampone_worker(work_queue, config=None, workdir='./', QAdir='./', defaultconfig='pyphot',
+                     delete=True, log=False, verbose=True, configcomd=None):
 
-    comd = ["scamp"] + [input] + configcomd + configapp
+    """Multiprocessing worker for scampone, stops at the None sentinel."""
 
-    p = subprocess.Popen(comd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    if verbose:
-        msgs.info("Header files are generated in {:}".format(workdir))
+    for catname in iter(work_queue.get, None):
+        scampone(catname, config=config, workdir=workdir, QAdir=QAdir, defaultconfig=defaultconfig,
+                 delete=delete, log=log, group=False, verbose=verbose, configcomd=configcomd)
 
-    if log:
-        logfile = open(os.path.join(workdir, catroot+".scamp.log"), "w")
-        logfile.write("SCAMP was called with :\n")
-        logfile.write(" ".join(comd))
-        logfile.write("\n\n####### stdout #######\n")
-        logfile.write(out.decode("utf-8"))
-        logfile.write("\n####### stderr #######\n")
-        logfile.write(err.decode("utf-8"))
-        logfile.write("\n")
-        logfile.close()
-        if verbose:
-            msgs.info("Processing log generated: " + os.path.join(workdir, catroot+".scamp.log"))
-    if delete:
-        os.system("rm " + os.path.join(workdir, catroot+"*.scamp"))
+def _scampone_probe(result_queue, catname, **kwargs):
+
+    """Run scampone in a fresh process and report the peak memory of SCAMP in bytes."""
+
+    scampone(catname, group=False, **kwargs)
+    # the only child of this process is SCAMP, ru_maxrss is in kilobytes except on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    result_queue.put(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+def _free_memory():
+
+    """Available physical memory in bytes, None where the system does not report it."""
+
+    # MemAvailable counts the reclaimable page cache, SC_AVPHYS_PAGES is only MemFree
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
 
 def run_scamp(catlist, config=None, workdir='./', QAdir='./', defaultconfig='pyphot', n_process=4,
               group=False, delete=False, log=True, verbose=False):
@@ -137,9 +209,79 @@ def run_scamp(catlist, config=None, workdir='./', QAdir='./', defaultconfig='pyp
         msgs.info('Refine the astrometric solution with SCAMP by groups.')
         scampone(catlist, config=config, workdir=workdir, QAdir=QAdir, defaultconfig=defaultconfig,
                  delete=delete, log=log, group=True, verbose=verbose)
-    else:
-        # ToDo: parallel the following
-        for catname in catlist:
-            msgs.info('Refine the astrometric solution with SCAMP one by one.')
-            scampone(catname, config=config, workdir=workdir, QAdir=QAdir, defaultconfig=defaultconfig,
-                     delete=delete, log=log, group=False, verbose=verbose)
+        return
+
+    n_file = len(catlist)
+    n_cpu = multiprocessing.cpu_count()
+
+    if n_process > n_cpu:
+        n_process = n_cpu
+
+    if n_process>n_file:
+        n_process = n_file
+
+    msgs.info('Refine the astrometric solution with SCAMP one by one.')
+    # The default configuration is the same for every catalog, so it is written once for the whole
+    # list into a scratch directory rather than copied next to each catalog.
+    with tempfile.TemporaryDirectory(prefix='pyphot_scamp_') as config_tmpdir:
+        configcomd = get_default_config(defaultconfig=defaultconfig, workdir=config_tmpdir, outroot='pyphot',
+                                        verbose=verbose)
+        if n_process <= 1:
+            for catname in catlist:
+                scampone(catname, config=config, workdir=workdir, QAdir=QAdir, defaultconfig=defaultconfig,
+                         delete=delete, log=log, group=False, verbose=verbose, configcomd=configcomd)
+        else:
+            # the SCAMP runs of individual catalogs are independent of each other
+            scamp_kwargs = {'config': config, 'workdir': workdir, 'QAdir': QAdir, 'defaultconfig': defaultconfig,
+                            'delete': delete, 'log': log, 'verbose': verbose, 'configcomd': configcomd}
+
+            work_queue = Queue()
+            processes = []
+
+            # SCAMP holds the reference catalogs in memory. With more than two runs, the first catalog is
+            # solved in a probe process to measure what one run needs, and the parallel runs are capped to
+            # what fits in the available memory. One ordinary worker runs next to the probe, two runs at a
+            # time is what n_process=2 does without any probe.
+            free_memory = _free_memory()
+            if free_memory is not None and n_process > 2:
+                probe_queue = Queue()
+                probe = Process(target=_scampone_probe, args=(probe_queue, catlist[0]), kwargs=scamp_kwargs)
+                probe.start()
+                for catname in catlist[1:]:
+                    work_queue.put(catname)
+                p = Process(target=_scampone_worker, args=(work_queue,), kwargs=scamp_kwargs)
+                processes.append(p)
+                p.start()
+
+                probe.join()
+                if probe.exitcode != 0:
+                    p.terminate()
+                    msgs.error('SCAMP failed for {:}.'.format(catlist[0]))
+                peak_memory = probe_queue.get()
+                if peak_memory > 0:
+                    n_mem = max(int(free_memory // peak_memory), 1)
+                    if n_mem < n_process:
+                        msgs.warn('One SCAMP run needs {:0.1f} GB, only {:} of them fit in the available memory.'.format(
+                            peak_memory / 1024**3, n_mem))
+                        n_process = n_mem
+                n_process = max(min(n_process, n_file - 1), 1)
+            else:
+                for catname in catlist:
+                    work_queue.put(catname)
+
+            msgs.info('Start parallel processing with n_process={:}'.format(n_process))
+            # one sentinel per worker
+            for w in range(n_process):
+                work_queue.put(None)
+
+            # creating processes
+            for w in range(len(processes), n_process):
+                p = Process(target=_scampone_worker, args=(work_queue,), kwargs=scamp_kwargs)
+                processes.append(p)
+                p.start()
+
+            # completing process
+            for p in processes:
+                p.join()
+            if any(p.exitcode != 0 for p in processes):
+                msgs.error('SCAMP failed for at least one catalog.')
@@ -83,8 +83,6 @@ def colorterm(filter, primary, secondary, show=True, path=None):
         plt.plot(xx, yy,'k.')
         plt.plot(xx, func(xx,popt[0],popt[1]))
         plt.show()
-    from IPython import embed
-    embed()
 
 def parse_args(options=None, return_parser=False):
     import argparse
@@ -2,8 +2,9 @@
 ToDo: Improve it and change to a class
 """
 
-import os,re,subprocess
+import os,re,glob,shutil,subprocess
 import numpy as np
+from functools import lru_cache
 
 import multiprocessing
 from multiprocessing import Process, Queue
@@ -12,6 +13,9 @@ from pyphot import msgs
 from pkg_resources import resource_filename
 config_dir = resource_filename('pyphot', '/config/')
 
+# matched against the raw banner SExtractor prints to stderr
+_VERSION_RE = re.compile(rb"[Vv]ersion (\d+(?:\.\d+)*)")
+
 defaultparams = ['NUMBER','X_IMAGE', 'Y_IMAGE','XWIN_IMAGE','YWIN_IMAGE','ERRAWIN_IMAGE','ERRBWIN_IMAGE',
                  'ERRTHETAWIN_IMAGE','ALPHA_J2000', 'DELTA_J2000','ISOAREAF_IMAGE','ISOAREA_IMAGE','ELLIPTICITY','ELONGATION',
                  'KRON_RADIUS','FWHM_IMAGE','CLASS_STAR','FLAGS',
@@ -20,15 +24,15 @@ defaultparams = ['NUMBER','X_IMAGE', 'Y_IMAGE','XWIN_IMAGE','YWIN_IMAGE','ERRAWI
                  'MAGERR_BEST','FLUX_BEST','FLUXERR_BEST','FLUX_RADIUS','MAG_APER(5)','MAGERR_APER(5)',
                  'FLUX_APER(5)','FLUXERR_APER(5)']
 
+@lru_cache(maxsize=None)
 def get_version(task='sex'):
     """
-    To find the SExtractor version
+    To find the SExtractor version, the executable is only called once per task
     returns: a string (e.g. '2.4.4')
     """
     v = subprocess.Popen(task, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out, err = v.communicate()
-    version_match = re.search("[Vv]ersion ([0-9\.])+", err.decode("utf-8"))
-    version = str(version_match.group()[8:])
+    version = _VERSION_RE.search(err).group(1).decode("ascii")
     return version
 
 
@@ -47,11 +51,11 @@ def get_default_config(task='sex', defaultconfig='pyphot', workdir='./', outroot
             msgs.info("config.sex generated from SExtractor default configuration")
 
     elif defaultconfig == "pyphot":
-        os.system("cp " + os.path.join(config_dir,"sex.config") + ' ' + os.path.join(workdir,outroot+"_config.sex"))
+        shutil.copyfile(os.path.join(config_dir,"sex.config"), os.path.join(workdir,outroot+"_config.sex"))
         if verbose:
             msgs.info("config.sex generated from PyPhot default configuration")
     else:
-        os.system("cp " + defaultconfig + ' ' + os.path.join(workdir,outroot+"_config.sex"))
+        shutil.copyfile(defaultconfig, os.path.join(workdir,outroot+"_config.sex"))
         if verbose:
             msgs.info("Using user provided configuration for SExtractor")
 
@@ -95,9 +99,9 @@ def get_config(config=None, workdir="./", dual=False):
         configapp = []
         for (key, value) in config.items():
             configapp.append("-" + str(key))
-            if (key == 'PHOT_APERTURES') and (np.size(config['PHOT_APERTURES'])>1):
-                separator = ','
-                configapp.append(separator.join(config['PHOT_APERTURES'].astype('str')))
+            if (key == 'PHOT_APERTURES') and not isinstance(value, str):
+                # lists and arrays of any length, including a single aperture
+                configapp.append(','.join(np.atleast_1d(value).astype('str')))
             else:
                 configapp.append(str(value).replace(' ', ''))
 
@@ -109,11 +113,11 @@ def get_nnw(nnw=None, workdir='./', outroot='pyphot', verbose=True):
     To get the default SExtractor configuration file
     """
     if (nnw == None) or (nnw=='sex'):
-        os.system("cp " + os.path.join(config_dir,"sex.nnw") + ' ' + os.path.join(workdir,outroot+"_nnw.sex"))
+        shutil.copyfile(os.path.join(config_dir,"sex.nnw"), os.path.join(workdir,outroot+"_nnw.sex"))
         if verbose:
             msgs.info("nnw.sex generated from PyPhot default NNW")
     else:
-        os.system("cp " + nnw + ' ' + os.path.join(workdir,outroot+"_nnw.sex"))
+        shutil.copyfile(nnw, os.path.join(workdir,outroot+"_nnw.sex"))
         if verbose:
             msgs.info("Using user provided NNW")
 
@@ -126,19 +130,19 @@ def get_conv(conv=None, workdir='./', outroot='pyphot', verbose=True):
     Get the default convolution matrix, if needed.
     """
     if (conv == None) or (conv == "sex"):
-        os.system("cp " + os.path.join(config_dir,"sex.conv") + ' ' + os.path.join(workdir,outroot+"_conv.sex"))
+        shutil.copyfile(os.path.join(config_dir,"sex.conv"), os.path.join(workdir,outroot+"_conv.sex"))
         if verbose:
             msgs.info("conv.sex using 3x3 ``all-ground'' convolution mask with FWHM = 2 pixels")
     elif conv == "sex552":
-        os.system("cp " + os.path.join(config_dir, "gauss_2.0_5x5.conv") + ' ' + os.path.join(workdir, outroot + "_conv.sex"))
+        shutil.copyfile(os.path.join(config_dir, "gauss_2.0_5x5.conv"), os.path.join(workdir, outroot + "_conv.sex"))
         if verbose:
             msgs.info("conv.sex using 5x5 convolution mask of a gaussian PSF with FWHM = 2.0 pixels")
     elif conv == "sex995":
-        os.system("cp " + os.path.join(config_dir, "sex995.conv") + ' ' + os.path.join(workdir, outroot+"_conv.sex"))
+        shutil.copyfile(os.path.join(config_dir, "sex995.conv"), os.path.join(workdir, outroot+"_conv.sex"))
         if verbose:
             msgs.info("conv.sex using 9x9 convolution mask of a gaussian PSF with FWHM = 5.0 pixels")
     else:
-        os.system("cp " + conv + ' ' + os.path.join(workdir,outroot+"_conv.sex"))
+        shutil.copyfile(conv, os.path.join(workdir,outroot+"_conv.sex"))
         if verbose:
             msgs.info("Using user provided conv")
 
@@ -157,7 +161,7 @@ def get_params(params=None, workdir='./', outroot='pyphot', verbose=True):
         f.close()
     else:
         try:
-            os.system("cp " + params +' ' + os.path.join(workdir,outroot+"_params.sex"))
+            shutil.copyfile(params, os.path.join(workdir,outroot+"_params.sex"))
             if verbose:
                 msgs.info("Using user provided params file")
         except:
@@ -241,20 +245,18 @@ def sexone(imgname, catname=None, task='sex', config=None, workdir='./', params=
         if verbose:
             msgs.info("Processing log generated: " + os.path.join(workdir, imgroot+".sex.log"))
     if delete:
-        os.system("rm {:}".format(os.path.join(workdir,imgroot+"*.sex")))
+        for ifile in glob.glob(os.path.join(workdir,imgroot+"*.sex")):
+            os.remove(ifile)
 
 def _sexone_worker(work_queue, task='sex', config=None, workdir='./', params=None, defaultconfig='pyphot',
                    conv=None, nnw=None, dual=False, delete=True, log=False, verbose=True):
 
     """Multiprocessing worker for sexone."""
 
-    if config is not None:
-        this_config = config.copy()  # need to copy this since the config would be possibly changed in sexone!
-    else:
-        this_config = None
-
     while not work_queue.empty():
         imgname, flag_image, weight_image = work_queue.get()
+        # need to copy this for every image since the config would be possibly changed in sexone!
+        this_config = config.copy() if config is not None else None
         sexone(imgname, task=task, config=this_config, workdir=workdir, params=params, defaultconfig=defaultconfig, conv=conv,
                nnw=nnw, dual=dual, flag_image=flag_image, weight_image=weight_image, delete=delete, log=log, verbose=verbose)
 
@@ -2,7 +2,8 @@
 ToDo: Improve it and change to a class
 """
 
-import os, re, subprocess
+import os, re, glob, shutil, subprocess, resource
+from functools import lru_cache
 
 import multiprocessing
 from multiprocessing import Process, Queue
@@ -11,16 +12,19 @@ from pyphot import msgs
 from pkg_resources import resource_filename
 config_dir = resource_filename('pyphot', '/config/')
 
+# matched against the raw banner SWarp prints to stderr
+_VERSION_RE = re.compile(rb"[Vv]ersion (\d+(?:\.\d+)*)")
 
+
+@lru_cache(maxsize=None)
 def get_version():
     """
-    To find the SWARP version
+    To find the SWARP version, the executable is only called once
     returns: a string (e.g. '2.4.4')
     """
     v = subprocess.Popen("swarp", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out, err = v.communicate()
-    version_match = re.search("[Vv]ersion ([0-9\.])+", err.decode("utf-8"))
-    version = str(version_match.group()[8:])
+    version = _VERSION_RE.search(err).group(1).decode("ascii")
     return version
 
 
@@ -38,11 +42,11 @@ def get_default_config(defaultconfig='pyphot', workdir='./', outroot='pyphot', v
         if verbose:
             msgs.info("config.swarp generated from SWarp default configuration")
     elif defaultconfig == "pyphot":
-        os.system("cp " + os.path.join(config_dir,"swarp.config") + ' ' + os.path.join(workdir,outroot+"_config.swarp"))
+        shutil.copyfile(os.path.join(config_dir,"swarp.config"), os.path.join(workdir,outroot+"_config.swarp"))
         if verbose:
             msgs.info("config.swarp generated from PyPhot default configuration")
     else:
-        os.system("cp " + defaultconfig + ' ' + os.path.join(workdir,outroot+"_config.swarp"))
+        shutil.copyfile(defaultconfig, os.path.join(workdir,outroot+"_config.swarp"))
         if verbose:
             msgs.info("Using user provided configuration for SWarp")
 
@@ -104,22 +108,30 @@ def swarpone(imgname, config=None, workdir='./', defaultconfig='pyphot', delete=
         if verbose:
             msgs.info("Processing log generated: " + os.path.join(workdir, imgname[:-5]+".swarp.log"))
     if delete:
-        os.system("rm " + os.path.join(workdir, imgroot+"_*.swarp"))
+        for ifile in glob.glob(os.path.join(workdir, imgroot+"_*.swarp")):
+            os.remove(ifile)
         if os.path.exists(os.path.join(workdir, imgname.replace('.fits','.swarp.xml'))):
-            os.system("rm {:}".format(os.path.join(workdir, imgname.replace('.fits','.swarp.xml'))))
+            os.remove(os.path.join(workdir, imgname.replace('.fits','.swarp.xml')))
 
 def _swarpone_worker(work_queue, config=None, workdir='./', defaultconfig='pyphot', delete=True, log=False, verbose=True):
 
-    """Multiprocessing worker for sexone."""
-
-    if config is not None:
-        this_config = config.copy()  # need to copy this since the config would be possibly changed in sexone!
-    else:
-        this_config = None
+    """Multiprocessing worker for swarpone."""
 
     while not work_queue.empty():
         imgname = work_queue.get()
-        swarpone(imgname, config=config, workdir=workdir, defaultconfig=defaultconfig, delete=delete, log=log, verbose=verbose)
+        # need to copy this for every image since the config would be possibly changed in swarpone!
+        this_config = config.copy() if config is not None else None
+        swarpone(imgname, config=this_config, workdir=workdir, defaultconfig=defaultconfig, delete=delete, log=log, verbose=verbose)
+
+def _raise_nofile_limit(nofile=4096):
+
+    """Raise the soft limit of opened files up to nofile (capped by the hard limit) in the calling process."""
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        nofile = min(nofile, hard)
+    if soft != resource.RLIM_INFINITY and soft < nofile:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (nofile, hard))
 
 def run_swarp(imglist, config=None, workdir='./', defaultconfig='pyphot', coadddir=None, coaddroot=None,
               n_process=4, delete=False, log=False, verbose=False):
@@ -134,7 +146,8 @@ def run_swarp(imglist, config=None, workdir='./', defaultconfig='pyphot', coaddd
             msgs.info("Coadded images are stored at {:}".format(coadddir))
 
         ## Generate a tmp list to store the imagename with path
-        tmplist = open(os.path.join(workdir, "tmplist.txt"), "w")
+        tmplist_name = os.path.join(workdir, coaddroot + "_tmplist.txt")
+        tmplist = open(tmplist_name, "w")
         for img in imglist:
             print(img, file=tmplist)
         tmplist.close()
@@ -149,17 +162,15 @@ def run_swarp(imglist, config=None, workdir='./', defaultconfig='pyphot', coaddd
 
         ## append your configuration
         configapp = get_config(config=config)
-        comd = ["swarp"] + ["@" + os.path.join(workdir, "tmplist.txt")] + configcomd + configapp + \
+        comd = ["swarp"] + ["@" + tmplist_name] + configcomd + configapp + \
                ["-COMBINE"] + ["Y"] + ["-IMAGEOUT_NAME"] + [os.path.join(coadddir, coaddroot + ".fits")] + \
                ["-WEIGHTOUT_NAME"] + [os.path.join(coadddir, coaddroot + ".weight.fits")] + \
                ["-RESAMPLE_DIR"] + [coadddir] + ["-XML_NAME"] + [os.path.join(coadddir, coaddroot + ".swarp.xml")]
 
-        # Set the max number of opened files by your computer
-        os.system("ulimit -n 4096")
-
-        p = subprocess.Popen(comd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Raise the max number of opened files for SWarp only, in the child before exec
+        p = subprocess.Popen(comd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=_raise_nofile_limit)
         out, err = p.communicate()
-        os.system("rm {:}".format(os.path.join(workdir, "tmplist.txt")))
+        os.remove(tmplist_name)
 
         if log:
             logfile = open(os.path.join(coadddir, coaddroot+".swarp.log"), "w")
@@ -173,9 +184,9 @@ def run_swarp(imglist, config=None, workdir='./', defaultconfig='pyphot', coaddd
             logfile.close()
             msgs.info("Processing log generated: " + os.path.join(coadddir, coaddroot+".swarp.log"))
         if delete:
-            os.system("rm " + os.path.join(coadddir, coaddroot+"_config.swarp"))
+            os.remove(os.path.join(coadddir, coaddroot+"_config.swarp"))
             if os.path.exists(os.path.join(coadddir, coaddroot + ".swarp.xml")):
-                os.system("rm " + os.path.join(coadddir, coaddroot + ".swarp.xml"))
+                os.remove(os.path.join(coadddir, coaddroot + ".swarp.xml"))
 
     else:
         if n_process==1:
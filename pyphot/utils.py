@@ -3,9 +3,6 @@ import itertools
 import numpy as np
 from scipy.optimize import curve_fit
 
-import matplotlib
-import matplotlib.pyplot as plt
-
 from collections import deque
 from bisect import insort, bisect_left
 
@@ -30,6 +27,7 @@ def pyplot_rcparams():
     Returns:
 
     """
+    import matplotlib.pyplot as plt
     # set some plotting parameters
     plt.rcParams["xtick.top"] = True
     plt.rcParams["ytick.right"] = True
@@ -54,6 +52,7 @@ def pyplot_rcparams_default():
     Returns:
 
     """
+    import matplotlib
     matplotlib.rcParams.update(matplotlib.rcParamsDefault)
 
 
@@ -306,6 +305,35 @@ def pixel_stats(pixels, bpm=None, sigclip=3, n_clip=10, min_pix=50):
             break
     return sky, rms
 
+def clipped_stat(pixels, bpm=None, stat='median', sigclip=3, n_clip=5):
+    """
+    Sigma-clipped median or mean of the good pixels of an image.
+
+    Gives the same value as the corresponding output of
+    `astropy.stats.sigma_clipped_stats` (median centre, std width), but the
+    good pixels are gathered once and the clipped ones are dropped on every
+    iteration, so later iterations only touch the surviving pixels and no
+    masked array is built.
+
+    :param pixels: Array to calculate the statistic for
+    :param bpm: Boolean bad pixel mask, True for pixels to be ignored
+    :param stat: 'median' or 'mean'
+    :param sigclip: Sigma value at which to clip outliers
+    :param n_clip: Maximum number of clipping iterations
+    :return: the clipped statistic
+    """
+    values = pixels[np.invert(bpm)] if bpm is not None else np.ravel(pixels)
+    values = values[np.isfinite(values)]
+    for _ in range(n_clip):
+        cen, std = np.median(values), np.std(values)
+        keep = np.abs(values - cen) <= sigclip * std
+        if keep.all():
+            break
+        values = values[keep]
+    if stat == 'median':
+        return np.median(values)
+    return np.mean(values)
+
 def gauss1D(x, amplitude, mean, stddev, offset):
     return amplitude * np.exp(-((x - mean)**2 / (2*stddev**2))) + offset
 
@@ -363,6 +391,7 @@ def robust_curve_fit(func, xx, yy, niters=5, sigclip=3, maxiters_sigclip=5, cenf
 
 def showimage(image, header=None, outroot=None, interval_method='zscale', vmin=None, vmax=None,
               stretch_method='linear', cmap='gist_yarg_r', plot_wcs=True, show=False, verbose=False):
+    import matplotlib.pyplot as plt
 
     plt.rcParams["ytick.direction"] = 'in'
     plt.rcParams["xtick.direction"] = 'in'